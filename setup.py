@@ -22,7 +22,8 @@ setup(
     url='https://gitlab.com/ska-telescope/src/ska-rucio-extended-client',
     author='rob barnsley',
     author_email='rob.barnsley@skao.int',
-    packages=['rucio_extended_client.api', 'rucio_extended_client.cli', 'rucio_extended_client.common'],
+    packages=['rucio_extended_client.api', 'rucio_extended_client.cli', 'rucio_extended_client.common',
+              'rucio_extended_client.testing'],
     package_dir={'': 'src'},
     data_files=data_files,
     scripts=scripts,
@@ -0,0 +1,30 @@
+import typing
+
+from rucio_extended_client.api.optimize import optimize_steps
+from rucio_extended_client.api.plan import Plan
+from rucio_extended_client.api.sections import SECTION_ORDER
+from rucio_extended_client.common.exceptions import DataFormatError
+
+
+def merge_plans(plans: typing.List[Plan], max_items_per_call: int = 1000) -> Plan:
+    """ Merge the plans of several uploads or downloads into a single plan, coalescing their catalog operations.
+
+    The merged plan is optimized (see rucio_extended_client.api.optimize), so it is ordered by section and e.g. the root
+    containers of every upload are created in a single call, before any of their files are uploaded. Transfers are left
+    as they are, to be run together by whichever executor runs the merged plan.
+
+    :param plans: the plans to merge
+    :param max_items_per_call: the maximum number of items (DIDs or attachments) in a single catalog call
+    :return: the merged plan
+    """
+    unknown_section_names = set(step.section_name for plan in plans for step in plan.steps) - set(SECTION_ORDER)
+    if unknown_section_names:
+        raise DataFormatError("Can't merge plans with unknown sections: {}".format(
+            ', '.join(sorted(unknown_section_names))))
+
+    first_plan = plans[0] if plans else Plan()
+    merged_plan = Plan(root_suffix=first_plan.root_suffix, path_delimiter=first_plan.path_delimiter,
+                       hierarchy_key=first_plan.hierarchy_key)
+    merged_plan.steps, _ = optimize_steps([step for plan in plans for step in plan.steps],
+                                          max_items_per_call=max_items_per_call)
+    return merged_plan
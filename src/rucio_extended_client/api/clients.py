@@ -0,0 +1,236 @@
+import threading
+import types
+import typing
+import weakref
+
+
+def _make_client(pool):
+    from rucio.client.client import Client
+    return Client()
+
+
+def _make_upload_client(pool):
+    from rucio.client.uploadclient import UploadClient
+    return UploadClient(_client=pool.get('Client'))
+
+
+def _make_download_client(pool):
+    from rucio.client.downloadclient import DownloadClient
+    return DownloadClient(client=pool.get('Client'))
+
+
+def _get_shared_client(pool):
+    return pool.get('Client')
+
+
+def _get_client_class():
+    from rucio.client.client import Client
+    return Client
+
+
+def _get_upload_client_class():
+    from rucio.client.uploadclient import UploadClient
+    return UploadClient
+
+
+def _get_download_client_class():
+    from rucio.client.downloadclient import DownloadClient
+    return DownloadClient
+
+
+class ClientPool:
+    """ A registry of Rucio clients, shared by planning, execution and verification.
+
+    Every thread gets its own instance of each client (Rucio's clients hold a requests session, which is not
+    thread-safe), created on first use and reused afterwards. By default, the catalog clients (DIDClient, RuleClient and
+    ReplicaClient) of a thread are all the same instance of rucio.client.client.Client, which the thread's UploadClient
+    and DownloadClient also wrap, so a thread authenticates and opens a keep-alive session once rather than once per
+    client. Tokens are cached by Rucio and reused until they expire.
+    """
+    default_factories = {
+        'Client': _make_client,
+        'DIDClient': _get_shared_client,
+        'DownloadClient': _make_download_client,
+        'ReplicaClient': _get_shared_client,
+        'RuleClient': _get_shared_client,
+        'UploadClient': _make_upload_client
+    }
+    # the classes the default factories make, imported when first needed
+    default_classes = {
+        'Client': _get_client_class,
+        'DIDClient': _get_client_class,
+        'DownloadClient': _get_download_client_class,
+        'ReplicaClient': _get_client_class,
+        'RuleClient': _get_client_class,
+        'UploadClient': _get_upload_client_class
+    }
+
+    def __init__(self, factories: typing.Dict[str, typing.Callable[['ClientPool'], typing.Any]] = None,
+                 classes: typing.Dict[str, typing.Callable[[], type]] = None):
+        """
+        :param factories: mapping of client name to a function taking the pool and returning a new client, overriding
+            the defaults
+        :param classes: mapping of client name to a function returning the class its factory makes (used to check the
+            methods of deferred clients without making one), overriding the defaults of any default factories kept
+        """
+        self.factories = {**self.default_factories, **(factories or {})}
+        self.classes = {name: get_class for name, get_class in self.default_classes.items()
+                        if self.factories[name] is self.default_factories[name]}
+        self.classes.update(classes or {})
+        self._local = threading.local()
+        self._names = weakref.WeakKeyDictionary()         # client -> name it was first created as
+        self._lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.factories
+
+    def get(self, name: str) -> typing.Any:
+        """ Get this thread's instance of a client, creating it if necessary.
+
+        :param name: the name of the client (e.g. DIDClient)
+        """
+        clients = self._local.__dict__.setdefault('clients', {})
+        if name not in clients:
+            client = self.factories[name](self)
+            clients[name] = client
+            with self._lock:
+                try:
+                    self._names.setdefault(client, name)
+                except TypeError:               # not weakly referenceable, so can't be rebound
+                    pass
+        return clients[name]
+
+    def get_class(self, name: str) -> typing.Union[None, type]:
+        """ Get the class of a client without making one, or None if it isn't known.
+
+        :param name: the name of the client (e.g. DIDClient)
+        """
+        if self.factories.get(name) is _get_shared_client:
+            name = 'Client'
+        get_class = self.classes.get(name)
+        return get_class() if get_class else None
+
+    def rebind(self, fqn: typing.Callable) -> typing.Callable:
+        """ Get the equivalent of a method bound to a client from this pool, bound to this thread's instance.
+
+        Anything else is returned unchanged.
+
+        :param fqn: the function to rebind
+        """
+        instance = getattr(fqn, '__self__', None)
+        try:
+            name = self._names.get(instance)
+        except TypeError:
+            return fqn
+        if name is None:
+            return fqn
+        return getattr(self.get(name), fqn.__name__)
+
+    def clear(self) -> None:
+        """ Forget this thread's clients. """
+        self._local.__dict__.pop('clients', None)
+
+
+_client_pool = None
+_client_pool_lock = threading.Lock()
+
+
+def get_client_pool() -> ClientPool:
+    """ Get the process-wide client pool. """
+    global _client_pool
+    with _client_pool_lock:
+        if _client_pool is None:
+            _client_pool = ClientPool()
+        return _client_pool
+
+
+def set_client_pool(client_pool: ClientPool) -> None:
+    """ Replace the process-wide client pool (e.g. with one whose factories make fake clients). """
+    global _client_pool
+    with _client_pool_lock:
+        _client_pool = client_pool
+
+
+def get_client(name: str) -> typing.Any:
+    """ Get this thread's instance of a client from the process-wide pool.
+
+    :param name: the name of the client (e.g. DIDClient)
+    """
+    return get_client_pool().get(name)
+
+
+class DeferredClient:
+    """ Stands in for a client of the process-wide pool until one of its methods is called.
+
+    Planning an upload, or loading a saved plan, only binds the steps to client methods, so the methods of a deferred
+    client are bound to it instead, and get (so make, and authenticate) the calling thread's client when first called.
+    Running steps from many threads then needs no rebinding, and plans that are only inspected, or only run local
+    steps, never make a client.
+    """
+    def __init__(self, name: str):
+        """
+        :param name: the name of the client in the pool (e.g. DIDClient)
+        """
+        self.name = name
+
+    def __getattr__(self, attr: str) -> typing.Callable:
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return self.get_method(attr)
+
+    def get_method(self, attr: str, check: bool = True) -> typing.Callable:
+        """ Get a method of the client, bound to this stand-in.
+
+        :param attr: the name of the method
+        :param check: check the client's class has the method (importing it if it isn't already, see
+            ClientPool.get_class), raising AttributeError if not
+        """
+        if check:
+            # without a known class, this thread's client is made to check it
+            client_class = get_client_pool().get_class(self.name) or type(get_client(self.name))
+            if not callable(getattr(client_class, attr)):
+                raise AttributeError(attr)
+        name = self.name
+
+        def call(_, *args, **kwargs):
+            return getattr(get_client(name), attr)(*args, **kwargs)
+
+        call.__name__ = call.__qualname__ = attr
+        bound = types.MethodType(call, self)
+        self.__dict__[attr] = bound                 # so that each method is bound once
+        return bound
+
+    def __repr__(self) -> str:
+        return "DeferredClient({!r})".format(self.name)
+
+
+_deferred_clients = {}
+
+
+def get_deferred_client(name: str) -> DeferredClient:
+    """ Get a stand-in for a client of the process-wide pool, which is only made when one of its methods is called.
+
+    :param name: the name of the client (e.g. DIDClient)
+    """
+    with _client_pool_lock:
+        return _deferred_clients.setdefault(name, DeferredClient(name))
+
+
+def reset_deferred_clients() -> None:
+    """ Forget the stand-ins made by get_deferred_client, along with the methods they have bound (e.g. so that a pool
+    set afterwards with set_client_pool checks their methods again).
+    """
+    with _client_pool_lock:
+        _deferred_clients.clear()
+
+
+def get_client_class_name(fqn: typing.Callable) -> typing.Union[None, str]:
+    """ Get the name of the class of the instance a method is bound to (the client name, for a deferred client), or
+    None if it isn't a bound method.
+    """
+    if not hasattr(fqn, '__self__'):
+        return None
+    instance = fqn.__self__
+    if isinstance(instance, DeferredClient):
+        return instance.name
+    return instance.__class__.__name__
@@ -0,0 +1,386 @@
+import logging
+import os
+import time
+import typing
+import uuid
+
+from rucio_extended_client.api.clients import get_client, get_deferred_client
+from rucio_extended_client.api.items import UploadItems
+from rucio_extended_client.api.plan import Plan
+from rucio_extended_client.common.exceptions import DataFormatError, UnknownMethod
+from rucio_extended_client.common.paths import PathSelector
+from rucio_extended_client.common.watch import StabilityTracker, make_watcher
+
+
+class IncrementalIngest:
+    """ Ingests files into the hierarchy of a directory that has already been uploaded, a micro-batch at a time.
+
+    The state of the hierarchy (the files registered and, for the native method, the collections that exist) is
+    fetched once when loading and then kept up to date in memory, so each micro-batch only costs the uploads, the
+    catalog calls for any new collections and, for the metadata method, a single update of the root container's
+    metadata. Files already in the hierarchy are never re-uploaded (changes to them are not ingested).
+
+    If a micro-batch fails, what its finished steps did is kept in memory too, so that retrying it doesn't repeat
+    them, and its files are uploaded under the same DID names however many times it is retried.
+    """
+    def __init__(self, root_directory: str, root_container_scope: str, root_container_name: str, rse: str,
+                 method: str = 'metadata', hierarchy_key: str = 'hierarchy', metadata_plugin: str = 'json',
+                 fallback_root_suffix: str = '__root', fallback_path_delimiter: str = '.',
+                 include: typing.List[str] = None, exclude: typing.List[str] = None):
+        """
+        :param root_directory: the local directory that was uploaded
+        :param root_container_scope: the scope of the root container
+        :param root_container_name: the name of the root container
+        :param rse: the RSE to upload to
+        :param method: the hierarchy method the directory was uploaded with (metadata or native)
+        :param hierarchy_key: metadata key holding description of how did fits into hierarchy
+        :param metadata_plugin: the Rucio metadata plugin to use
+        :param fallback_root_suffix: fallback suffix to define that the file belongs to the base directory (native)
+        :param fallback_path_delimiter: fallback delimiter used to separate directories and files (native)
+        :param include: only ingest files matching one of these globs (relative to the root directory)
+        :param exclude: don't ingest files matching any of these globs (relative to the root directory)
+        """
+        if method not in ('metadata', 'native'):
+            raise UnknownMethod("method {} is not understood".format(method))
+        self.root_directory = root_directory.rstrip(os.sep)
+        self.scope = root_container_scope
+        self.root_container_name = root_container_name
+        self.rse = rse
+        self.method = method
+        self.hierarchy_key = hierarchy_key
+        self.metadata_plugin = metadata_plugin
+        self.fallback_root_suffix = fallback_root_suffix
+        self.fallback_path_delimiter = fallback_path_delimiter
+        self.selector = PathSelector(include=include, exclude=exclude)
+        self.metadata_hierarchy = None
+        self.registered = set()             # DID names (native) or hierarchy paths (metadata) of registered files
+        self.collections = {}               # name -> DID type of collections in the hierarchy (native only)
+        # state left by micro-batches that failed, until their files are ingested
+        self.planned_names = {}             # key -> DID name the file was planned to be uploaded as
+        self.uploaded = set()               # keys of files uploaded (but not yet in the hierarchy's metadata)
+        self.unattached = {}                # name -> DID type of collections created but not attached (native only)
+
+    def _relative_parts(self, path: str) -> typing.List[str]:
+        return os.path.relpath(path, self.root_directory).split(os.sep)
+
+    def _get_key(self, parts: typing.List[str]) -> str:
+        """ Get the key a file is registered under: its DID name (native) or hierarchy path (metadata). """
+        if self.method == 'native':
+            return self.metadata_hierarchy['path_delimiter'].join([self.root_container_name] + parts)
+        return '/'.join([self.root_container_name] + parts)
+
+    def load(self) -> None:
+        """ Fetch the state of the hierarchy from the catalog. """
+        did_client = get_client('DIDClient')
+        metadata = did_client.get_metadata(
+            scope=self.scope, name=self.root_container_name, plugin=self.metadata_plugin)
+        if self.hierarchy_key not in metadata:
+            raise DataFormatError("hierarchical key ({}) not found in root container metadata. This may not be "
+                                  "hierarchical data.".format(self.hierarchy_key))
+        self.metadata_hierarchy = dict(metadata[self.hierarchy_key])
+        if self.method == 'metadata':
+            self.registered = set(self.metadata_hierarchy['file_paths_to_names'])
+        else:
+            self.metadata_hierarchy.setdefault('root_suffix', self.fallback_root_suffix)
+            self.metadata_hierarchy.setdefault('path_delimiter', self.fallback_path_delimiter)
+            self.collections = {
+                collection['name']: collection['did_type'] for collection in did_client.list_dids(
+                    scope=self.scope, filters=[{'name': self.root_container_name}], did_type='collection', long=True,
+                    recursive=True)
+            }
+            self.registered = set(
+                fi['name'] for fi in did_client.list_files(scope=self.scope, name=self.root_container_name))
+        logging.info("Loaded hierarchy of {}:{} ({} files registered)".format(
+            self.scope, self.root_container_name, len(self.registered)))
+
+    def is_pending(self, path: str) -> bool:
+        """ Check if a local file is to be ingested, i.e. it is selected and not already registered. """
+        if not os.path.isfile(path):
+            return False
+        parts = self._relative_parts(path)
+        if parts[0] == os.pardir or not self.selector.is_file_selected('/'.join(parts)):
+            return False
+        return self._get_key(parts) not in self.registered
+
+    def _ensure_container(self, plan: Plan, name: str, new_collections: typing.Dict[str, str]) -> None:
+        """ Add steps to the plan to create a container (and any missing parents) if it doesn't exist. """
+        did_client = get_deferred_client('DIDClient')
+        did_type = new_collections.get(name, self.collections.get(name))
+        if did_type == 'CONTAINER':
+            return
+        if did_type == 'DATASET':
+            raise DataFormatError("Can't add a directory beneath {}, which was uploaded as a directory containing only "
+                                  "files".format(name))
+        parent_name = name.rpartition(self.metadata_hierarchy['path_delimiter'])[0]
+        self._ensure_container(plan, parent_name, new_collections)
+        if name not in self.unattached:
+            logging.debug("Will create container {}".format(name))
+            plan.append_step("create_collections", fqn=did_client.add_container, arguments={
+                'scope': self.scope,
+                'name': name
+            })
+        plan.append_step("create_attachments", fqn=did_client.add_containers_to_containers, arguments={
+            'attachments': [{'scope': self.scope, 'name': parent_name, 'dids': [{'scope': self.scope, 'name': name}]}]
+        })
+        new_collections[name] = 'CONTAINER'
+
+    def _get_dataset(self, plan: Plan, dir_name: str, new_collections: typing.Dict[str, str]) -> str:
+        """ Get the dataset that files in a directory belong in, adding steps to the plan to create it if needed. """
+        did_client = get_deferred_client('DIDClient')
+        did_type = new_collections.get(dir_name, self.collections.get(dir_name))
+        if did_type == 'DATASET':
+            return dir_name
+        if did_type == 'CONTAINER':
+            # a directory with subdirectories, so its files are in a dataset with the root suffix
+            parent_name, dataset_name = dir_name, dir_name + self.metadata_hierarchy['root_suffix']
+        else:
+            # a new directory, uploaded as a directory containing only files
+            parent_name, dataset_name = dir_name.rpartition(self.metadata_hierarchy['path_delimiter'])[0], dir_name
+            self._ensure_container(plan, parent_name, new_collections)
+        if dataset_name not in new_collections and dataset_name not in self.collections:
+            if dataset_name not in self.unattached:
+                logging.debug("Will create dataset {}".format(dataset_name))
+                plan.append_step("create_collections", fqn=did_client.add_dataset, arguments={
+                    'scope': self.scope,
+                    'name': dataset_name
+                })
+            plan.append_step("create_attachments", fqn=did_client.add_datasets_to_containers, arguments={
+                'attachments': [
+                    {'scope': self.scope, 'name': parent_name, 'dids': [{'scope': self.scope, 'name': dataset_name}]}
+                ]
+            })
+            new_collections[dataset_name] = 'DATASET'
+        return dataset_name
+
+    def make_plan(self, paths: typing.List[str]) -> typing.Tuple[Plan, typing.Dict[str, typing.Any]]:
+        """ Make a plan to ingest files. Files that can't be placed in the hierarchy are skipped with an error.
+
+        :param paths: the paths of the files to ingest
+        :return: a tuple of the plan and the changes to make to the in-memory state once it has run
+        """
+        upload_client = get_deferred_client('UploadClient')
+        did_client = get_deferred_client('DIDClient')
+        plan = Plan(root_suffix=self.metadata_hierarchy.get('root_suffix'),
+                    path_delimiter=self.metadata_hierarchy.get('path_delimiter'), hierarchy_key=self.hierarchy_key)
+        changes = {'registered': set(), 'collections': {}, 'metadata_hierarchy': None}
+        items = UploadItems(defaults={
+            'rse': self.rse,
+            'did_scope': self.scope,
+            'dataset_scope': self.scope,
+            'register_after_upload': True
+        })
+        relative_paths = {}                             # relative path -> DID name
+        for path in paths:
+            parts = self._relative_parts(path)
+            key = self._get_key(parts)
+            if key in self.uploaded:
+                # uploaded by a micro-batch that failed afterwards, so only to be added to the metadata
+                changes['registered'].add((key, self.planned_names[key]))
+                relative_paths['/'.join(parts)] = self.planned_names[key]
+                continue
+            if self.method == 'metadata':
+                name = self.planned_names.get(key) or str(uuid.uuid4())
+                dataset_name = self.metadata_hierarchy['files_dataset_name']
+            else:
+                name = key
+                try:
+                    if self.metadata_hierarchy['root_suffix'] in parts[-1]:
+                        raise DataFormatError("File ({}) contains root suffix ({})".format(
+                            path, self.metadata_hierarchy['root_suffix']))
+                    dataset_name = self._get_dataset(
+                        plan, self.metadata_hierarchy['path_delimiter'].join([self.root_container_name] + parts[:-1]),
+                        changes['collections'])
+                except DataFormatError as e:
+                    logging.error("Skipping {}: {}".format(path, e))
+                    continue
+            logging.debug("Will upload {} as {}".format(path, name))
+            items.append({
+                'path': path,
+                'did_name': name,
+                'dataset_name': dataset_name
+            })
+            changes['registered'].add((key, name))
+            relative_paths['/'.join(parts)] = name
+        if not changes['registered']:
+            return plan, changes
+        if items:
+            plan.append_step("upload_files", fqn=upload_client.upload, arguments={
+                'items': items
+            }, size_bytes=sum(os.path.getsize(items.get_path(idx)) for idx in range(len(items))))
+
+        # The directory checksum can't be updated without rehashing the whole directory, so it is cleared.
+        metadata_hierarchy = dict(self.metadata_hierarchy, dir_checksum=None)
+        if self.method == 'metadata':
+            file_paths_to_names = dict(metadata_hierarchy['file_paths_to_names'])
+            file_paths_to_names.update(changes['registered'])
+            dirs = set(metadata_hierarchy['dirs'])
+            for key in file_paths_to_names.keys() - metadata_hierarchy['file_paths_to_names'].keys():
+                dir_path = os.path.dirname(key)
+                while dir_path and dir_path not in dirs:        # add any new directories and their ancestors
+                    dirs.add(dir_path)
+                    dir_path = os.path.dirname(dir_path)
+            metadata_hierarchy.update({
+                'n_files': len(file_paths_to_names),
+                'n_dirs': len(dirs),
+                'file_paths_to_names': file_paths_to_names,
+                'dirs': sorted(dirs)
+            })
+        elif 'manifest' in metadata_hierarchy:
+            # keep the manifest recorded on upload complete, as downloads are planned from it
+            manifest = dict(metadata_hierarchy['manifest'])
+            manifest['files'] = dict(manifest['files'], **relative_paths)
+            manifest['dirs'] = dict(manifest['dirs'])
+            for relative_path in relative_paths:
+                dir_path = os.path.dirname(relative_path)
+                while dir_path and dir_path not in manifest['dirs']:   # add any new directories and their ancestors
+                    collection_name = self._get_key(dir_path.split('/'))
+                    manifest['dirs'][dir_path] = [
+                        collection_name, changes['collections'].get(collection_name, 'CONTAINER')]
+                    dir_path = os.path.dirname(dir_path)
+            metadata_hierarchy['manifest'] = manifest
+        if metadata_hierarchy != self.metadata_hierarchy:
+            plan.append_step("add_metadata", fqn=did_client.set_metadata_bulk, arguments={
+                'scope': self.scope,
+                'name': self.root_container_name,
+                'meta': {
+                    self.hierarchy_key: metadata_hierarchy
+                }
+            })
+        changes['metadata_hierarchy'] = metadata_hierarchy
+        return plan, changes
+
+    def ingest(self, paths: typing.List[str], dry_run: bool = False) -> int:
+        """ Ingest a micro-batch of files, skipping any that are already registered.
+
+        Unlike Plan.run, a step failing raises its exception rather than dumping the plan and exiting, so that the
+        files can be ingested again in a later micro-batch (which repeats none of the steps that finished, see
+        _keep_finished_steps).
+
+        :param paths: the paths of the files to ingest
+        :param dry_run: don't actually do anything, just log
+        :return: the number of files ingested
+        """
+        paths = [path for path in dict.fromkeys(paths) if self.is_pending(path)]
+        if not paths:
+            return 0
+        st = time.time()
+        plan, changes = self.make_plan(paths)
+        if not plan.steps:
+            return 0
+        plan.optimize()
+        try:
+            while plan.current_step_number < plan.number_of_steps:
+                plan.run_next_step(dry_run=dry_run)
+        except Exception:
+            if not dry_run:
+                self._keep_finished_steps(plan, changes)
+            raise
+        if dry_run:
+            return 0
+
+        # Only update the in-memory state once the plan has run.
+        self.registered.update(key for key, _ in changes['registered'])
+        self.collections.update(changes['collections'])
+        self.metadata_hierarchy = changes['metadata_hierarchy']
+        for key, _ in changes['registered']:
+            self.planned_names.pop(key, None)
+            self.uploaded.discard(key)
+        for name in changes['collections']:
+            self.unattached.pop(name, None)
+        logging.info("Ingested {} files into {}:{} in {:.2f}s".format(
+            len(changes['registered']), self.scope, self.root_container_name, time.time() - st))
+        return len(changes['registered'])
+
+    def _keep_finished_steps(self, plan: Plan, changes: typing.Dict[str, typing.Any]) -> None:
+        """ Update the in-memory state with what the finished steps of a failed micro-batch did: the DID names its files
+        were planned as, the files it uploaded and the collections it created and attached.
+        """
+        self.planned_names.update(changes['registered'])
+        names_to_keys = {name: key for key, name in changes['registered']}
+        created, attached = set(), set()
+        for step in plan.steps:
+            if not step.is_done:
+                continue
+            if step.section_name == 'create_collections':       # add_container or add_dataset, or add_dids if optimized
+                created.update(did['name'] for did in step.arguments.get('dids', [step.arguments]))
+            elif step.section_name == 'create_attachments':
+                attached.update(did['name'] for attachment in step.arguments['attachments']
+                                for did in attachment['dids'])
+            elif step.section_name == 'upload_files':
+                self.uploaded.update(names_to_keys[item['did_name']] for item in step.arguments['items'])
+        for name, did_type in changes['collections'].items():
+            if name in attached:
+                self.collections[name] = did_type
+                self.unattached.pop(name, None)
+            elif name in created:
+                self.unattached[name] = did_type
+
+    def watch(self, settle_seconds: float = 2, batch_seconds: float = 1, max_batch_files: int = 1000,
+              poll_interval: float = 5, use_inotify: bool = True, dry_run: bool = False,
+              max_batches: int = None, retry_seconds: float = 1, max_retry_seconds: float = 300) -> None:
+        """ Watch the root directory and ingest files in micro-batches as they are written.
+
+        Files already in the directory but not yet registered (e.g. written while not watching) are ingested first.
+        If a micro-batch fails, the error is logged and its files are kept for the next micro-batch, which waits for
+        twice as long after each consecutive failure (from retry_seconds up to max_retry_seconds). While no files
+        are pending, the watcher blocks in the kernel (inotify) or sleeps between scans (polling), so
+        no CPU is used between events.
+
+        :param settle_seconds: how long a file must be unchanged for before it is ingested
+        :param batch_seconds: how long to wait for more files once a file is ready, to ingest them together
+        :param max_batch_files: the maximum number of files in a micro-batch
+        :param poll_interval: seconds between scans of the directory if inotify isn't available
+        :param use_inotify: use inotify if available
+        :param dry_run: don't actually do anything, just log
+        :param max_batches: stop after this many micro-batches (watch forever if None)
+        :param retry_seconds: seconds to wait before retrying after a micro-batch fails
+        :param max_retry_seconds: the maximum number of seconds to wait before retrying
+        """
+        if self.metadata_hierarchy is None:
+            self.load()
+        watcher = make_watcher(self.root_directory, poll_interval=poll_interval, use_inotify=use_inotify)
+        tracker = StabilityTracker(settle_seconds)
+        ready = {}                  # path -> None (ordered)
+        batch_started = None
+        retry_at = None             # time before which a failed micro-batch isn't retried
+        n_failures = 0              # number of consecutive micro-batches that have failed
+        n_batches = 0
+        logging.info("Watching {} for files to ingest into {}:{}".format(
+            self.root_directory, self.scope, self.root_container_name))
+        try:
+            while max_batches is None or n_batches < max_batches:
+                timeout = tracker.time_until_ready()
+                if batch_started is not None:
+                    batch_timeout = max(0, batch_started + batch_seconds - time.monotonic(),
+                                        (retry_at or 0) - time.monotonic())
+                    timeout = batch_timeout if timeout is None else min(timeout, batch_timeout)
+                for path in watcher.poll(timeout):
+                    if self.is_pending(path):
+                        tracker.add(path)
+                ready.update(dict.fromkeys(tracker.pop_ready()))
+                if not ready:
+                    continue
+                if batch_started is None:
+                    batch_started = time.monotonic()
+                if retry_at is not None and time.monotonic() < retry_at:
+                    continue
+                if len(ready) >= max_batch_files or time.monotonic() - batch_started >= batch_seconds:
+                    batch = list(ready)[:max_batch_files]
+                    for path in batch:
+                        del ready[path]
+                    n_batches += 1
+                    try:
+                        self.ingest(batch, dry_run=dry_run)
+                        retry_at, n_failures = None, 0
+                    except Exception as e:
+                        n_failures += 1
+                        backoff = min(max_retry_seconds, retry_seconds * 2 ** (n_failures - 1))
+                        logging.error("Failed to ingest {} files, will try again in {:.0f}s: {}".format(
+                            len(batch), backoff, repr(e)))
+                        retry_at = time.monotonic() + backoff
+                        ready = dict.fromkeys(batch + list(ready))
+                    batch_started = time.monotonic() if ready else None
+        except KeyboardInterrupt:
+            logging.info("Stopped watching {}".format(self.root_directory))
+        finally:
+            watcher.close()
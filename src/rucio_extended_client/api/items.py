@@ -0,0 +1,224 @@
+from array import array
+import collections.abc
+import os
+import typing
+
+from rucio_extended_client.api.stragglers import get_transfer_timeout
+
+# the number of items expanded into dictionaries at a time when a step is run
+EXPAND_CHUNK_ITEMS = 1000
+
+# key marking an encoded UploadItems in a JSON description of a step's arguments
+ENCODED_KEY = '__upload_items__'
+
+
+class UploadItems(collections.abc.Sequence):
+    """ A compact list of the items of an upload step.
+
+    Planning an upload of millions of files as a list of dictionaries repeats the same RSE, scopes, dataset name and
+    flags, and the same directory in every path, for every file. Here, values shared by every item are stored once as
+    defaults, directories and DID name prefixes are interned in a table, and each item is only its filename, DID name
+    suffix and size in array-backed columns. Items are expanded into the dictionaries UploadClient.upload expects when
+    they are accessed, a chunk at a time when the step is run (see iter_chunks), with a transfer timeout from the size
+    of each file where it is known (see set_size).
+    """
+    def __init__(self, defaults: typing.Dict[str, typing.Any] = None):
+        """
+        :param defaults: values shared by every item (e.g. rse, did_scope, dataset_scope, dataset_name,
+            register_after_upload)
+        """
+        self.defaults = dict(defaults or {})
+        self._strings = []                  # interned directories and DID name prefixes
+        self._string_ids = {}
+        self._directory_ids = array('I')
+        self._did_name_prefix_ids = array('I')
+        # The filename and DID name suffix of each item, encoded back to back in one buffer rather than as a string
+        # object each. An item's filename ends at its filename end, followed by its DID name suffix (empty if the
+        # suffix is the filename), which ends at its suffix end.
+        self._buffer = bytearray()
+        self._filename_ends = array('Q')
+        self._suffix_ends = array('Q')
+        self._sizes = array('q')            # the size of each item's file in bytes, or -1 if not known
+        self._overrides = {}                # index -> values that differ from the defaults (e.g. from ingest)
+
+    def _intern(self, string: str) -> int:
+        string_id = self._string_ids.get(string)
+        if string_id is None:
+            string_id = self._string_ids[string] = len(self._strings)
+            self._strings.append(string)
+        return string_id
+
+    def _append_record(self, directory_id: int, filename: str, did_name_prefix_id: int, did_name_suffix: str) -> None:
+        self._directory_ids.append(directory_id)
+        self._did_name_prefix_ids.append(did_name_prefix_id)
+        self._buffer += os.fsencode(filename)
+        self._filename_ends.append(len(self._buffer))
+        self._buffer += os.fsencode(did_name_suffix or '')
+        self._suffix_ends.append(len(self._buffer))
+        self._sizes.append(-1)
+
+    def _get_record(self, idx: int) -> typing.Tuple[int, str, int, typing.Union[None, str]]:
+        start = self._suffix_ends[idx - 1] if idx else 0
+        filename_end, suffix_end = self._filename_ends[idx], self._suffix_ends[idx]
+        filename = os.fsdecode(bytes(self._buffer[start:filename_end]))
+        did_name_suffix = os.fsdecode(bytes(self._buffer[filename_end:suffix_end])) if suffix_end > filename_end \
+            else None
+        return self._directory_ids[idx], filename, self._did_name_prefix_ids[idx], did_name_suffix
+
+    def append(self, item: typing.Dict[str, typing.Any]) -> None:
+        """ Append an item.
+
+        :param item: the item, with at least a path and DID name (other keys are only stored if they differ from the
+            defaults)
+        """
+        directory, filename = os.path.split(item['path'])
+        did_name = item['did_name']
+        # e.g. <collection><delimiter><filename> for the native method (but not a UUID that happens to end the same)
+        if filename and did_name.endswith(filename) and not did_name[:-len(filename)][-1:].isalnum():
+            did_name_prefix, did_name_suffix = did_name[:-len(filename)], None
+        else:
+            did_name_prefix, did_name_suffix = '', did_name
+        self._append_record(self._intern(directory), filename, self._intern(did_name_prefix), did_name_suffix)
+        overrides = {key: value for key, value in item.items()
+                     if key not in ('path', 'did_name') and (key not in self.defaults or self.defaults[key] != value)}
+        if overrides:
+            self._overrides[len(self) - 1] = overrides
+
+    def extend(self, items: typing.Iterable[typing.Dict[str, typing.Any]]) -> None:
+        for item in items:
+            self.append(item)
+
+    def set_path(self, idx: int, path: str) -> None:
+        """ Change the path of an item (e.g. to upload it from a staging directory), keeping its DID name. """
+        self._overrides.setdefault(idx, {})['path'] = path
+
+    def set_size(self, idx: int, size_bytes: int) -> None:
+        """ Set the size of an item's file, from which the timeout of its transfer is set when it is expanded. """
+        self._sizes[idx] = size_bytes
+
+    def get_size(self, idx: int) -> typing.Union[None, int]:
+        return self._sizes[idx] if self._sizes[idx] >= 0 else None
+
+    def get_path(self, idx: int) -> str:
+        if 'path' in self._overrides.get(idx, {}):
+            return self._overrides[idx]['path']
+        directory_id, filename, _, _ = self._get_record(idx)
+        return os.path.join(self._strings[directory_id], filename)
+
+    def get_did_name(self, idx: int) -> str:
+        _, filename, did_name_prefix_id, did_name_suffix = self._get_record(idx)
+        return self._strings[did_name_prefix_id] + (filename if did_name_suffix is None else did_name_suffix)
+
+    def select(self, idxs: typing.Iterable[int], **defaults) -> 'UploadItems':
+        """ Make a new list of some of the items.
+
+        :param idxs: the indices of the items, in the order to select them
+        :param defaults: values to add to (or replace in) the defaults of the selected items, e.g. an RSE
+        """
+        selected = UploadItems(dict(self.defaults, **defaults))
+        for idx in idxs:
+            selected.append(dict({'path': self.get_path(idx), 'did_name': self.get_did_name(idx)},
+                                 **self._overrides.get(idx, {})))
+            selected._sizes[-1] = self._sizes[idx]
+        return selected
+
+    def __len__(self) -> int:
+        return len(self._suffix_ends)
+
+    def __getitem__(self, idx: typing.Union[int, slice]) \
+            -> typing.Union[typing.Dict[str, typing.Any], typing.List[typing.Dict[str, typing.Any]]]:
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("item index out of range")
+        item = dict(self.defaults, path=self.get_path(idx), did_name=self.get_did_name(idx))
+        if self._sizes[idx] >= 0:
+            item['transfer_timeout'] = get_transfer_timeout(self._sizes[idx])
+        item.update(self._overrides.get(idx, {}))
+        return item
+
+    def __iter__(self) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __eq__(self, other: typing.Any) -> bool:
+        if isinstance(other, UploadItems):
+            return self.to_dict() == other.to_dict()
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+    def iter_chunks(self, chunk_size: int = EXPAND_CHUNK_ITEMS) \
+            -> typing.Iterator[typing.List[typing.Dict[str, typing.Any]]]:
+        """ Expand the items into dictionaries, chunk_size items at a time. """
+        for start in range(0, len(self), chunk_size):
+            yield self[start:start + chunk_size]
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        """ Get a JSON serialisable description of the items, keeping them compact. """
+        return {
+            'defaults': self.defaults,
+            'strings': self._strings,
+            'records': [list(self._get_record(idx)) for idx in range(len(self))],
+            'sizes': self._sizes.tolist(),
+            'overrides': {str(idx): overrides for idx, overrides in self._overrides.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, description: typing.Dict[str, typing.Any]) -> 'UploadItems':
+        """ Make the items from a description made by to_dict. """
+        items = cls(description['defaults'])
+        for string in description['strings']:
+            items._intern(string)
+        for directory_id, filename, did_name_prefix_id, did_name_suffix in description['records']:
+            items._append_record(directory_id, filename, did_name_prefix_id, did_name_suffix)
+        if 'sizes' in description:             # not in plans saved before sizes were kept
+            items._sizes = array('q', description['sizes'])
+        items._overrides = {int(idx): overrides for idx, overrides in description['overrides'].items()}
+        return items
+
+
+def encode_arguments(arguments: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    """ Encode a step's arguments so they are JSON serialisable, with any UploadItems kept compact. """
+    if not any(isinstance(value, UploadItems) for value in arguments.values()):
+        return arguments
+    return {key: {ENCODED_KEY: value.to_dict()} if isinstance(value, UploadItems) else value
+            for key, value in arguments.items()}
+
+
+def decode_arguments(arguments: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    """ Decode a step's arguments encoded by encode_arguments. """
+    if not any(isinstance(value, dict) and ENCODED_KEY in value for value in arguments.values()):
+        return arguments
+    return {key: UploadItems.from_dict(value[ENCODED_KEY]) if isinstance(value, dict) and ENCODED_KEY in value
+            else value for key, value in arguments.items()}
+
+
+def get_chunk_summary_path(summary_file_path: str, chunk_idx: int) -> str:
+    """ Get the path of the upload summary written for a chunk of a step's items (see call_with_arguments). """
+    return '{}.{}'.format(summary_file_path, chunk_idx)
+
+
+def call_with_arguments(fqn: typing.Callable, arguments: typing.Dict[str, typing.Any]) -> typing.Any:
+    """ Call a step's function with its arguments, expanding any UploadItems a chunk at a time so that only one chunk
+    of dictionaries exists at once (returning what the last call returns).
+
+    As each call would overwrite the upload summary of the last, a summary_file_path argument is replaced by a path for
+    each chunk (see get_chunk_summary_path).
+    """
+    key = next((key for key, value in arguments.items() if isinstance(value, UploadItems)), None)
+    if key is None:
+        return fqn(**arguments)
+    summary_file_path = arguments.get('summary_file_path')
+    if summary_file_path:
+        os.makedirs(os.path.dirname(summary_file_path), exist_ok=True)
+    rtn = None
+    for chunk_idx, chunk in enumerate(arguments[key].iter_chunks()):
+        chunk_arguments = dict(arguments, **{key: chunk})
+        if summary_file_path:
+            chunk_arguments['summary_file_path'] = get_chunk_summary_path(summary_file_path, chunk_idx)
+        rtn = fqn(**chunk_arguments)
+    return rtn
@@ -0,0 +1,237 @@
+import bisect
+import itertools
+import json
+import logging
+import os
+import typing
+
+from rucio_extended_client.api.clients import get_client
+from rucio_extended_client.common.exceptions import DataFormatError, UnknownMethod
+
+
+class Manifest:
+    """ An index of the files and directories in a hierarchy, keyed by path relative to the root container.
+
+    Paths are held in sorted lists so that everything beneath a path prefix is a contiguous range, found by bisection.
+    Together with a cumulative sum of file sizes, this means that listing a directory only touches its immediate
+    children and that totalling a directory is independent of the number of entries in the manifest.
+    """
+    version = 1
+
+    def __init__(self, files: typing.Dict[str, typing.Tuple[str, int]], dirs: typing.Iterable[str]):
+        """
+        :param files: mapping of file path (relative to the root container) to a tuple of (DID, size in bytes)
+        :param dirs: directory paths (relative to the root container)
+        """
+        self.paths = sorted(files)
+        self.dids = [files[path][0] for path in self.paths]
+        self.sizes = [files[path][1] or 0 for path in self.paths]
+        self._cumulative_sizes = list(itertools.accumulate(self.sizes, initial=0))
+
+        # Make sure all intermediate directories are present.
+        all_dirs = set()
+        for path in itertools.chain(self.paths, dirs):
+            path = os.path.dirname(path) if path in files else path
+            while path and path not in all_dirs:
+                all_dirs.add(path)
+                path = os.path.dirname(path)
+        self.dirs = sorted(all_dirs)
+
+    @staticmethod
+    def _normalise(path: str) -> str:
+        return (path or '').strip('/')
+
+    @staticmethod
+    def _range(entries: typing.List[str], prefix: str, lo: int = 0, hi: int = None) -> typing.Tuple[int, int]:
+        """ Get the index range of entries beneath a directory prefix ('' for everything). """
+        hi = len(entries) if hi is None else hi
+        if not prefix:
+            return lo, hi
+        # '0' is the character after '/', so [prefix/, prefix0) covers every path beneath prefix.
+        return (bisect.bisect_left(entries, prefix + '/', lo, hi),
+                bisect.bisect_left(entries, prefix + '0', lo, hi))
+
+    def _children(self, entries: typing.List[str], prefix: str) -> typing.Iterator[typing.Tuple[str, bool, int]]:
+        """ Iterate the immediate children of a directory prefix, skipping over the contents of subdirectories.
+
+        :return: an iterator of tuples of (path, whether the child has children of its own, index in entries)
+        """
+        lo, hi = self._range(entries, prefix)
+        offset = len(prefix) + 1 if prefix else 0
+        seen = set()
+        while lo < hi:
+            entry = entries[lo]
+            child_path = entry[:offset] + entry[offset:].split('/', 1)[0]
+            if entry == child_path:
+                seen.add(child_path)
+                yield child_path, False, lo
+                lo += 1
+            else:
+                # skip over the whole block beneath this child (which is not necessarily adjacent to the child itself,
+                # e.g. "a-b" sorts between "a" and "a/b")
+                if child_path not in seen:
+                    seen.add(child_path)
+                    yield child_path, True, lo
+                lo = bisect.bisect_left(entries, child_path + '0', lo, hi)
+
+    def is_dir(self, path: str) -> bool:
+        path = self._normalise(path)
+        if not path:
+            return True
+        idx = bisect.bisect_left(self.dirs, path)
+        return idx < len(self.dirs) and self.dirs[idx] == path
+
+    def is_file(self, path: str) -> bool:
+        return self._file_index(path) is not None
+
+    def _file_index(self, path: str) -> typing.Optional[int]:
+        path = self._normalise(path)
+        idx = bisect.bisect_left(self.paths, path)
+        if idx < len(self.paths) and self.paths[idx] == path:
+            return idx
+        return None
+
+    def ls(self, path: str = '') -> typing.List[typing.Dict[str, typing.Any]]:
+        """ List a path.
+
+        :param path: the path relative to the root container ('' for the root)
+        :return: a list of entries (just the file itself if path is a file)
+        """
+        path = self._normalise(path)
+        idx = self._file_index(path)
+        if idx is not None:
+            return [{'path': path, 'type': 'file', 'did': self.dids[idx], 'bytes': self.sizes[idx]}]
+        if not self.is_dir(path):
+            raise FileNotFoundError("{} does not exist in manifest".format(path))
+
+        entries = [{'path': child_path, 'type': 'dir', 'bytes': self.du(child_path)['bytes']}
+                   for child_path, _, _ in self._children(self.dirs, path)]
+        for child_path, is_nested, idx in self._children(self.paths, path):
+            if not is_nested:
+                entries.append({'path': child_path, 'type': 'file', 'did': self.dids[idx], 'bytes': self.sizes[idx]})
+        return sorted(entries, key=lambda entry: entry['path'])
+
+    def du(self, path: str = '') -> typing.Dict[str, typing.Any]:
+        """ Summarise the disk usage of a path.
+
+        :param path: the path relative to the root container ('' for the root)
+        :return: a dictionary of the number of files, number of directories and total size in bytes beneath the path
+        """
+        path = self._normalise(path)
+        idx = self._file_index(path)
+        if idx is not None:
+            return {'path': path, 'n_files': 1, 'n_dirs': 0, 'bytes': self.sizes[idx]}
+        if not self.is_dir(path):
+            raise FileNotFoundError("{} does not exist in manifest".format(path))
+
+        lo, hi = self._range(self.paths, path)
+        dirs_lo, dirs_hi = self._range(self.dirs, path)
+        return {
+            'path': path,
+            'n_files': hi - lo,
+            'n_dirs': dirs_hi - dirs_lo,
+            'bytes': self._cumulative_sizes[hi] - self._cumulative_sizes[lo]
+        }
+
+    @classmethod
+    def load(cls, path: str):
+        """ Load a manifest from a cached copy.
+
+        :param path: the path to load from
+        """
+        logging.info("Loading manifest from file {}".format(path))
+        with open(path, 'r') as fi:
+            inputs = json.load(fi)
+        if inputs.get('version') != cls.version:
+            raise DataFormatError("Manifest version {} is not supported".format(inputs.get('version')))
+        manifest = cls.__new__(cls)
+        manifest.paths = inputs['paths']
+        manifest.dids = inputs['dids']
+        manifest.sizes = inputs['sizes']
+        manifest.dirs = inputs['dirs']
+        manifest._cumulative_sizes = list(itertools.accumulate(manifest.sizes, initial=0))
+        return manifest
+
+    def save(self, path: str) -> None:
+        """ Save a cached copy of the manifest.
+
+        :param path: the path to save to
+        """
+        logging.info("Saving manifest to file {}".format(path))
+        with open(path, 'w') as fi:
+            json.dump({
+                'version': self.version,
+                'paths': self.paths,
+                'dids': self.dids,
+                'sizes': self.sizes,
+                'dirs': self.dirs
+            }, fi)
+
+    @classmethod
+    def from_did(cls, root_container_scope: str, root_container_name: str, method: str = 'metadata',
+                 hierarchy_key: str = 'hierarchy', metadata_plugin: str = 'json', fallback_root_suffix: str = '__root',
+                 fallback_path_delimiter: str = '.'):
+        """ Make a manifest from the hierarchy of a root container.
+
+        :param root_container_scope: the scope of the root container
+        :param root_container_name: the name of the root container
+        :param method: the hierarchy method the container was uploaded with (metadata or native)
+        :param hierarchy_key: metadata key holding description of how did fits into hierarchy
+        :param metadata_plugin: the Rucio metadata plugin to use
+        :param fallback_root_suffix: fallback suffix to define that the file belongs to the base directory (native)
+        :param fallback_path_delimiter: fallback delimiter used to separate directories and files (native)
+        :return: a populated instance of Manifest
+        """
+        # avoid a circular import
+        from rucio_extended_client.api.plan import DownloadPlanNative
+
+        did_client = get_client('DIDClient')
+        metadata = did_client.get_metadata(scope=root_container_scope, name=root_container_name, plugin=metadata_plugin)
+        if hierarchy_key not in metadata:
+            raise DataFormatError("hierarchical key ({}) not found in root container metadata. This may not be "
+                                  "hierarchical data.".format(hierarchy_key))
+        metadata_hierarchy = metadata[hierarchy_key]
+
+        def relative(path):
+            return path[len(root_container_name):].lstrip('/')
+
+        # compressed files are listed by their original size
+        compressed_files = metadata_hierarchy.get('compressed_files', {})
+
+        if method == 'metadata':
+            files_dataset_name = metadata_hierarchy['files_dataset_name']
+            names_to_sizes = {
+                fi['name']: compressed_files[fi['name']]['bytes'] if fi['name'] in compressed_files else fi['bytes']
+                for fi in did_client.list_files(scope=root_container_scope, name=files_dataset_name)
+            }
+            files = {
+                relative(path): ('{}:{}'.format(root_container_scope, name), names_to_sizes.get(name))
+                for path, name in metadata_hierarchy['file_paths_to_names'].items()
+            }
+            dirs = [relative(dir) for dir in metadata_hierarchy['dirs']]
+        elif method == 'native':
+            plan = DownloadPlanNative(
+                root_suffix=metadata_hierarchy.get('root_suffix', fallback_root_suffix),
+                path_delimiter=metadata_hierarchy.get('path_delimiter', fallback_path_delimiter))
+            file_sizes = {}
+            if 'manifest' in metadata_hierarchy:        # recorded on upload, so the hierarchy needn't be crawled
+                for fi in did_client.list_files(scope=root_container_scope, name=root_container_name):
+                    file_sizes['{}:{}'.format(fi['scope'], fi['name'])] = fi['bytes']
+                paths = plan._paths_from_manifest(
+                    metadata_hierarchy['manifest'], root_container_scope, root_container_name)
+            else:
+                graph, roots, collections = plan._create_directed_graph(
+                    root_container_name, root_container_scope, file_sizes=file_sizes)
+                paths = plan._paths_from_tree(plan._make_tree_from_graph(graph, roots), collections)
+            files = {}
+            dirs = []
+            for lfn, _, _, relative_path in paths:
+                if lfn is None:
+                    dirs.append(relative_path)
+                else:
+                    name = lfn.split(':')[1]
+                    files[relative_path] = (
+                        lfn, compressed_files[name]['bytes'] if name in compressed_files else file_sizes.get(lfn))
+        else:
+            raise UnknownMethod("method {} is not understood".format(method))
+        return cls(files, dirs)
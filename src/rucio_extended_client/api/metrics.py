@@ -0,0 +1,151 @@
+import bisect
+import json
+import logging
+import os
+import time
+import typing
+
+
+class SectionMetrics:
+    """ Aggregated metrics for the steps of a single plan section. """
+    # upper bounds (in seconds) of the latency histogram buckets, the last bucket is unbounded
+    buckets = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+    __slots__ = ('n_steps', 'n_failed', 'seconds', 'bytes', 'calls', 'bucket_counts')
+
+    def __init__(self):
+        self.n_steps = 0
+        self.n_failed = 0
+        self.seconds = 0.
+        self.bytes = 0
+        self.calls = {}
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+
+    def record(self, function_name: str, seconds: float, size_bytes: int = None, success: bool = True) -> None:
+        self.n_steps += 1
+        self.seconds += seconds
+        if success:
+            self.bytes += size_bytes or 0
+        else:
+            self.n_failed += 1
+        self.calls[function_name] = self.calls.get(function_name, 0) + 1
+        self.bucket_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'n_steps': self.n_steps,
+            'n_failed': self.n_failed,
+            'seconds': self.seconds,
+            'bytes': self.bytes,
+            'bytes_per_second': self.bytes / self.seconds if self.seconds else None,
+            'calls': dict(self.calls),
+            'latency_histogram': {
+                **{str(bound): count for bound, count in zip(self.buckets, self.bucket_counts)},
+                '+Inf': self.bucket_counts[-1]
+            }
+        }
+
+
+class PlanMetrics:
+    """ Per-section timing, throughput and call-count metrics for the steps run in a plan.
+
+    Reports are written as JSON and/or as a Prometheus textfile (for the node exporter's textfile collector), both at
+    the end of a run and, during long runs, whenever report_interval seconds have passed since the last report (checked
+    between steps).
+    """
+    def __init__(self, json_path: str = None, prometheus_path: str = None, report_interval: float = 60):
+        """
+        :param json_path: path to write the JSON report to
+        :param prometheus_path: path to write the Prometheus textfile report to
+        :param report_interval: minimum number of seconds between periodic reports
+        """
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.report_interval = report_interval
+        self.sections = {}
+        self.start_time = time.time()
+        self._last_report_time = self.start_time
+
+    def record(self, section_name: str, function_name: str, seconds: float, size_bytes: int = None,
+               success: bool = True) -> None:
+        """ Record a step.
+
+        :param section_name: the section the step belongs to
+        :param function_name: the name of the function the step called
+        :param seconds: wall time taken by the step
+        :param size_bytes: number of bytes moved by the step, if known
+        :param success: whether the step succeeded
+        """
+        if section_name not in self.sections:
+            self.sections[section_name] = SectionMetrics()
+        self.sections[section_name].record(function_name, seconds, size_bytes, success)
+
+    def report_if_due(self) -> None:
+        """ Write the reports if report_interval seconds have passed since the last report. """
+        if time.time() - self._last_report_time >= self.report_interval:
+            self.report()
+
+    def report(self) -> None:
+        """ Write the reports. """
+        self._last_report_time = time.time()
+        if self.json_path:
+            self._write_atomically(self.json_path, json.dumps(self.to_dict(), indent=2))
+        if self.prometheus_path:
+            self._write_atomically(self.prometheus_path, self.to_prometheus())
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'start_time': self.start_time,
+            'elapsed_seconds': time.time() - self.start_time,
+            'sections': {section_name: metrics.to_dict() for section_name, metrics in self.sections.items()}
+        }
+
+    def to_prometheus(self) -> str:
+        """ Format the metrics in the Prometheus text exposition format. """
+        lines = [
+            "# HELP rucio_extended_plan_steps_total Number of plan steps run.",
+            "# TYPE rucio_extended_plan_steps_total counter"
+        ]
+        for section_name, metrics in sorted(self.sections.items()):
+            lines.append('rucio_extended_plan_steps_total{{section="{}",status="success"}} {}'.format(
+                section_name, metrics.n_steps - metrics.n_failed))
+            lines.append('rucio_extended_plan_steps_total{{section="{}",status="failure"}} {}'.format(
+                section_name, metrics.n_failed))
+        lines += [
+            "# HELP rucio_extended_plan_bytes_total Number of bytes moved by plan steps.",
+            "# TYPE rucio_extended_plan_bytes_total counter"
+        ]
+        for section_name, metrics in sorted(self.sections.items()):
+            lines.append('rucio_extended_plan_bytes_total{{section="{}"}} {}'.format(section_name, metrics.bytes))
+        lines += [
+            "# HELP rucio_extended_plan_calls_total Number of calls made by plan steps, by function.",
+            "# TYPE rucio_extended_plan_calls_total counter"
+        ]
+        for section_name, metrics in sorted(self.sections.items()):
+            for function_name, count in sorted(metrics.calls.items()):
+                lines.append('rucio_extended_plan_calls_total{{section="{}",function="{}"}} {}'.format(
+                    section_name, function_name, count))
+        lines += [
+            "# HELP rucio_extended_plan_step_duration_seconds Wall time taken by plan steps.",
+            "# TYPE rucio_extended_plan_step_duration_seconds histogram"
+        ]
+        for section_name, metrics in sorted(self.sections.items()):
+            cumulative_count = 0
+            for bound, count in zip(SectionMetrics.buckets + ('+Inf',), metrics.bucket_counts):
+                cumulative_count += count
+                lines.append('rucio_extended_plan_step_duration_seconds_bucket{{section="{}",le="{}"}} {}'.format(
+                    section_name, bound, cumulative_count))
+            lines.append('rucio_extended_plan_step_duration_seconds_sum{{section="{}"}} {}'.format(
+                section_name, metrics.seconds))
+            lines.append('rucio_extended_plan_step_duration_seconds_count{{section="{}"}} {}'.format(
+                section_name, metrics.n_steps))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _write_atomically(path: str, content: str) -> None:
+        """ Write to a temporary file and rename so that readers never see a partial report. """
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'w') as fi:
+            fi.write(content)
+        os.replace(tmp_path, path)
+        logging.debug("Written metrics report to {}".format(path))
@@ -0,0 +1,215 @@
+from importlib import import_module
+import json
+import logging
+import os
+import typing
+
+from rucio_extended_client.api.clients import get_client_class_name
+from rucio_extended_client.api.items import encode_arguments
+from rucio_extended_client.api.sections import SECTION_ORDER
+from rucio_extended_client.api.step import Step, describe_fqn
+
+# mapping of the name of a catalog function to the name of the bulk function its calls can be coalesced into
+BULK_FUNCTION_NAMES = {
+    'add_container': 'add_dids',
+    'add_dataset': 'add_dids',
+    'add_containers_to_containers': 'add_containers_to_containers',
+    'add_datasets_to_containers': 'add_datasets_to_containers',
+    'add_files_to_datasets': 'add_files_to_datasets',
+    'add_replication_rule': 'add_replication_rule',
+    'set_metadata_bulk': 'set_dids_metadata_bulk'
+}
+
+# the type of DID created by each function coalesced into add_dids
+DID_TYPES = {
+    'add_container': 'CONTAINER',
+    'add_dataset': 'DATASET'
+}
+
+
+def _get_sibling_function(fqn: typing.Callable, name: str) -> typing.Union[None, typing.Callable]:
+    """ Get another function of the same client as fqn, bound to the same instance if fqn is bound (None if the client
+    has no such function).
+    """
+    if hasattr(fqn, '__self__'):                                                    # bound method
+        return getattr(fqn.__self__, name, None)
+    client_cls = getattr(import_module(fqn.__module__), fqn.__qualname__.split('.')[0], None)  # e.g. mock plans
+    return getattr(client_cls, name, None)
+
+
+def _get_bulk_call(step: Step) -> typing.Union[None, typing.Tuple[typing.Callable, str, typing.Dict[str, typing.Any],
+                                                                    typing.List[typing.Any]]]:
+    """ Get how a step's call can be coalesced with others.
+
+    :return: None if it can't be, otherwise a tuple of the bulk function, the argument key holding the list of items,
+        the other (fixed) arguments and the step's items
+    """
+    name = step.fqn.__name__
+    if step.is_done or name not in BULK_FUNCTION_NAMES:
+        return None
+    bulk_fqn = _get_sibling_function(step.fqn, BULK_FUNCTION_NAMES[name])
+    if bulk_fqn is None:
+        return None
+    arguments = step.arguments
+    if name in DID_TYPES:
+        if set(arguments) != {'scope', 'name'}:
+            return None
+        return bulk_fqn, 'dids', {}, [{'scope': arguments['scope'], 'name': arguments['name'],
+                                       'type': DID_TYPES[name]}]
+    if name == 'set_metadata_bulk':
+        if set(arguments) != {'scope', 'name', 'meta'}:
+            return None
+        return bulk_fqn, 'dids', {}, [{'scope': arguments['scope'], 'name': arguments['name'],
+                                       'meta': arguments['meta']}]
+    list_key = 'dids' if name == 'add_replication_rule' else 'attachments'
+    fixed_arguments = {key: value for key, value in arguments.items() if key != list_key}
+    return bulk_fqn, list_key, fixed_arguments, list(arguments[list_key])
+
+
+def coalesce_steps(steps: typing.List[Step], max_items_per_call: int = 1000) -> typing.List[Step]:
+    """ Coalesce catalog steps into as few bulk calls as possible.
+
+    Steps calling the same bulk function with the same fixed arguments (e.g. rules with the same RSE expression and
+    lifetime) are merged, in chunks of at most max_items_per_call items, at the position of the first of them. Other
+    steps are left as they are.
+
+    :param steps: the steps to coalesce, all from the same section
+    :param max_items_per_call: the maximum number of items (DIDs or attachments) in a single call
+    :return: the coalesced steps
+    """
+    entries = []            # steps left as they are, or keys of groups of coalesced items
+    groups = {}             # key -> (function, list key, fixed arguments, items)
+    for step in steps:
+        bulk_call = _get_bulk_call(step)
+        if bulk_call is None:
+            entries.append(step)
+            continue
+        bulk_fqn, list_key, fixed_arguments, items = bulk_call
+        key = (describe_fqn(bulk_fqn), json.dumps(fixed_arguments, sort_keys=True, default=str))
+        if key not in groups:
+            groups[key] = (bulk_fqn, list_key, fixed_arguments, [])
+            entries.append(key)
+        groups[key][3].extend(items)
+
+    coalesced_steps = []
+    section_name = steps[0].section_name if steps else None
+    for entry in entries:
+        if isinstance(entry, Step):
+            coalesced_steps.append(entry)
+            continue
+        fqn, list_key, fixed_arguments, items = groups[entry]
+        for idx in range(0, len(items), max_items_per_call):
+            coalesced_steps.append(Step(section_name, fqn, {
+                **fixed_arguments,
+                list_key: items[idx:idx + max_items_per_call]
+            }))
+    return coalesced_steps
+
+
+def _get_step_key(step: Step) -> str:
+    """ Get a key that is the same for steps that do exactly the same thing. """
+    fqn = step.fqn
+    owner = get_client_class_name(fqn)
+    return json.dumps([step.section_name, fqn.__module__, owner, fqn.__name__, encode_arguments(step.arguments)],
+                      sort_keys=True, default=str)
+
+
+def remove_duplicate_steps(steps: typing.List[Step]) -> typing.List[Step]:
+    """ Remove steps that are identical to an earlier step. """
+    seen = set()
+    unique_steps = []
+    for step in steps:
+        key = _get_step_key(step)
+        if key not in seen:
+            seen.add(key)
+            unique_steps.append(step)
+    return unique_steps
+
+
+def _get_created_directory(step: Step) -> typing.Union[None, str]:
+    """ Get the directory a step creates with os.makedirs(exist_ok=True), if it does only that. """
+    if step.fqn is not os.makedirs or set(step.arguments) != {'name', 'exist_ok'} or not step.arguments['exist_ok']:
+        return None
+    return os.path.normpath(step.arguments['name'])
+
+
+def remove_implied_directories(steps: typing.List[Step]) -> typing.List[Step]:
+    """ Remove steps creating a directory that a step creating a directory below it creates anyway. """
+    ancestors = set()
+    for step in steps:
+        path = _get_created_directory(step)
+        while path:
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+            ancestors.add(path)
+    return [step for step in steps if _get_created_directory(step) not in ancestors]
+
+
+def group_steps_by_function(steps: typing.List[Step]) -> typing.List[Step]:
+    """ Reorder steps by section (in SECTION_ORDER) and then by function, keeping the order of the plan otherwise. """
+    section_idxs = {section_name: idx for idx, section_name in enumerate(SECTION_ORDER)}
+    function_idxs = {}
+    for step in steps:
+        function_idxs.setdefault((step.section_name, step.fqn.__name__), len(function_idxs))
+    return sorted(steps, key=lambda step: (section_idxs[step.section_name],
+                                           function_idxs[(step.section_name, step.fqn.__name__)]))
+
+
+def optimize_steps(steps: typing.List[Step], coalesce: bool = True, max_items_per_call: int = 1000) \
+        -> typing.Tuple[typing.List[Step], typing.Dict[str, int]]:
+    """ Optimize pending steps, by applying the following rules in turn:
+
+    - identical steps are removed,
+    - if every section is known, the steps are grouped by section and function. Then directories created by a step
+      creating a directory below them are removed, and, if coalesce is set, catalog steps are coalesced into bulk calls.
+
+    :param steps: the pending steps of a plan, in plan order
+    :param coalesce: coalesce catalog steps into bulk calls
+    :param max_items_per_call: the maximum number of items (DIDs or attachments) in a single coalesced call
+    :return: a tuple of the optimized steps and a report of the number of steps removed by each rule
+    """
+    report = {'n_steps': len(steps)}
+    optimized_steps = remove_duplicate_steps(steps)
+    report['n_duplicates'] = len(steps) - len(optimized_steps)
+    report['n_implied_directories'] = report['n_coalesced'] = 0
+    if all(step.section_name in SECTION_ORDER for step in optimized_steps):
+        optimized_steps = group_steps_by_function(optimized_steps)
+        n_steps = len(optimized_steps)
+        optimized_steps = remove_implied_directories(optimized_steps)
+        report['n_implied_directories'] = n_steps - len(optimized_steps)
+        if coalesce:
+            n_steps = len(optimized_steps)
+            steps_by_section = {}
+            for step in optimized_steps:
+                steps_by_section.setdefault(step.section_name, []).append(step)
+            optimized_steps = [step for section_name in SECTION_ORDER
+                               for step in coalesce_steps(steps_by_section.get(section_name, []), max_items_per_call)]
+            report['n_coalesced'] = n_steps - len(optimized_steps)
+    report['n_removed'] = len(steps) - len(optimized_steps)
+    return optimized_steps, report
+
+
+def optimize_plan(plan, coalesce: bool = True, max_items_per_call: int = 1000) -> typing.Dict[str, int]:
+    """ Optimize the steps of a plan that are still to run (see optimize_steps), in place.
+
+    Steps before the plan's current step, and steps that are done, are left where they are.
+
+    :param plan: the plan to optimize
+    :param coalesce: coalesce catalog steps into bulk calls
+    :param max_items_per_call: the maximum number of items (DIDs or attachments) in a single coalesced call
+    :return: a report of the number of steps removed by each rule
+    """
+    head = plan.steps[:plan.current_step_number]
+    tail = plan.steps[plan.current_step_number:]
+    done_steps = [step for step in tail if step.is_done]
+    optimized_steps, report = optimize_steps([step for step in tail if not step.is_done], coalesce,
+                                             max_items_per_call)
+    plan.steps = head + done_steps + optimized_steps
+    if report['n_removed']:
+        logging.info("Optimized plan: removed {} of {} pending steps ({} duplicates, {} implied directories, {} "
+                     "coalesced into bulk calls)".format(report['n_removed'], report['n_steps'],
+                                                         report['n_duplicates'], report['n_implied_directories'],
+                                                         report['n_coalesced']))
+    return report
@@ -0,0 +1,285 @@
+import fcntl
+import heapq
+import json
+import logging
+import os
+import socket
+import time
+import typing
+
+from rucio_extended_client.api.plan import Plan
+from rucio_extended_client.api.sections import SECTION_ORDER
+from rucio_extended_client.common.compression import DEFAULT_STAGING_DIRECTORY
+from rucio_extended_client.common.exceptions import DataFormatError, ShardDependencyError
+
+# sections holding transfers, and the steps that depend only on a single transfer step (renaming the files it
+# downloaded), which are spread over the transfer shards
+TRANSFER_SECTIONS = ('upload_files', 'download_files', 'rename_files')
+
+COORDINATOR_SHARD_NAME = 'coordinator'
+FINAL_SHARD_NAME = 'final'
+
+
+def _get_download_paths(step) -> typing.Iterator[str]:
+    """ Get the paths a download step downloads its files to (without knowing the files of collections). """
+    for item in step.arguments.get('items', []):
+        scope, name = item['did'].split(':', 1)
+        base_dir = item.get('base_dir', '.')
+        yield os.path.join(base_dir, name) if item.get('no_subdir') else os.path.join(base_dir, scope, name)
+
+
+def partition_plan(plan: Plan, n_shards: int) -> typing.Dict[str, Plan]:
+    """ Partition a plan into shards that can be run on different hosts sharing a filesystem.
+
+    - the coordinator shard holds the steps that must be run before any transfer (e.g. creating collections and
+      attachments, or local directories),
+    - the n_shards transfer shards hold the transfers, balanced by bytes, each with the renames of the files its
+      downloads download,
+    - the final shard holds the steps that must be run after every transfer (e.g. adding rules and metadata, and any
+      renames of files not downloaded by a download step of their own).
+
+    Files compressed before being uploaded must be staged in a directory every host can read, so plans compressing
+    files into the default staging directory (in the system temporary directory) are not partitioned.
+
+    :param plan: the plan to partition
+    :param n_shards: the number of transfer shards
+    :return: an ordered mapping of shard name to plan
+    """
+    if n_shards < 1:
+        raise ValueError("number of shards must be at least 1")
+    unknown_section_names = set(step.section_name for step in plan.steps) - set(SECTION_ORDER)
+    if unknown_section_names:
+        raise DataFormatError("Can't partition a plan with unknown sections: {}".format(
+            ', '.join(sorted(unknown_section_names))))
+    default_staging_directory = os.path.abspath(DEFAULT_STAGING_DIRECTORY)
+    for step in plan.steps:
+        if step.section_name == 'compress_files' and os.path.commonpath(
+                [os.path.abspath(step.arguments['dst']), default_staging_directory]) == default_staging_directory:
+            raise DataFormatError("Can't partition a plan staging compressed files in {}, which other hosts can't "
+                                  "read (set --staging-dir to a directory every host shares)".format(
+                                      DEFAULT_STAGING_DIRECTORY))
+    first_transfer_section_idx = SECTION_ORDER.index(TRANSFER_SECTIONS[0])
+
+    coordinator_steps, final_steps, transfer_units, renames = [], [], [], []
+    for step in plan.steps:
+        if step.section_name == 'rename_files':
+            renames.append(step)
+        elif step.section_name in TRANSFER_SECTIONS:
+            transfer_units.append([step])               # in plan order
+        elif SECTION_ORDER.index(step.section_name) < first_transfer_section_idx:
+            coordinator_steps.append(step)
+        else:
+            final_steps.append(step)
+
+    # Each rename stays with the download of the file it renames, wherever that is in the plan (the optimizer groups
+    # every rename after every download). Renames of files downloaded otherwise are run once every transfer is done.
+    download_unit_idxs = {path: unit_idx for unit_idx, unit in enumerate(transfer_units)
+                          if unit[0].section_name == 'download_files' for path in _get_download_paths(unit[0])}
+    unpaired_renames = []
+    for step in renames:
+        unit_idx = download_unit_idxs.get(step.arguments.get('src'))
+        if unit_idx is None:
+            unpaired_renames.append(step)
+        else:
+            transfer_units[unit_idx].append(step)
+    final_steps = unpaired_renames + final_steps
+
+    # Assign the largest transfers first, each to the shard with fewest bytes so far.
+    transfer_shard_units = [[] for _ in range(n_shards)]
+    shard_loads = [(0, idx) for idx in range(n_shards)]
+    unit_sizes = [unit[0].size_bytes or 0 for unit in transfer_units]
+    for unit_idx in sorted(range(len(transfer_units)), key=lambda unit_idx: unit_sizes[unit_idx], reverse=True):
+        load, idx = heapq.heappop(shard_loads)
+        transfer_shard_units[idx].append(unit_idx)
+        heapq.heappush(shard_loads, (load + unit_sizes[unit_idx], idx))
+
+    def make_shard(steps):
+        shard = Plan(root_suffix=plan.root_suffix, path_delimiter=plan.path_delimiter,
+                     hierarchy_key=plan.hierarchy_key)
+        for step in steps:
+            shard.append_step(step.section_name, step.fqn, arguments=step.arguments, is_done=step.is_done,
+                              size_bytes=step.size_bytes)
+        return shard
+
+    shards = {COORDINATOR_SHARD_NAME: make_shard(coordinator_steps)}
+    for idx, unit_idxs in enumerate(transfer_shard_units):
+        shards['transfer-{}'.format(idx)] = make_shard(
+            [step for unit_idx in sorted(unit_idxs) for step in transfer_units[unit_idx]])     # in plan order
+    shards[FINAL_SHARD_NAME] = make_shard(final_steps)
+    return shards
+
+
+def save_partitioned_plan(plan: Plan, n_shards: int, prefix: str) -> str:
+    """ Partition a plan and save each shard, along with a manifest describing them and their dependencies.
+
+    :param plan: the plan to partition
+    :param n_shards: the number of transfer shards
+    :param prefix: path prefix of the files to save
+    :return: the path of the manifest
+    """
+    shards = partition_plan(plan, n_shards)
+    manifest = {
+        'journal_path': '{}.journal'.format(prefix),
+        'shards': []
+    }
+    transfer_shard_names = [name for name in shards if name not in (COORDINATOR_SHARD_NAME, FINAL_SHARD_NAME)]
+    for name, shard in shards.items():
+        path = '{}.{}.json'.format(prefix, name)
+        shard.save(path)
+        if name == COORDINATOR_SHARD_NAME:
+            depends_on = []
+        elif name == FINAL_SHARD_NAME:
+            depends_on = [COORDINATOR_SHARD_NAME] + transfer_shard_names
+        else:
+            depends_on = [COORDINATOR_SHARD_NAME]
+        manifest['shards'].append({
+            'name': name,
+            'path': path,
+            'depends_on': depends_on,
+            'n_steps': shard.number_of_steps,
+            'size_bytes': sum(step.size_bytes or 0 for step in shard.steps)
+        })
+    manifest_path = '{}.shards.json'.format(prefix)
+    with open(manifest_path, 'w') as fi:
+        json.dump(manifest, fi, indent=2)
+    logging.info("Saved {} shards with manifest {}".format(len(shards), manifest_path))
+    return manifest_path
+
+
+class ShardJournal:
+    """ An append-only journal of shard progress, safe to share between hosts.
+
+    Each record is a line of JSON, appended under an exclusive fcntl lock and flushed to disk before the lock is
+    released, so concurrent writers on a shared filesystem (with working POSIX locks) never interleave records.
+    """
+    def __init__(self, path: str):
+        """
+        :param path: the path of the journal (created if it doesn't exist)
+        """
+        self.path = path
+
+    def record(self, shard_name: str, event: str, step_number: int = None) -> None:
+        """ Append a record.
+
+        :param shard_name: the name of the shard
+        :param event: the event (shard_started, step_done or shard_done)
+        :param step_number: the number of the step within the shard, for step_done events
+        """
+        line = json.dumps({
+            'shard': shard_name,
+            'event': event,
+            'step': step_number,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'time': time.time()
+        }) + '\n'
+        with open(self.path, 'a') as fi:
+            fcntl.flock(fi, fcntl.LOCK_EX)
+            try:
+                fi.write(line)
+                fi.flush()
+                os.fsync(fi.fileno())
+            finally:
+                fcntl.flock(fi, fcntl.LOCK_UN)
+
+    def read(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """ Read the state of every shard in the journal.
+
+        :return: mapping of shard name to a dictionary of the set of done step numbers, whether the shard is done and
+            the hosts that have started it
+        """
+        shards = {}
+        if not os.path.exists(self.path):
+            return shards
+        with open(self.path, 'r') as fi:
+            fcntl.flock(fi, fcntl.LOCK_SH)
+            try:
+                lines = fi.readlines()
+            finally:
+                fcntl.flock(fi, fcntl.LOCK_UN)
+        for line in lines:
+            if not line.endswith('\n'):
+                continue                        # partially written by a writer that died
+            record = json.loads(line)
+            shard = shards.setdefault(record['shard'], {'done_steps': set(), 'is_done': False, 'hosts': set()})
+            if record['event'] == 'shard_started':
+                shard['hosts'].add(record['host'])
+            elif record['event'] == 'step_done':
+                shard['done_steps'].add(record['step'])
+            elif record['event'] == 'shard_done':
+                shard['is_done'] = True
+        return shards
+
+
+class ShardRunner:
+    """ Runs one shard of a partitioned plan, recording progress in the shared journal.
+
+    A shard only starts once the shards it depends on are done, and steps already recorded as done in the journal are
+    skipped, so an interrupted shard can be rerun (on any host).
+    """
+    def __init__(self, manifest_path: str, shard_name: str, poll_interval: float = 10):
+        """
+        :param manifest_path: the path of the manifest saved by save_partitioned_plan
+        :param shard_name: the name of the shard to run
+        :param poll_interval: seconds between checks of whether the shards this one depends on are done
+        """
+        with open(manifest_path, 'r') as fi:
+            self.manifest = json.load(fi)
+        shards = {shard['name']: shard for shard in self.manifest['shards']}
+        if shard_name not in shards:
+            raise ShardDependencyError("Shard {} is not in manifest {}".format(shard_name, manifest_path))
+        self.shard = shards[shard_name]
+        self.journal = ShardJournal(self.manifest['journal_path'])
+        self.poll_interval = poll_interval
+
+    def get_pending_dependencies(self) -> typing.List[str]:
+        state = self.journal.read()
+        return [name for name in self.shard['depends_on'] if not state.get(name, {}).get('is_done')]
+
+    def wait_for_dependencies(self, wait: bool = True) -> None:
+        """ Wait until the shards this one depends on are done.
+
+        :param wait: raise immediately instead of waiting if any are pending
+        """
+        while True:
+            pending = self.get_pending_dependencies()
+            if not pending:
+                return
+            if not wait:
+                raise ShardDependencyError("Shard {} depends on pending shards: {}".format(
+                    self.shard['name'], ', '.join(pending)))
+            logging.info("Waiting for shards {} to finish".format(', '.join(pending)))
+            time.sleep(self.poll_interval)
+
+    def run(self, dry_run: bool = False, wait: bool = True) -> None:
+        """ Run the shard.
+
+        :param dry_run: don't actually do anything, just print
+        :param wait: wait for the shards this one depends on (otherwise raise if any are pending)
+        """
+        name = self.shard['name']
+        self.wait_for_dependencies(wait)
+        state = self.journal.read().get(name, {'done_steps': set(), 'is_done': False, 'hosts': set()})
+        if state['is_done']:
+            logging.info("Shard {} is already done".format(name))
+            return
+        other_hosts = state['hosts'] - {socket.gethostname()}
+        if other_hosts:
+            logging.warning("Shard {} has previously been started on {}".format(name, ', '.join(sorted(other_hosts))))
+
+        plan = Plan.load(self.shard['path'])
+        for step_number in state['done_steps']:
+            plan.steps[step_number].is_done = True
+        self.journal.record(name, 'shard_started')
+        logging.info("Running shard {} ({} of {} steps already done)".format(
+            name, len(state['done_steps']), plan.number_of_steps))
+        for step_number, step in enumerate(plan.steps):
+            if step.is_done:
+                continue
+            plan.current_step_number = step_number
+            plan.run_next_step(dry_run=dry_run)
+            if not dry_run:
+                self.journal.record(name, 'step_done', step_number)
+        if not dry_run:
+            self.journal.record(name, 'shard_done')
+            logging.info("Shard {} is done".format(name))
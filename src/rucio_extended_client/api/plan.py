@@ -1,38 +1,52 @@
-from importlib import import_module
-import json
+import itertools
 import logging
 import os
-import pathlib
 import shutil
 import time
 import typing
 import uuid
 
-from dirhash import dirhash
-from rucio.client import client
-from rucio.client.didclient import DIDClient
-from rucio.client.downloadclient import DownloadClient
-from rucio.client.ruleclient import RuleClient
-from rucio.client.uploadclient import UploadClient
-from treelib.exceptions import DuplicatedNodeIdError
-from treelib import Node, Tree
 
-from rucio_extended_client.common.exceptions import DataFormatError
-from rucio_extended_client.api.step import Step
+from rucio_extended_client.common.checksum import DEFAULT_DIR_CHECKSUM_ALGORITHM, calculate_dir_checksum, \
+    find_up_to_date_files
+from rucio_extended_client.common.compression import DEFAULT_STAGING_DIRECTORY, CompressionPolicy, compress_file, \
+    decompress_file
+from rucio_extended_client.common.exceptions import ArgumentError, DataFormatError
+from rucio_extended_client.common.paths import PathSelector
+from rucio_extended_client.api.clients import get_client, get_deferred_client
+from rucio_extended_client.api.items import UploadItems, call_with_arguments
+from rucio_extended_client.api.metrics import PlanMetrics
+from rucio_extended_client.api.optimize import optimize_plan
+from rucio_extended_client.api.planfile import PlanFileReader, print_summary, summarise_step_heads, \
+    write_plan_file
+from rucio_extended_client.api.registration import SUMMARY_DIRECTORY, make_registration_batches, register_files
+from rucio_extended_client.api.scheduling import WeightedStriper, schedule_largest_first
+from rucio_extended_client.api.step import Step, describe_fqn
+from rucio_extended_client.api.store import PlanStore, is_plan_store_path
+from rucio_extended_client.api.stragglers import get_transfer_timeout
+
+# Rucio, treelib and dirhash are slow to import, so are only imported when used (see the README on startup time).
+if typing.TYPE_CHECKING:
+    from treelib import Tree
 
 
 class Plan:
-    def __init__(self, root_suffix: str = None, path_delimiter: str = None, hierarchy_key: str = None, **kwargs):
+    def __init__(self, root_suffix: str = None, path_delimiter: str = None, hierarchy_key: str = None,
+                 root_directory: str = None, **kwargs):
         """
         :param root_suffix: suffix to define that the file belongs to the base directory (native method only)
         :param path_delimiter: delimiter used to separate directories and files (native method only)
         :param hierarchy_key: metadata key holding description of how did fits into hierarchy (metadata method only)
+        :param root_directory: the directory being uploaded, if its directory checksum is calculated while uploading
+            (see HybridPlanRunner), so that a resumed run can still calculate it
         """
         self._current_step_number = 0
         self.steps = []
         self.root_suffix = root_suffix
         self.path_delimiter = path_delimiter
         self.hierarchy_key = hierarchy_key
+        self.root_directory = root_directory
+        self.metrics = None
 
     @property
     def current_step_number(self):
@@ -42,6 +56,15 @@ class Plan:
     def current_step_number(self, new_current_step_number):
         self._current_step_number = new_current_step_number
 
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, new_metrics: PlanMetrics):
+        """ Set to an instance of PlanMetrics to record per-step metrics when running (None to disable). """
+        self._metrics = new_metrics
+
     @property
     def max_step_number(self):
         return self.number_of_steps-1
@@ -58,15 +81,97 @@ class Plan:
         return sections
 
     def append_step(self, section_name: str, fqn: str, arguments: typing.Dict[typing.Any, typing.Any] = {},
-                    is_done: bool = False) -> None:
+                    is_done: bool = False, size_bytes: int = None) -> None:
         """ Append a step to the plan.
 
         :param section_name: section name to run next step from (will skip other sections in between)
         :param fqn: the fully qualified function name (package and class)
         :param arguments: arguments to the function
         :param is_done: flag for whether step is done
+        :param size_bytes: number of bytes the step transfers, if known
+        """
+        self.steps.append(Step(section_name, fqn, arguments, is_done, size_bytes))
+
+    def _append_upload_steps(self, upload_client, items: UploadItems, striper: WeightedStriper,
+                             compression: CompressionPolicy = None, staging_directory: str = None,
+                             compressed_files: typing.Dict[str, typing.Dict[str, typing.Any]] = None,
+                             deferred_registration: bool = False) -> None:
+        """ Append steps to upload items, striped across RSEs by striper with one step per RSE (so that transfers to
+        different RSEs can run in parallel).
+
+        If a compression policy is given, the files worth compressing are first compressed into the staging directory
+        (each in its own step, so they can be compressed in parallel) and uploaded from there. With deferred
+        registration, each step writes an upload summary (with the checksums of its files) to the staging directory.
+
+        :param upload_client: the upload client (usually deferred, see get_deferred_client)
+        :param items: the upload items, without an RSE
+        :param striper: the striper to assign the items to RSEs with
+        :param compression: the compression policy (no files are compressed if None)
+        :param staging_directory: the directory to write compressed files (and upload summaries) to
+        :param compressed_files: populated with a mapping of the DID name of each compressed file to its compression
+            algorithm and original size in bytes
+        :param deferred_registration: upload the files without registering them, so that they can be registered in
+            bulk afterwards (see _append_registration_steps)
         """
-        self.steps.append(Step(section_name, fqn, arguments, is_done))
+        sizes = {}
+        for idx in range(len(items)):
+            path = items.get_path(idx)
+            sizes[idx] = os.path.getsize(path)
+            ratio = compression.estimate_ratio(path, sizes[idx]) if compression else None
+            if ratio:
+                did_name = items.get_did_name(idx)
+                staged_path = os.path.join(staging_directory, did_name)
+                self.append_step("compress_files", fqn=compress_file, arguments={
+                    'src': path,
+                    'dst': staged_path,
+                    'algorithm': compression.algorithm,
+                    'level': compression.level
+                }, size_bytes=sizes[idx])
+                compressed_files[did_name] = {'algorithm': compression.algorithm, 'bytes': sizes[idx]}
+                items.set_path(idx, staged_path)
+                sizes[idx] = int(sizes[idx] / ratio)        # estimated, as it isn't compressed yet
+        for rse, idxs in striper.stripe(sizes).items():
+            selected = items.select(sorted(idxs), rse=rse)
+            if deferred_registration:
+                selected.defaults['no_register'] = True
+            for selected_idx, idx in enumerate(sorted(idxs)):      # sets the timeout of each file's transfer
+                selected.set_size(selected_idx, sizes[idx])
+            arguments = {'items': selected}
+            if deferred_registration:
+                arguments['summary_file_path'] = os.path.join(staging_directory, SUMMARY_DIRECTORY,
+                                                              'upload-{}.json'.format(len(self.steps)))
+            self.append_step("upload_files", fqn=upload_client.upload, arguments=arguments,
+                             size_bytes=sum(sizes[idx] for idx in idxs))
+
+    def _append_overwrite_step(self, root_container_name: str, selector: PathSelector) -> None:
+        """ Append a step to remove the local copy of a directory before it is downloaded again. For a download of a
+        subpath, only the subpath is removed. Downloads selecting files by glob can't overwrite, as the files they
+        don't select would be removed without being downloaded again.
+
+        :param root_container_name: the local directory
+        :param selector: the path selector of the download
+        """
+        if selector.include or selector.exclude:
+            raise ArgumentError("Can't overwrite an existing directory when selecting files to download with include "
+                                "or exclude globs, as the files not selected would be lost")
+        path = os.path.join(root_container_name, *selector.subpath.split('/')) if selector.subpath \
+            else root_container_name
+        self.append_step("overwrite_existing", fqn=shutil.rmtree, arguments={
+            'path': path
+        })
+
+    def _append_registration_steps(self) -> None:
+        """ Append steps to register the files uploaded (by the upload steps so far) without registering them, in
+        batches of files with the same RSE, scope and dataset. These must run before any staged files they were
+        uploaded from (or upload summaries) are removed.
+        """
+        uploads = ((step.arguments['items'], step.arguments.get('summary_file_path')) for step in self.steps
+                   if step.section_name == 'upload_files' and step.arguments['items'].defaults.get('no_register'))
+        for items, summary_file_paths in make_registration_batches(uploads):
+            self.append_step("register_files", fqn=register_files, arguments={
+                'items': items,
+                'summary_file_paths': summary_file_paths
+            })
 
     def clear(self) -> None:
         """ Clear the current plan. """
@@ -74,74 +179,118 @@ class Plan:
         self.steps = []
         self.current_step_number = 0
 
-    def describe(self) -> None:
-        """ Describe the current plan. """
+    def describe(self, full: bool = False, page: int = None, page_size: int = 100,
+                 bandwidth: float = 100 * 1024**2) -> None:
+        """ Describe the current plan.
+
+        :param full: list every step rather than summarising per section
+        :param page: only list this page of steps (starting at 1) in the full listing
+        :param page_size: number of steps per page in the full listing
+        :param bandwidth: bandwidth (bytes/s) to estimate the transfer time at in the summary
+        """
+        if full:
+            self._describe_steps(page, page_size)
+        else:
+            self._describe_summary(bandwidth)
+
+    def _describe_steps(self, page: int = None, page_size: int = 100) -> None:
         print()
         print("Plan Description")
         print("================")
         print()
-        for idx, step in enumerate(self.steps):
-            section_name, fqn, arguments, is_done = (step.section_name, step.fqn, step.arguments, step.is_done)
-            if not is_done:
-                if hasattr(step.fqn, '__self__'): # bound method
-                    print("{}: ({}) RUN bound method {}.{}.{} with parameters {}".format(
-                        idx, section_name, fqn.__self__.__class__.__name__, fqn.__name__, fqn.__module__, arguments))
-                else:
-                    print("{}: ({}) RUN function {}.{} with parameters {}".format(
-                        idx, section_name, fqn.__module__, fqn.__name__, arguments))
-            else:
-                if hasattr(step.fqn, '__self__'):  # bound method
-                    print("{}: ({}) RAN bound method {}.{}.{} with parameters {}".format(
-                        idx, section_name, fqn.__self__.__class__.__name__, fqn.__name__, fqn.__module__, arguments))
-                else:
-                    print("{}: ({}) RAN function {}.{} with parameters {}".format(
-                        idx, section_name, fqn.__module__, fqn.__name__, arguments))
+        first_idx, last_idx = 0, self.number_of_steps
+        if page is not None:
+            first_idx = (page - 1) * page_size
+            last_idx = min(first_idx + page_size, self.number_of_steps)
+            print("Page {} of {} (steps {}-{} of {})".format(
+                page, max(1, -(-self.number_of_steps // page_size)), first_idx, last_idx - 1, self.number_of_steps))
+            print()
+        for idx in range(first_idx, last_idx):
+            step = self.steps[idx]
+            print("{}: ({}) {} {} with parameters {}".format(
+                idx, step.section_name, 'RAN' if step.is_done else 'RUN', describe_fqn(step.fqn), step.arguments))
         print()
 
+    def _describe_summary(self, bandwidth: float = 100 * 1024**2) -> None:
+        self.print_summary(self.summarise(), bandwidth)
+
+    @staticmethod
+    def print_summary(summary: typing.Dict[str, typing.Any], bandwidth: float = 100 * 1024**2) -> None:
+        """ Print a summary made by summarise (or PlanStore.summarise).
+
+        :param summary: the summary
+        :param bandwidth: bandwidth (bytes/s) to estimate the transfer time at
+        """
+        print_summary(summary, bandwidth)
+
+    def summarise(self) -> typing.Dict[str, typing.Any]:
+        """ Summarise the current plan per section (in order of first appearance), without formatting any arguments.
+
+        :return: a dictionary with per section and total counts of steps, done steps, items, bytes, catalog calls
+            and transfers
+        """
+        return summarise_step_heads({
+            'section_name': step.section_name,
+            'is_done': step.is_done,
+            'size_bytes': step.size_bytes,
+            'n_items': step.n_items,
+            'operation_class': step.operation_class
+        } for step in self.steps)
+
     @classmethod
     def load(cls, path: str) -> None:
         """ Load plan from a hard copy.
 
         :param path: the path to load from
         """
+        if is_plan_store_path(path):
+            with PlanStore(path) as store:
+                return store.to_plan(cls)
         logging.info("Loading plan from file {}".format(path))
-        with open(path, 'r') as fi:
-            inputs = json.load(fi)
-        plan = cls(**inputs)
-        plan.current_step_number = inputs['current_step_number']
+        reader = PlanFileReader(path)
+        plan = cls(**reader.plan_attributes)
+        plan.current_step_number = reader.plan_attributes['current_step_number']
+        plan.root_directory = reader.plan_attributes.get('root_directory')
         function_classes_to_objects = {}        # avoid instantiating duplicate classes of same type
-        for step in inputs['steps']:
-            module = import_module(step['function_module_name'])
-            if step['function_class_name']:     # bound method
-                try:
-                    if step['function_class_name'] not in function_classes_to_objects:
-                        function_classes_to_objects[step['function_class_name']] = \
-                        getattr(module, step['function_class_name'])()
-                    function_class_instance = function_classes_to_objects[step['function_class_name']]
-                    fqn = getattr(function_class_instance, step['function_name'])
-                except AttributeError:          # bound method with no class, just module
-                    fqn = getattr(module, step['function_name'])
-            else:                               # unbound method (e.g. class)
-                fqn = getattr(module, step['function_name'])
-            plan.append_step(step['section_name'], fqn, arguments=step['arguments'], is_done=step['is_done'])
+        for step in reader.iter_step_descriptions():
+            plan.steps.append(Step.from_dict(step, function_classes_to_objects))
         return plan
 
-    def run(self, section_name: str =None, dry_run: bool = False) -> typing.List[typing.Any]:
+    def optimize(self, coalesce: bool = True, max_items_per_call: int = 1000) -> typing.Dict[str, int]:
+        """ Remove redundant steps that are still to run and group the rest by section and function (see
+        rucio_extended_client.api.optimize).
+
+        :param coalesce: coalesce catalog steps into bulk calls
+        :param max_items_per_call: the maximum number of items (DIDs or attachments) in a single coalesced call
+        :return: a report of the number of steps removed by each rule
+        """
+        return optimize_plan(self, coalesce=coalesce, max_items_per_call=max_items_per_call)
+
+    def run(self, section_name: str =None, dry_run: bool = False, optimize: bool = True) -> typing.List[typing.Any]:
         """ Run the entire plan.
 
         :param section_name: section name to run next step from (will skip other sections in between)
         :param dry_run: don't actually do anything, just print
+        :param optimize: optimize the plan first
         """
+        if optimize:
+            self.optimize()
         logging.info("Running plan")
         returns = []
         while True:
             try:
                 returns.append(self.run_next_step(section_name, dry_run))
+                if self.metrics is not None:
+                    self.metrics.report_if_due()
                 if self.current_step_number > self.max_step_number:
                     logging.info("Reached end of plan")
+                    if self.metrics is not None:
+                        self.metrics.report()
                     return
             except (Exception, KeyboardInterrupt) as e:
                 logging.critical("Encountered exception running step {}: {}".format(self.current_step_number, repr(e)))
+                if self.metrics is not None:
+                    self.metrics.report()
                 self.save("plan-dump.json")
                 exit()
         return returns
@@ -154,24 +303,35 @@ class Plan:
         """
         if section_name:
             for idx, step in enumerate(self.steps[self.current_step_number:]):
-                if step.section == section_name:
+                if step.section_name == section_name:
                     self.current_step_number += idx
                     break
+
+        # Skip steps that are already done (e.g. by AsyncPlanRunner, which doesn't run steps in plan order).
+        while self.current_step_number <= self.max_step_number and self.steps[self.current_step_number].is_done:
+            self.current_step_number += 1
+        if self.current_step_number > self.max_step_number:
+            return None
         current_step = self.steps[self.current_step_number]
 
         section_name, fqn, arguments, is_done = \
             (current_step.section_name, current_step.fqn, current_step.arguments, current_step.is_done)
-        if hasattr(fqn, '__self__'):  # bound method
-            logging.debug("{}: ({}) Running function {}.{}.{} with parameters {}".format(
-                self.current_step_number, section_name, fqn.__self__.__class__.__name__, fqn.__name__, fqn.__module__,
-                arguments))
-        else:
-            logging.debug("{}: ({}) Running function {}.{} with parameters {}".format(
-                self.current_step_number, section_name, fqn.__module__, fqn.__name__, arguments))
-        if not dry_run:
-            rtn = fqn(**arguments)
-        else:
+        if logging.getLogger().isEnabledFor(logging.DEBUG):     # avoid formatting large arguments needlessly
+            logging.debug("{}: ({}) Running {} with parameters {}".format(
+                self.current_step_number, section_name, describe_fqn(fqn), arguments))
+        if dry_run:
             rtn = None
+        elif self.metrics is None:
+            rtn = call_with_arguments(fqn, arguments)
+        else:
+            st = time.perf_counter()
+            try:
+                rtn = call_with_arguments(fqn, arguments)
+            except BaseException:
+                self.metrics.record(section_name, fqn.__name__, time.perf_counter() - st, current_step.size_bytes,
+                                    success=False)
+                raise
+            self.metrics.record(section_name, fqn.__name__, time.perf_counter() - st, current_step.size_bytes)
 
         self.steps[self.current_step_number].is_done = True
         self.current_step_number += 1
@@ -183,37 +343,19 @@ class Plan:
 
         :param path: the path to save to
         """
+        if is_plan_store_path(path):
+            PlanStore.from_plan(self, path).close()
+            return
         logging.info("Saving plan to file {}".format(path))
-        step_output = []
-        for step in self.steps:
-            section_name, fqn, arguments, is_done = (step.section_name, step.fqn, step.arguments, step.is_done)
-            if hasattr(fqn, '__self__'):  # bound method
-                step_output.append({
-                    'section_name': section_name,
-                    'function_name': fqn.__name__,
-                    'function_class_name': fqn.__self__.__class__.__name__,
-                    'function_module_name': fqn.__module__,
-                    'arguments': arguments,
-                    'is_done': is_done
-                })
-            else:
-                step_output.append({
-                    'section_name': section_name,
-                    'function_name': fqn.__name__,
-                    'function_class_name': None,
-                    'function_module_name': fqn.__module__,
-                    'arguments': arguments,
-                    'is_done': is_done
-                })
-        output = {
+        attributes = {
             'current_step_number': self.current_step_number,
             'path_delimiter': self.path_delimiter,
             'hierarchy_key': self.hierarchy_key,
             'root_suffix': self.root_suffix,
-            'steps': step_output
+            'root_directory': self.root_directory
         }
-        with open(path, 'w') as fi:
-            json.dump(output, fi, indent=2)
+        write_plan_file(path, attributes, self.summarise(), (
+            dict(step.to_dict(), n_items=step.n_items, operation_class=step.operation_class) for step in self.steps))
 
 
 class DownloadPlanMetadata(Plan):
@@ -223,10 +365,41 @@ class DownloadPlanMetadata(Plan):
         """
         super().__init__(hierarchy_key)
 
+    @staticmethod
+    def _select_paths(
+            root_container_name: str, file_paths_to_names: typing.Dict[str, str], dirs: typing.List[str],
+            selector: PathSelector) -> typing.Tuple[typing.Dict[str, str], typing.List[str]]:
+        """ Filter the files and directories in the hierarchy metadata down to those selected.
+
+        Directories are kept if they contain a selected file or are selected in their own right. Ancestors of kept
+        directories are also kept so that the hierarchy remains complete.
+
+        :param root_container_name: the name of the root container (the first segment of each path)
+        :param file_paths_to_names: mapping of file paths to DID names
+        :param dirs: list of directory paths
+        :param selector: the path selector
+        :return: a tuple of the filtered file_paths_to_names and dirs
+        """
+        def relative(path):
+            return path[len(root_container_name):].lstrip('/')
+
+        selected_file_paths_to_names = {
+            path: name for path, name in file_paths_to_names.items() if selector.is_file_selected(relative(path))}
+
+        selected_dirs = set(os.path.dirname(path) for path in selected_file_paths_to_names)
+        selected_dirs.update(dir for dir in dirs if selector.is_directory_selected(relative(dir)))
+        for dir in list(selected_dirs):
+            while relative(dir):
+                dir = os.path.dirname(dir)
+                selected_dirs.add(dir)
+        return selected_file_paths_to_names, [dir for dir in dirs if dir in selected_dirs]
+
     @classmethod
     def make_plan_from_did(
             cls, root_container_scope: str, root_container_name: str, hierarchy_key: str ='hierarchy',
-            metadata_plugin: str = 'json', clobber: bool = True, show_tree: bool = True) -> typing.Type[Plan]:
+            metadata_plugin: str = 'json', clobber: bool = True, show_tree: bool = True, subpath: str = None,
+            include: typing.List[str] = None, exclude: typing.List[str] = None, num_threads: int = 4,
+            batch_bytes: int = 1024**3, skip_existing: bool = False) -> typing.Type[Plan]:
         """ Makes a download plan given the DID of a root container and according to the rules of the UploadPlan.
 
         :param root_container_scope: the scope of the root container
@@ -235,10 +408,16 @@ class DownloadPlanMetadata(Plan):
         :param metadata_plugin: the Rucio metadata plugin to use
         :param clobber: overwrite existing directory if it exists
         :param show_tree: show the hierarchical tree when constructing the plan
+        :param subpath: only download paths at or below this path (relative to the root container)
+        :param include: only download files matching one of these globs (relative to the root container)
+        :param exclude: don't download paths matching any of these globs (relative to the root container)
+        :param num_threads: number of threads to download each batch of files with
+        :param batch_bytes: minimum number of bytes in a batch of files (smaller files are packed together)
+        :param skip_existing: only download files that are missing locally or don't match the catalogue
         :return: a populated instance of DownloadPlan
         """
-        did_client = DIDClient()
-        download_client = DownloadClient()
+        did_client = get_client('DIDClient')
+        download_client = get_deferred_client('DownloadClient')
 
         # Get metadata of root container
         metadata = did_client.get_metadata(
@@ -280,8 +459,33 @@ class DownloadPlanMetadata(Plan):
             logging.warning("Could not find a .files nested dataset attached to root container")
             exit()
 
+        # Filter files and directories, if requested.
+        selector = PathSelector(subpath=subpath, include=include, exclude=exclude)
+        if selector.is_selective:
+            file_paths_to_names, dirs = cls._select_paths(root_container_name, file_paths_to_names, dirs, selector)
+            logging.info("Selected {} files in {} directories".format(len(file_paths_to_names), len(dirs)))
+
+        # Get the file sizes and checksums in bulk from the .files dataset.
+        files_dataset_scope, files_dataset_name = did_files_dataset.split(':')
+        names_to_files = {
+            fi['name']: fi for fi in did_client.list_files(scope=files_dataset_scope, name=files_dataset_name)
+        }
+
+        # Skip files that already exist locally and match the catalogue, if requested (compressed files are compared
+        # by their original size only, as the catalogue checksum is of the compressed file).
+        compressed_files = metadata_hierarchy.get('compressed_files', {})
+        if skip_existing:
+            up_to_date = find_up_to_date_files({
+                path: (compressed_files[name]['bytes'], None) if name in compressed_files else
+                (names_to_files[name]['bytes'], names_to_files[name]['adler32'])
+                for path, name in file_paths_to_names.items() if name in names_to_files
+            })
+            file_paths_to_names = {
+                path: name for path, name in file_paths_to_names.items() if path not in up_to_date}
+
         # Create tree, if requested
         if show_tree:
+            from treelib import Tree
             tree = Tree()
 
             # Add directories as nodes first.
@@ -293,7 +497,7 @@ class DownloadPlanMetadata(Plan):
 
             # Then add files.
             for path, name in file_paths_to_names.items():
-                tree.create_node(path, path, parent=os.path.dirname(dir))
+                tree.create_node(path, path, parent=os.path.dirname(path))
 
             print()
             print("Tree")
@@ -304,32 +508,48 @@ class DownloadPlanMetadata(Plan):
         plan = cls(hierarchy_key)
 
         # Add clobber step if set.
-        if clobber:
-            plan.append_step("overwrite_existing", fqn=shutil.rmtree, arguments={
-                'path': root_container_name
-            })
+        if clobber and skip_existing:
+            logging.warning("Skipping existing files, existing directory will not be overwritten")
+        elif clobber:
+            plan._append_overwrite_step(root_container_name, selector)
 
         # Create these directories.
         for dir in dirs:
-            plan.append_step("create_directories", fqn=pathlib.Path(dir).mkdir, arguments={
-                'parents': True,
+            plan.append_step("create_directories", fqn=os.makedirs, arguments={
+                'name': dir,
                 'exist_ok': True
             })
 
-        # Download files and rename.
-        for path, name in file_paths_to_names.items():
+        paths_to_sizes = {
+            path: names_to_files[name]['bytes'] if name in names_to_files else None
+            for path, name in file_paths_to_names.items()
+        }
+
+        # Download files (in batches, largest first) and rename.
+        for batch in schedule_largest_first(paths_to_sizes, num_threads=num_threads, batch_bytes=batch_bytes):
             plan.append_step("download_files", fqn=download_client.download_dids, arguments={
                 'items': [{
-                    'did': '{}:{}'.format(root_container_scope, name),
+                    'did': '{}:{}'.format(root_container_scope, file_paths_to_names[path]),
                     'base_dir': os.path.dirname(path),
                     'no_subdir': True,
-                    'transfer_timeout': 3600
-                }],
-            })
-            plan.append_step("rename_files", fqn=os.rename, arguments={
-                'src': os.path.join(os.path.dirname(path), name),
-                'dst': os.path.join(path)
-            })
+                    'transfer_timeout': get_transfer_timeout(paths_to_sizes[path])
+                } for path in batch],
+                'num_threads': num_threads
+            }, size_bytes=sum(paths_to_sizes[path] or 0 for path in batch))
+            for path in batch:
+                name = file_paths_to_names[path]
+                if name in compressed_files:
+                    plan.append_step("rename_files", fqn=decompress_file, arguments={
+                        'src': os.path.join(os.path.dirname(path), name),
+                        'dst': os.path.join(path),
+                        'algorithm': compressed_files[name]['algorithm'],
+                        'n_bytes': compressed_files[name]['bytes']
+                    })
+                else:
+                    plan.append_step("rename_files", fqn=os.rename, arguments={
+                        'src': os.path.join(os.path.dirname(path), name),
+                        'dst': os.path.join(path)
+                    })
 
         return plan
 
@@ -341,20 +561,16 @@ class DownloadPlanNative(Plan):
         """
         super().__init__(root_suffix, path_delimiter)
 
-    def _add_steps_from_tree(
-            self, tree: typing.Type[Tree], collections: typing.List[typing.Dict[typing.Any, typing.Any]],
-            mock: bool = False) -> None:
-        """ Add plan steps from a graph.
+    def _paths_from_tree(
+            self, tree: 'Tree', collections: typing.List[typing.Dict[typing.Any, typing.Any]]) \
+            -> typing.Iterator[typing.Tuple[str, str, str, str]]:
+        """ Recover the physical paths of the leaves of a tree.
 
         :param tree: the tree of relationships between DIDs
         :param collections: a list of collections contained within the root container
-        :param mock: only use for pytests (doesn't instantiate clients)
+        :return: an iterator of tuples of (lfn, directory path, filename, path relative to the root container) for
+        each leaf, where lfn and filename are None if the leaf is a (empty) directory
         """
-        download_client = DownloadClient
-        if not mock:
-            download_client = download_client() # instantiate
-
-        did_items = []
         for logical_path_segments in tree.paths_to_leaves():
             # remove segments w/ root_suffix and strip scope
             physical_path_segments = [
@@ -367,49 +583,153 @@ class DownloadPlanNative(Plan):
                 desired_physical_path_segments.append(
                     segment_p1.replace('{}{}'.format(segment, self.path_delimiter), ""))
 
+            relative_path = '/'.join(desired_physical_path_segments[1:])
             is_dir = logical_path_segments[-1] in collections
             if is_dir:
-                lfn = None
-                path = os.path.join(*desired_physical_path_segments)
-                filename = None
+                yield None, os.path.join(*desired_physical_path_segments), None, relative_path
             else:
-                lfn = logical_path_segments[-1]
-                path = os.path.join(*desired_physical_path_segments[:-1])
-                filename = desired_physical_path_segments[-1]
+                yield (logical_path_segments[-1], os.path.join(*desired_physical_path_segments[:-1]),
+                       desired_physical_path_segments[-1], relative_path)
+
+    def _paths_from_manifest(self, manifest: typing.Dict[str, typing.Any], root_container_scope: str,
+                             root_container_name: str) -> typing.Iterator[typing.Tuple[str, str, str, str]]:
+        """ Recover the physical paths of the files and empty directories in a manifest recorded by UploadPlanNative,
+        as _paths_from_tree does from a tree.
+
+        :param manifest: the manifest
+        :param root_container_scope: the scope of the root container
+        :param root_container_name: the name of the root container
+        :return: an iterator of tuples of (lfn, directory path, filename, path relative to the root container) for
+        each file and empty directory, where lfn and filename are None if it is a directory
+        """
+        if manifest.get('version') != 1:
+            raise DataFormatError("Manifest version {} is not supported".format(manifest.get('version')))
+        non_empty_dirs = set()
+        for relative_path in itertools.chain(manifest['files'], manifest['dirs']):
+            if relative_path:
+                non_empty_dirs.add(os.path.dirname(relative_path))
+        for relative_path in manifest['dirs']:
+            if relative_path not in non_empty_dirs:
+                yield None, os.path.join(root_container_name, *relative_path.split('/')), None, relative_path
+        for relative_path, name in manifest['files'].items():
+            yield ('{}:{}'.format(root_container_scope, name),
+                   os.path.join(root_container_name, *os.path.dirname(relative_path).split('/')),
+                   os.path.basename(relative_path), relative_path)
+
+    def _add_steps_from_tree(
+            self, tree: 'Tree', collections: typing.List[typing.Dict[typing.Any, typing.Any]],
+            **kwargs) -> None:
+        """ Add plan steps from a graph (see _add_steps_from_paths for keyword arguments).
+
+        :param tree: the tree of relationships between DIDs
+        :param collections: a list of collections contained within the root container
+        """
+        self._add_steps_from_paths(self._paths_from_tree(tree, collections), **kwargs)
+
+    def _add_steps_from_paths(
+            self, paths: typing.Iterable[typing.Tuple[str, str, str, str]], mock: bool = False,
+            selector: PathSelector = None, file_sizes: typing.Dict[str, int] = None, num_threads: int = 4,
+            batch_bytes: int = 1024**3, file_checksums: typing.Dict[str, str] = None, skip_existing: bool = False,
+            compressed_files: typing.Dict[str, typing.Dict[str, typing.Any]] = None) -> None:
+        """ Add plan steps from the paths of files and empty directories.
+
+        If file sizes are given, downloads are batched and scheduled largest first, otherwise each file is downloaded
+        in its own step in the order the paths are given.
+
+        :param paths: tuples of (lfn, directory path, filename, relative path), as made by _paths_from_tree
+        :param mock: only use for pytests (no longer needed, as clients are only made when the plan is run)
+        :param selector: only add steps for paths selected by this selector
+        :param file_sizes: mapping of file DID to size in bytes
+        :param num_threads: number of threads to download each batch of files with
+        :param batch_bytes: minimum number of bytes in a batch of files (smaller files are packed together)
+        :param file_checksums: mapping of file DID to adler32 checksum
+        :param skip_existing: only download files that are missing locally or don't match the catalogue
+        :param compressed_files: mapping of the DID name of each compressed file to its compression algorithm and
+            original size in bytes (decompressed instead of renamed once downloaded)
+        """
+        compressed_files = compressed_files or {}
+        download_client = get_deferred_client('DownloadClient')
+
+        downloads = {}                      # lfn -> (path, filename)
+        for lfn, path, filename, relative_path in paths:
+            if selector:
+                if lfn is None and not selector.is_directory_selected(relative_path):
+                    continue
+                if lfn is not None and not selector.is_file_selected(relative_path):
+                    continue
 
             # create directories
-            self.append_step("create_directories", fqn=pathlib.Path(path).mkdir, arguments={
-                'parents': True,
+            self.append_step("create_directories", fqn=os.makedirs, arguments={
+                'name': path,
                 'exist_ok': True
             })
 
-            # download file and rename
             if lfn and filename:
-                self.append_step("download_files", fqn=download_client.download_dids, arguments={
-                    'items': [{
-                        'did': lfn,
-                        'base_dir': path,
-                        'no_subdir': True,
-                        'transfer_timeout': 3600
-                    }]
-                })
-                self.append_step("rename_files", fqn=os.rename, arguments={
-                    'src': os.path.join(path, lfn.split(':')[1]),
-                    'dst': os.path.join(path, filename)
-                })
+                downloads[lfn] = (path, filename)
+
+        # skip files that already exist locally and match the catalogue, if requested
+        if skip_existing:
+            paths_to_lfns = {os.path.join(path, filename): lfn for lfn, (path, filename) in downloads.items()}
+            up_to_date = find_up_to_date_files({
+                path: (compressed_files[lfn.split(':')[1]]['bytes'], None) if lfn.split(':')[1] in compressed_files
+                else ((file_sizes or {}).get(lfn), (file_checksums or {}).get(lfn))
+                for path, lfn in paths_to_lfns.items()
+            })
+            for path in up_to_date:
+                del downloads[paths_to_lfns[path]]
 
-    def _create_directed_graph(self, did_name: str, did_scope: str) \
+        # download files and rename
+        if file_sizes is not None:
+            sizes = {lfn: file_sizes.get(lfn) for lfn in downloads}
+            batches = schedule_largest_first(sizes, num_threads=num_threads, batch_bytes=batch_bytes)
+        else:
+            sizes = {}
+            batches = [[lfn] for lfn in downloads]
+        for batch in batches:
+            arguments = {
+                'items': [{
+                    'did': lfn,
+                    'base_dir': downloads[lfn][0],
+                    'no_subdir': True,
+                    'transfer_timeout': get_transfer_timeout(sizes.get(lfn))
+                } for lfn in batch]
+            }
+            if file_sizes is not None:
+                arguments['num_threads'] = num_threads
+            self.append_step("download_files", fqn=download_client.download_dids, arguments=arguments,
+                             size_bytes=sum(sizes.get(lfn) or 0 for lfn in batch) if sizes else None)
+            for lfn in batch:
+                path, filename = downloads[lfn]
+                name = lfn.split(':')[1]
+                if name in compressed_files:
+                    self.append_step("rename_files", fqn=decompress_file, arguments={
+                        'src': os.path.join(path, name),
+                        'dst': os.path.join(path, filename),
+                        'algorithm': compressed_files[name]['algorithm'],
+                        'n_bytes': compressed_files[name]['bytes']
+                    })
+                else:
+                    self.append_step("rename_files", fqn=os.rename, arguments={
+                        'src': os.path.join(path, name),
+                        'dst': os.path.join(path, filename)
+                    })
+
+    def _create_directed_graph(
+            self, did_name: str, did_scope: str, file_sizes: typing.Dict[str, int] = None,
+            file_checksums: typing.Dict[str, str] = None) \
             -> typing.Tuple[typing.Dict[str, str], typing.List[str], typing.List[typing.Dict[typing.Any, typing.Any]]]:
         """
         Create a directed graph representing the relationships between dids in a given container (did_scope:did_name).
 
         :param did_name: DID name
         :param did_scope: DID scope
+        :param file_sizes: if set, populated with a mapping of file DID to size in bytes
+        :param file_checksums: if set, populated with a mapping of file DID to adler32 checksum
         :return: a tuple consisting of the graph showing the relationships between dids, the roots of this graph and
         nested collections
         """
         # Create an instance of the rucio client & get a list of child containers and datasets.
-        did_client = DIDClient()
+        did_client = get_client('DIDClient')
         collections = did_client.list_dids(
             scope=did_scope,
             filters=[{
@@ -446,6 +766,10 @@ class DownloadPlanNative(Plan):
             for content in did_client.list_content(dataset_scope, dataset_name):
                 file_scope = content['scope']
                 file_name = content['name']
+                if file_sizes is not None:
+                    file_sizes['{}:{}'.format(file_scope, file_name)] = content.get('bytes')
+                if file_checksums is not None:
+                    file_checksums['{}:{}'.format(file_scope, file_name)] = content.get('adler32')
                 relationships.append(
                     ('{}:{}'.format(dataset_scope, dataset_name),
                      '{}:{}'.format(file_scope, file_name))
@@ -463,6 +787,68 @@ class DownloadPlanNative(Plan):
 
         return (graph, roots, datasets + containers)
 
+    def _create_pruned_directed_graph(
+            self, did_name: str, did_scope: str, selector: PathSelector, file_sizes: typing.Dict[str, int] = None,
+            file_checksums: typing.Dict[str, str] = None) \
+            -> typing.Tuple[typing.Dict[str, str], typing.List[str], typing.List[typing.Dict[typing.Any, typing.Any]]]:
+        """
+        Create a directed graph representing the relationships between dids in a given container (did_scope:did_name),
+        crawling top-down from the root container and pruning at collections that cannot contain selected paths.
+
+        Unlike _create_directed_graph, the contents of pruned collections are never listed.
+
+        :param did_name: DID name
+        :param did_scope: DID scope
+        :param selector: the path selector
+        :param file_sizes: if set, populated with a mapping of file DID to size in bytes
+        :param file_checksums: if set, populated with a mapping of file DID to adler32 checksum
+        :return: a tuple consisting of the graph showing the relationships between dids, the roots of this graph and
+        nested collections
+        """
+        did_client = get_client('DIDClient')
+
+        root_did = '{}:{}'.format(did_scope, did_name)
+        graph = {root_did: set()}
+        collections = [root_did]
+        to_visit = [(root_did, '')]         # (did, path of directory relative to root container)
+        while to_visit:
+            parent_did, parent_path = to_visit.pop()
+            parent_scope, parent_name = parent_did.split(':')
+
+            # children are named with respect to the directory name, i.e. the parent name without the root suffix
+            parent_dir_name = parent_name
+            if parent_name.endswith(self.root_suffix):
+                parent_dir_name = parent_name[:-len(self.root_suffix)]
+            for content in did_client.list_content(parent_scope, parent_name):
+                child_did = '{}:{}'.format(content['scope'], content['name'])
+                if 'FILE' in content['type']:
+                    graph[parent_did].add(child_did)
+                    graph[child_did] = set()
+                    if file_sizes is not None:
+                        file_sizes[child_did] = content.get('bytes')
+                    if file_checksums is not None:
+                        file_checksums[child_did] = content.get('adler32')
+                    continue
+                if content['name'].endswith(self.root_suffix):
+                    child_path = parent_path
+                else:
+                    child_path = '/'.join(filter(None, [
+                        parent_path, content['name'].replace('{}{}'.format(parent_dir_name, self.path_delimiter), '', 1)
+                    ]))
+                if 'DATASET' in content['type']:
+                    is_selected = selector.is_file_directory_selected(child_path)
+                else:
+                    is_selected = selector.is_collection_selected(child_path)
+                if not is_selected:
+                    logging.debug("Pruning collection {} ({})".format(child_did, child_path))
+                    continue
+                graph[parent_did].add(child_did)
+                graph[child_did] = set()
+                collections.append(child_did)
+                to_visit.append((child_did, child_path))
+
+        return (graph, [root_did], collections)
+
     def _traverse_graph(self, graph: typing.Dict[str, str], roots: typing.List[str]) -> typing.Dict[str, str]:
         """ Traverse a directed graph, creating a nested dictionary illustrating the relationships between elements.
 
@@ -478,7 +864,7 @@ class DownloadPlanNative(Plan):
 
         return traverse_graph_recursive({}, graph, roots)
 
-    def _make_tree_from_graph(self, graph: typing.Dict[str, str], roots: typing.List[str]) -> typing.Type[Tree]:
+    def _make_tree_from_graph(self, graph: typing.Dict[str, str], roots: typing.List[str]) -> 'Tree':
         """ Make a tree from a graph.
 
         :param graph: graph showing the relationships between dids
@@ -496,6 +882,7 @@ class DownloadPlanNative(Plan):
                     recurse_hierarchy(children, did, tree=tree)
             return tree
 
+        from treelib import Tree
         tree = Tree()
         return recurse_hierarchy(self._traverse_graph(graph, roots), '', tree=tree)
 
@@ -503,7 +890,9 @@ class DownloadPlanNative(Plan):
     def make_plan_from_did(
             cls, root_container_scope: str, root_container_name: str, hierarchy_key: str = 'hierarchy',
             fallback_root_suffix: str = '__root', fallback_path_delimiter: str ='.', metadata_plugin: str = 'json',
-            clobber: bool = True, show_tree: bool = True) -> typing.Type[Plan]:
+            clobber: bool = True, show_tree: bool = True, subpath: str = None, include: typing.List[str] = None,
+            exclude: typing.List[str] = None, num_threads: int = 4, batch_bytes: int = 1024**3,
+            skip_existing: bool = False) -> typing.Type[Plan]:
         """ Makes a download plan given the DID of a root container and according to the rules of the UploadPlan.
 
         :param root_container_scope: the scope of the root container
@@ -514,10 +903,15 @@ class DownloadPlanNative(Plan):
         :param metadata_plugin: the Rucio metadata plugin to use
         :param clobber: overwrite existing directory if it exists
         :param show_tree: show the hierarchical tree when constructing the plan
+        :param subpath: only download paths at or below this path (relative to the root container)
+        :param include: only download files matching one of these globs (relative to the root container)
+        :param exclude: don't download paths matching any of these globs (relative to the root container)
+        :param num_threads: number of threads to download each batch of files with
+        :param batch_bytes: minimum number of bytes in a batch of files (smaller files are packed together)
+        :param skip_existing: only download files that are missing locally or don't match the catalogue
         :return: a populated instance of DownloadPlan
         """
-        did_client = DIDClient
-        did_client = did_client()
+        did_client = get_client('DIDClient')
 
         # Get metadata of root container
         metadata = did_client.get_metadata(
@@ -554,21 +948,58 @@ class DownloadPlanNative(Plan):
         plan = cls(root_suffix, path_delimiter)
 
         # add clobber step if set
-        if clobber:
-            plan.append_step("overwrite_existing", fqn=shutil.rmtree, arguments={
-                'path': root_container_name
-            })
+        selector = PathSelector(subpath=subpath, include=include, exclude=exclude)
+        if clobber and skip_existing:
+            logging.warning("Skipping existing files, existing directory will not be overwritten")
+        elif clobber:
+            plan._append_overwrite_step(root_container_name, selector)
 
         try:
-            graph, roots, collections = plan._create_directed_graph(root_container_name, root_container_scope)
-            tree = plan._make_tree_from_graph(graph, roots)
+            file_sizes = {}
+            file_checksums = {}
+            if 'manifest' in metadata_hierarchy:
+                # plan from the manifest recorded on upload rather than crawling the hierarchy
+                logging.info("manifest found in metadata, planning from it")
+                did_client = get_client('DIDClient')
+                for fi in did_client.list_files(scope=root_container_scope, name=root_container_name):
+                    lfn = '{}:{}'.format(fi['scope'], fi['name'])
+                    file_sizes[lfn] = fi['bytes']
+                    file_checksums[lfn] = fi['adler32']
+                paths = list(plan._paths_from_manifest(
+                    metadata_hierarchy['manifest'], root_container_scope, root_container_name))
+                if show_tree:
+                    from treelib import Tree
+                    tree = Tree()
+                    tree.create_node(root_container_name, '')
+                    for relative_path in sorted(metadata_hierarchy['manifest']['dirs']):
+                        if relative_path:
+                            tree.create_node(os.path.basename(relative_path), relative_path,
+                                             parent=os.path.dirname(relative_path))
+                    for _, _, filename, relative_path in paths:
+                        if filename is not None:
+                            tree.create_node(filename, relative_path, parent=os.path.dirname(relative_path))
+            else:
+                logging.warning("manifest not in container metadata, crawling the hierarchy")
+                if selector.is_selective:
+                    graph, roots, collections = plan._create_pruned_directed_graph(
+                        root_container_name, root_container_scope, selector, file_sizes=file_sizes,
+                        file_checksums=file_checksums)
+                else:
+                    graph, roots, collections = plan._create_directed_graph(
+                        root_container_name, root_container_scope, file_sizes=file_sizes,
+                        file_checksums=file_checksums)
+                tree = plan._make_tree_from_graph(graph, roots)
+                paths = plan._paths_from_tree(tree, collections)
             if show_tree:
                 print()
                 print("Tree")
                 print("====")
                 print()
                 tree.show()
-            plan._add_steps_from_tree(tree, collections)
+            plan._add_steps_from_paths(paths, selector=selector if selector.is_selective else None,
+                                       file_sizes=file_sizes, num_threads=num_threads, batch_bytes=batch_bytes,
+                                       file_checksums=file_checksums, skip_existing=skip_existing,
+                                       compressed_files=metadata_hierarchy.get('compressed_files'))
         except Exception as e:
             logging.critical("Encountered exception: {}".format(repr(e)))
             exit()
@@ -584,8 +1015,11 @@ class UploadPlanMetadata(Plan):
 
     @classmethod
     def make_plan_from_directory(
-            cls, root_directory: str, root_container_name: str, rse: str, scope: str, lifetime: int,
-            hierarchy_key: str = 'hierarchy', mock: bool = False, do_checksum: bool = True) -> typing.Type[Plan]:
+            cls, root_directory: str, root_container_name: str, rse: typing.Union[str, typing.Dict[str, float]],
+            scope: str, lifetime: int, hierarchy_key: str = 'hierarchy', mock: bool = False, do_checksum: bool = True,
+            consolidate_rse: str = None, compression: CompressionPolicy = None,
+            dir_checksum_algorithm: str = DEFAULT_DIR_CHECKSUM_ALGORITHM,
+            deferred_registration: bool = False) -> typing.Type[Plan]:
         """
         Makes a new plan with steps created according to the following rules:
 
@@ -598,24 +1032,41 @@ class UploadPlanMetadata(Plan):
 
         :param root_directory: the directory to upload
         :param root_container_name: the name to use for the root container
-        :param rse: the RSE to upload to
+        :param rse: the RSE to upload to, or a mapping of RSE to weight to stripe uploads across several RSEs
         :param scope: the scope to use for uploaded content
         :param lifetime: the lifetime of uploaded content
         :param hierarchy_key: metadata key holding description of how did fits into hierarchy
-        :param mock: only use for pytests (doesn't instantiate clients)
+        :param mock: only use for pytests (no longer needed, as clients are only made when the plan is run)
         :param do_checksum: do directory checksum
+        :param consolidate_rse: RSE expression for the root container rule, to consolidate the upload onto (the
+            RSEs uploaded to if not set)
+        :param compression: the policy for compressing files before uploading them (not compressed if None)
+        :param dir_checksum_algorithm: the hashlib algorithm to calculate the directory checksum with (recorded with
+            it, see DIR_CHECKSUM_ALGORITHMS)
+        :param deferred_registration: upload every file before registering any, then add their replicas and attach
+            them to their datasets in bulk
         :return: a populated instance of UploadPlan
         """
         st = time.time()
         plan = cls(hierarchy_key)
 
-        upload_client = UploadClient
-        did_client = DIDClient
-        rule_client = RuleClient
-        if not mock:                         # instantiate
-            upload_client = upload_client()
-            did_client = did_client()
-            rule_client = rule_client()
+        upload_client = get_deferred_client('UploadClient')
+        did_client = get_deferred_client('DIDClient')
+        rule_client = get_deferred_client('RuleClient')
+        striper = WeightedStriper(rse if isinstance(rse, dict) else {rse: 1})
+        rule_arguments = {
+            'copies': 1,
+            'rse_expression': consolidate_rse or '|'.join(striper.weights),
+            'lifetime': lifetime
+        }
+        if not consolidate_rse and len(striper.weights) > 1:
+            # keep each striped file where it was uploaded, rather than Rucio moving each dataset onto one of the RSEs
+            rule_arguments['grouping'] = 'NONE'
+        compressed_files = {}
+        staging_directory = None
+        if compression or deferred_registration:
+            staging_directory = os.path.join(
+                compression.staging_directory if compression else DEFAULT_STAGING_DIRECTORY, scope, root_container_name)
         try:
             # Create a root container to hold files dataset.
             logging.debug("Will create container {}".format(root_container_name))
@@ -658,7 +1109,12 @@ class UploadPlanMetadata(Plan):
 
                     # Upload files and add to this dataset.
                     logging.debug("  Will add the following files to the {} dataset:".format(files_dataset_name))
-                    items = []
+                    items = UploadItems(defaults={
+                        'did_scope': scope,
+                        'dataset_scope': scope,
+                        'dataset_name': files_dataset_name,
+                        'register_after_upload': True
+                    })
                     for fi in files:
                         path = '/'.join([root_container_name] + \
                             os.path.join(root, fi).split(os.sep)[len(root_directory.split(os.sep)):])
@@ -666,27 +1122,18 @@ class UploadPlanMetadata(Plan):
                         logging.debug("  - {} as {}".format(os.path.join(root, fi), name))
                         items.append({
                             'path': os.path.join(root, fi),
-                            'rse': rse,
-                            'did_scope': scope,
-                            'did_name': name,
-                            'dataset_scope': scope,
-                            'dataset_name': files_dataset_name,
-                            'register_after_upload': True
+                            'did_name': name
                         })
                         file_paths_to_names[path] = name
                         n_files+=1
-                    plan.append_step("upload_files", fqn=upload_client.upload, arguments={
-                        'items': items
-                    })
+                    plan._append_upload_steps(upload_client, items, striper, compression, staging_directory,
+                                              compressed_files, deferred_registration)
 
                 if idx == 0:
                     # Add a rule to root container only.
-                    plan.append_step("add_root_container_rule", fqn=rule_client.add_replication_rule, arguments={
-                        'dids': [{'scope': scope, 'name': root_container_name}],
-                        'copies': 1,
-                        'rse_expression': rse,
-                        'lifetime': lifetime
-                    })
+                    plan.append_step("add_root_container_rule", fqn=rule_client.add_replication_rule, arguments=dict({
+                        'dids': [{'scope': scope, 'name': root_container_name}]
+                    }, **rule_arguments))
 
                 # Add this directory to the dir_paths set
                 path = '/'.join([root_container_name] + root.split(os.sep)[len(root_directory.split(os.sep)):])
@@ -694,23 +1141,38 @@ class UploadPlanMetadata(Plan):
 
                 n_dirs += 1
 
+            # Register files uploaded without registering them, in bulk.
+            if deferred_registration:
+                plan._append_registration_steps()
+
+            # Remove compressed files (and upload summaries) once uploaded.
+            if compressed_files or deferred_registration:
+                plan.append_step("remove_staged_files", fqn=shutil.rmtree, arguments={
+                    'path': staging_directory,
+                    'ignore_errors': True
+                })
+
             # Add metadata to root container.
             dir_checksum = None
             if do_checksum:
-                dir_checksum = dirhash(root_directory, algorithm='md5', empty_dirs=True)
+                dir_checksum = calculate_dir_checksum(root_directory, algorithm=dir_checksum_algorithm)
+            metadata_hierarchy = {
+                'upload_class': cls.__name__,
+                'dir_checksum': dir_checksum,
+                'dir_checksum_algorithm': dir_checksum_algorithm,
+                'n_files': n_files,
+                'n_dirs': n_dirs,
+                'files_dataset_name': files_dataset_name,
+                'file_paths_to_names': file_paths_to_names,
+                'dirs': list(dir_paths)
+            }
+            if compressed_files:
+                metadata_hierarchy['compressed_files'] = compressed_files
             plan.append_step("add_metadata", fqn=did_client.set_metadata_bulk, arguments={
                 'scope': scope,
                 'name': root_container_name,
                 'meta': {
-                    hierarchy_key: {
-                        'upload_class': cls.__name__,
-                        'dir_checksum': dir_checksum,
-                        'n_files': n_files,
-                        'n_dirs': n_dirs,
-                        'files_dataset_name': files_dataset_name,
-                        'file_paths_to_names': file_paths_to_names,
-                        'dirs': list(dir_paths)
-                    }
+                    hierarchy_key: metadata_hierarchy
                 }
             })
         except Exception as e:
@@ -728,9 +1190,12 @@ class UploadPlanNative(Plan):
 
     @classmethod
     def make_plan_from_directory(
-            cls, root_directory: str, root_container_name: str, rse: str, scope: str, lifetime: int, hierarchy_key: str
-            = 'hierarchy', root_suffix: str = '__root', path_delimiter: str = '.', mock: bool = False,
-            do_checksum: bool = True) -> typing.Type[Plan]:
+            cls, root_directory: str, root_container_name: str, rse: typing.Union[str, typing.Dict[str, float]],
+            scope: str, lifetime: int, hierarchy_key: str = 'hierarchy', root_suffix: str = '__root',
+            path_delimiter: str = '.', mock: bool = False, do_checksum: bool = True,
+            consolidate_rse: str = None, compression: CompressionPolicy = None,
+            record_manifest: bool = True, dir_checksum_algorithm: str = DEFAULT_DIR_CHECKSUM_ALGORITHM,
+            deferred_registration: bool = False) -> typing.Type[Plan]:
         """
 
         Makes a new plan with steps created according to the following rules:
@@ -742,26 +1207,46 @@ class UploadPlanNative(Plan):
 
         :param root_directory: the directory to upload
         :param root_container_name: the name to use for the root container
-        :param rse: the RSE to upload to
+        :param rse: the RSE to upload to, or a mapping of RSE to weight to stripe uploads across several RSEs
         :param scope: the scope to use for uploaded content
         :param lifetime: the lifetime of uploaded content
         :param hierarchy_key: metadata key holding description of how did fits into hierarchy
         :param root_suffix: suffix to define that the file belongs to the base directory
         :param path_delimiter: delimiter used to separate directories and files
-        :param mock: only use for pytests (doesn't instantiate clients)
+        :param mock: only use for pytests (no longer needed, as clients are only made when the plan is run)
         :param do_checksum: do directory checksum
+        :param consolidate_rse: RSE expression for the root container rule, to consolidate the upload onto (the
+            RSEs uploaded to if not set)
+        :param compression: the policy for compressing files before uploading them (not compressed if None)
+        :param record_manifest: record a manifest of the relative paths of files and directories and their DID names
+            in the metadata, so downloads don't need to crawl the hierarchy
+        :param dir_checksum_algorithm: the hashlib algorithm to calculate the directory checksum with (recorded with
+            it, see DIR_CHECKSUM_ALGORITHMS)
+        :param deferred_registration: upload every file before registering any, then add their replicas and attach
+            them to their datasets in bulk
         :return: a populated instance of UploadPlan
         """
         st = time.time()
         plan = cls(root_suffix, path_delimiter)
 
-        upload_client = UploadClient
-        did_client = DIDClient
-        rule_client = RuleClient
-        if not mock:                         # instantiate
-            upload_client = upload_client()
-            did_client = did_client()
-            rule_client = rule_client()
+        upload_client = get_deferred_client('UploadClient')
+        did_client = get_deferred_client('DIDClient')
+        rule_client = get_deferred_client('RuleClient')
+        striper = WeightedStriper(rse if isinstance(rse, dict) else {rse: 1})
+        rule_arguments = {
+            'copies': 1,
+            'rse_expression': consolidate_rse or '|'.join(striper.weights),
+            'lifetime': lifetime
+        }
+        if not consolidate_rse and len(striper.weights) > 1:
+            # keep each striped file where it was uploaded, rather than Rucio moving each dataset onto one of the RSEs
+            rule_arguments['grouping'] = 'NONE'
+        compressed_files = {}
+        staging_directory = None
+        if compression or deferred_registration:
+            staging_directory = os.path.join(
+                compression.staging_directory if compression else DEFAULT_STAGING_DIRECTORY, scope, root_container_name)
+        manifest = {'version': 1, 'dirs': {}, 'files': {}}    # relative path -> [name, type] (dirs) or name (files)
         try:
             for idx, (root, dirs, files) in enumerate(os.walk(root_directory, topdown=True)):
                 logging.debug("Considering directory {}".format(root))
@@ -771,6 +1256,15 @@ class UploadPlanNative(Plan):
                     if root_suffix in fi:
                         raise DataFormatError("File ({}) contains root suffix ({})".format(
                             os.path.join(root, fi), root_suffix))
+
+                # Record the directory and its files in the manifest.
+                relative_segments = root.split(os.sep)[len(root_directory.split(os.sep)):]
+                collection_name = path_delimiter.join([root_container_name] + relative_segments)
+                manifest['dirs']['/'.join(relative_segments)] = [
+                    collection_name, 'DATASET' if files and not dirs else 'CONTAINER']
+                for fi in files:
+                    manifest['files']['/'.join(relative_segments + [fi])] = path_delimiter.join([collection_name, fi])
+
                 parent_container_name = path_delimiter.join(
                     ([root_container_name] + root.split(os.sep)[len(root_directory.split(os.sep)):])[:-1])
                 if files:
@@ -834,23 +1328,22 @@ class UploadPlanNative(Plan):
 
                         # Upload files and add to this dataset.
                         logging.debug("  Will add the following files to the {} dataset:".format(dataset_name))
-                        items = []
+                        items = UploadItems(defaults={
+                            'did_scope': scope,
+                            'dataset_scope': scope,
+                            'dataset_name': dataset_name,
+                            'register_after_upload': True
+                        })
                         for fi in files:
                             name = path_delimiter.join([root_container_name] + \
                                 os.path.join(root, fi).split(os.sep)[len(root_directory.split(os.sep)):])
                             logging.debug("  - {} as {}".format(os.path.join(root, fi), name))
                             items.append({
                                 'path': os.path.join(root, fi),
-                                'rse': rse,
-                                'did_scope': scope,
-                                'did_name': name,
-                                'dataset_scope': scope,
-                                'dataset_name': dataset_name,
-                                'register_after_upload': True
+                                'did_name': name
                             })
-                        plan.append_step("upload_files", fqn=upload_client.upload, arguments={
-                            'items': items
-                        })
+                        plan._append_upload_steps(upload_client, items, striper, compression, staging_directory,
+                                                  compressed_files, deferred_registration)
                     else:
                         logging.debug("This directory contains only files")
 
@@ -884,23 +1377,22 @@ class UploadPlanNative(Plan):
 
                         logging.debug(
                             "  Will add the following files to the {} dataset:".format(dataset_name))
-                        items = []
+                        items = UploadItems(defaults={
+                            'did_scope': scope,
+                            'dataset_scope': scope,
+                            'dataset_name': dataset_name,
+                            'register_after_upload': True
+                        })
                         for fi in files:
                             name = path_delimiter.join([root_container_name] + \
                                 os.path.join(root, fi).split(os.sep)[len(root_directory.split(os.sep)):])
                             logging.debug("  - {} as {}".format(os.path.join(root, fi), name))
                             items.append({
                                 'path': os.path.join(root, fi),
-                                'rse': rse,
-                                'did_scope': scope,
-                                'did_name': name,
-                                'dataset_scope': scope,
-                                'dataset_name': dataset_name,
-                                'register_after_upload': True
+                                'did_name': name
                             })
-                        plan.append_step("upload_files", fqn=upload_client.upload, arguments={
-                            'items': items
-                        })
+                        plan._append_upload_steps(upload_client, items, striper, compression, staging_directory,
+                                                  compressed_files, deferred_registration)
                 else:
                     if dirs:
                         logging.debug("This directory contains only directories")
@@ -967,27 +1459,41 @@ class UploadPlanNative(Plan):
 
                 if idx == 0:
                     # Add a rule to root container only.
-                    plan.append_step("add_root_container_rule", fqn=rule_client.add_replication_rule, arguments={
-                        'dids': [{'scope': scope, 'name': root_container_name}],
-                        'copies': 1,
-                        'rse_expression': rse,
-                        'lifetime': lifetime
-                    })
+                    plan.append_step("add_root_container_rule", fqn=rule_client.add_replication_rule, arguments=dict({
+                        'dids': [{'scope': scope, 'name': root_container_name}]
+                    }, **rule_arguments))
+
+            # Register files uploaded without registering them, in bulk.
+            if deferred_registration:
+                plan._append_registration_steps()
+
+            # Remove compressed files (and upload summaries) once uploaded.
+            if compressed_files or deferred_registration:
+                plan.append_step("remove_staged_files", fqn=shutil.rmtree, arguments={
+                    'path': staging_directory,
+                    'ignore_errors': True
+                })
 
             # Add metadata to root container.
             dir_checksum = None
             if do_checksum:
-                dir_checksum = dirhash(root_directory, algorithm='md5', empty_dirs=True)
+                dir_checksum = calculate_dir_checksum(root_directory, algorithm=dir_checksum_algorithm)
+            metadata_hierarchy = {
+                'upload_class': cls.__name__,
+                'dir_checksum': dir_checksum,
+                'dir_checksum_algorithm': dir_checksum_algorithm,
+                'root_suffix': root_suffix,
+                'path_delimiter': path_delimiter
+            }
+            if record_manifest:
+                metadata_hierarchy['manifest'] = manifest
+            if compressed_files:
+                metadata_hierarchy['compressed_files'] = compressed_files
             plan.append_step("add_metadata", fqn=did_client.set_metadata_bulk, arguments={
                 'scope': scope,
                 'name': root_container_name,
                 'meta': {
-                    hierarchy_key: {
-                        'upload_class': cls.__name__,
-                        'dir_checksum': dir_checksum,
-                        'root_suffix': root_suffix,
-                        'path_delimiter': path_delimiter
-                    }
+                    hierarchy_key: metadata_hierarchy
                 }
             })
         except Exception as e:
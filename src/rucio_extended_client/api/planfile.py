@@ -0,0 +1,212 @@
+import json
+import logging
+import os
+import re
+import typing
+
+from rucio_extended_client.api.items import decode_arguments
+from rucio_extended_client.api.step import count_items, get_operation_class_from_names
+
+# The layout a JSON plan is saved in. The plan is still a single JSON document, but its first line holds everything but
+# the steps (including a summary), and each step is on a line of its own with its small fields before its arguments.
+# A saved plan can then be summarised from its first line, and its steps filtered a line at a time without parsing
+# their arguments (or importing Rucio to build their functions).
+FORMAT_VERSION = 2
+STEPS_OPENING = '"steps": ['
+STEPS_CLOSING = ']}'
+ARGUMENTS_KEY = ', "arguments": '
+
+# the fields of a step written before its arguments
+HEAD_FIELDS = ('section_name', 'is_done', 'size_bytes', 'n_items', 'operation_class', 'function_name',
+               'function_class_name', 'function_module_name')
+
+
+def _empty_summary_section() -> typing.Dict[str, int]:
+    return {'n_steps': 0, 'n_done': 0, 'n_items': 0, 'bytes': 0, 'bytes_done': 0, 'n_catalog_calls': 0,
+            'n_transfers': 0}
+
+
+def summarise_step_heads(heads: typing.Iterable[typing.Dict[str, typing.Any]]) -> typing.Dict[str, typing.Any]:
+    """ Summarise steps per section (in order of first appearance), as Plan.summarise does.
+
+    :param heads: the heads of the steps (see HEAD_FIELDS)
+    :return: a dictionary with per section and total counts of steps, done steps, items, bytes, catalog calls
+        and transfers
+    """
+    sections = {}
+    total = _empty_summary_section()
+    for head in heads:
+        if head['section_name'] not in sections:
+            sections[head['section_name']] = _empty_summary_section()
+        size_bytes = head['size_bytes'] or 0
+        for section in (sections[head['section_name']], total):
+            section['n_steps'] += 1
+            section['n_items'] += head['n_items']
+            section['bytes'] += size_bytes
+            if head['is_done']:
+                section['n_done'] += 1
+                section['bytes_done'] += size_bytes
+            if head['operation_class'] == 'catalog':
+                section['n_catalog_calls'] += 1
+            elif head['operation_class'] == 'transfer':
+                section['n_transfers'] += head['n_items']
+    return {'sections': sections, 'total': total}
+
+
+def print_summary(summary: typing.Dict[str, typing.Any], bandwidth: float = 100 * 1024**2) -> None:
+    """ Print a summary made by Plan.summarise (or PlanStore.summarise, or read from a saved plan).
+
+    :param summary: the summary
+    :param bandwidth: bandwidth (bytes/s) to estimate the transfer time at
+    """
+    row_format = "{:<32}{:>10}{:>10}{:>10}{:>16}{:>10}{:>10}"
+    print()
+    print("Plan Summary")
+    print("============")
+    print()
+    print(row_format.format('section', 'steps', 'done', 'items', 'bytes', 'catalog', 'transfers'))
+    for section_name, section in list(summary['sections'].items()) + [('total', summary['total'])]:
+        print(row_format.format(section_name, section['n_steps'], section['n_done'], section['n_items'],
+                                section['bytes'], section['n_catalog_calls'], section['n_transfers']))
+    print()
+    pending_bytes = summary['total']['bytes'] - summary['total']['bytes_done']
+    print("{} steps pending ({} bytes), estimated transfer time at {:.1f} MiB/s: {:.0f}s".format(
+        summary['total']['n_steps'] - summary['total']['n_done'], pending_bytes, bandwidth / 1024**2,
+        pending_bytes / bandwidth))
+    print()
+
+
+def _make_step_line(description: typing.Dict[str, typing.Any]) -> str:
+    """ Get the line of a step from its description (as made by Step.to_dict, with n_items and operation_class). """
+    head = {field: description[field] for field in HEAD_FIELDS}
+    return json.dumps(head)[:-1] + ARGUMENTS_KEY + json.dumps(description['arguments']) + '}'
+
+
+def _write_lines(path: str, attributes: typing.Dict[str, typing.Any], summary: typing.Dict[str, typing.Any],
+                 lines: typing.Iterable[str]) -> None:
+    header = dict(attributes, format_version=FORMAT_VERSION, summary=summary)
+    with open(path + '.part', 'w') as fi:
+        fi.write(json.dumps(header)[:-1] + ', ' + STEPS_OPENING)
+        for idx, line in enumerate(lines):
+            fi.write((',\n' if idx else '\n') + line)       # no blank line if there are no steps
+        fi.write('\n' + STEPS_CLOSING + '\n')
+    os.replace(path + '.part', path)
+
+
+def write_plan_file(path: str, attributes: typing.Dict[str, typing.Any], summary: typing.Dict[str, typing.Any],
+                    descriptions: typing.Iterable[typing.Dict[str, typing.Any]]) -> None:
+    """ Write a plan, a step per line. The plan only appears at path once it is complete.
+
+    :param path: the path to write to
+    :param attributes: the attributes of the plan (current_step_number, path_delimiter, ...)
+    :param summary: the summary of the plan, as made by Plan.summarise
+    :param descriptions: the descriptions of the steps, as made by Step.to_dict with n_items and operation_class added
+    """
+    _write_lines(path, attributes, summary, (_make_step_line(description) for description in descriptions))
+
+
+class PlanFileReader:
+    """ Reads a saved JSON plan a step at a time, without building the steps' functions.
+
+    Plans saved before the step per line layout are read whole, which is much slower for large plans.
+    """
+    def __init__(self, path: str):
+        """
+        :param path: the path of the saved plan
+        """
+        self.path = path
+        with open(path, 'r') as fi:
+            first_line = fi.readline().rstrip('\n')
+        self.is_streamable = first_line.endswith(STEPS_OPENING)
+        if self.is_streamable:
+            self.attributes = json.loads(first_line[:-len(STEPS_OPENING)].rstrip().rstrip(',') + '}')
+        else:
+            logging.warning("Plan {} wasn't saved a step per line, so is read whole".format(path))
+            with open(path, 'r') as fi:
+                self.attributes = json.load(fi)
+            self._descriptions = self.attributes.pop('steps')
+
+    @property
+    def plan_attributes(self) -> typing.Dict[str, typing.Any]:
+        """ The attributes of the plan (current_step_number, path_delimiter, ...), without those of the file. """
+        return {key: value for key, value in self.attributes.items() if key not in ('format_version', 'summary')}
+
+    @property
+    def summary(self) -> typing.Dict[str, typing.Any]:
+        """ The summary of the plan, as made by Plan.summarise. """
+        if 'summary' in self.attributes:
+            return self.attributes['summary']
+        return summarise_step_heads(head for _, head, _ in self.iter_steps())
+
+    def iter_steps(self, section_name: str = None, is_done: bool = None, pattern: str = None) \
+            -> typing.Iterator[typing.Tuple[int, typing.Dict[str, typing.Any], bytes]]:
+        """ Iterate over the steps of the plan, without parsing their arguments.
+
+        :param section_name: only steps in this section
+        :param is_done: only steps that are done (True) or not (False)
+        :param pattern: only steps whose JSON description matches this regular expression
+        :return: an iterator of tuples of (step number, the step's head, the step's line of JSON, UTF-8 encoded)
+        """
+        regex = re.compile(pattern.encode()) if pattern else None
+        # The head of each step is written in the same way, so steps can be filtered by its (undecoded) text before
+        # parsing it.
+        section_prefix = '{{"section_name": {}, '.format(json.dumps(section_name)).encode() \
+            if section_name is not None else b''
+        is_done_text = ', "is_done": {}, '.format(json.dumps(is_done)).encode() if is_done is not None else b''
+        arguments_key = ARGUMENTS_KEY.encode()
+        for step_number, line in self._iter_lines():
+            head_text = line[:line.find(arguments_key)]
+            if not head_text.startswith(section_prefix) or is_done_text not in head_text:
+                continue
+            if regex and not regex.search(line):
+                continue
+            yield step_number, json.loads(head_text + b'}'), line
+
+    def iter_step_descriptions(self) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        """ Iterate over the descriptions of the steps of the plan, as made by Step.to_dict. """
+        if not self.is_streamable:
+            yield from self._descriptions
+            return
+        for _, line in self._iter_lines():
+            yield json.loads(line)
+
+    def _iter_lines(self) -> typing.Iterator[typing.Tuple[int, bytes]]:
+        """ Iterate over the (UTF-8 encoded) lines of the steps, which are only decoded if needed. """
+        if not self.is_streamable:
+            for step_number, description in enumerate(self._descriptions):
+                description = dict(description, n_items=count_items(decode_arguments(description['arguments'])),
+                                   operation_class=get_operation_class_from_names(
+                                       description['function_name'], description['function_class_name']))
+                yield step_number, _make_step_line(description).encode()
+            return
+        with open(self.path, 'rb') as fi:
+            fi.readline()
+            for step_number, line in enumerate(fi):
+                line = line.rstrip(b'\n')
+                if line == STEPS_CLOSING.encode():
+                    return
+                yield step_number, line.rstrip(b',')
+
+
+def compact_plan_file(path: str, output_path: str = None) -> int:
+    """ Drop the steps of a saved plan that are done, or were skipped (those before its current step), so that it is
+    quicker to load and resume.
+
+    :param path: the path of the saved plan
+    :param output_path: the path to write the compacted plan to (path, if not set)
+    :return: the number of steps dropped
+    """
+    reader = PlanFileReader(path)
+    current_step_number = reader.plan_attributes.get('current_step_number') or 0
+    heads = []
+    n_dropped = 0
+    for step_number, head, _ in reader.iter_steps():
+        if head['is_done'] or step_number < current_step_number:
+            n_dropped += 1
+        else:
+            heads.append(head)
+
+    _write_lines(output_path or path, dict(reader.plan_attributes, current_step_number=0), summarise_step_heads(heads),
+                 (line.decode() for step_number, _, line in reader.iter_steps(is_done=False)
+                  if step_number >= current_step_number))
+    return n_dropped
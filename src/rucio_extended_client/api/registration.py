@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import typing
+
+from rucio_extended_client.api.clients import get_client
+from rucio_extended_client.api.items import EXPAND_CHUNK_ITEMS, UploadItems, get_chunk_summary_path
+from rucio_extended_client.common.checksum import file_checksums
+
+# The maximum number of files registered by a registration step. Each step registers its files in bulk calls of
+# EXPAND_CHUNK_ITEMS files (see UploadItems.iter_chunks), so there are far fewer steps than upload steps.
+REGISTRATION_BATCH_ITEMS = 10000
+
+# the values of an upload item that its file is registered with, and which the items of a batch share
+REGISTRATION_KEYS = ('rse', 'did_scope', 'dataset_scope', 'dataset_name')
+
+# subdirectory of an upload's staging directory that the upload summaries of its files are written to
+SUMMARY_DIRECTORY = '.summaries'
+
+
+def make_registration_batches(uploads: typing.Iterable[typing.Tuple[UploadItems, typing.Union[None, str]]],
+                              batch_size: int = REGISTRATION_BATCH_ITEMS) \
+        -> typing.Iterator[typing.Tuple[UploadItems, typing.List[str]]]:
+    """ Group the files of upload steps into batches to register, each of files with the same RSE, scope and dataset
+    (which are stored once, as the batch's defaults).
+
+    :param uploads: the items of the upload steps, each with the summary file path of the step (or None)
+    :param batch_size: the maximum number of files in a batch
+    :return: an iterator of the batches, as upload items holding only what is needed to register the files, each with
+        the paths of the upload summaries that have its files' checksums
+    """
+    batches = {}
+    summary_paths = {}              # key -> ordered summary paths of the batch's files
+    for items, summary_file_path in uploads:
+        for idx, item in enumerate(items):
+            key = tuple(item.get(registration_key) for registration_key in REGISTRATION_KEYS)
+            if key not in batches:
+                batches[key] = UploadItems(defaults={registration_key: value for registration_key, value
+                                                     in zip(REGISTRATION_KEYS, key) if value is not None})
+                summary_paths[key] = {}
+            batches[key].append({'path': item['path'], 'did_name': item['did_name']})
+            if summary_file_path:
+                summary_paths[key][get_chunk_summary_path(summary_file_path, idx // EXPAND_CHUNK_ITEMS)] = None
+            if len(batches[key]) >= batch_size:
+                yield batches.pop(key), list(summary_paths.pop(key))
+    for key, batch in batches.items():
+        yield batch, list(summary_paths[key])
+
+
+def _load_summaries(summary_file_paths: typing.Iterable[str]) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """ Load upload summaries, skipping any that weren't written (e.g. by an upload on another host). """
+    summaries = {}
+    for path in summary_file_paths:
+        try:
+            with open(path) as fi:
+                summaries.update(json.load(fi))
+        except (OSError, ValueError) as e:
+            logging.debug("Couldn't load upload summary {}: {}".format(path, repr(e)))
+    return summaries
+
+
+def register_files(items: typing.List[typing.Dict[str, typing.Any]],
+                   summary_file_paths: typing.List[str] = None) -> None:
+    """ Register files uploaded without registering them (with no_register), adding their replicas and attaching them
+    to their datasets in bulk, rather than with calls of their own as each upload finishes.
+
+    Files are registered with the sizes and checksums the upload client wrote to its upload summaries as it uploaded
+    them. Files missing from the summaries are read again to calculate them (so must still be where they were uploaded
+    from). Registering the same files again is harmless, so a registration interrupted part way through can be run
+    again: a bulk call failing because some of its replicas already exist is retried a file at a time, skipping those,
+    and files already attached to their dataset are ignored.
+
+    :param items: the upload items of the files, each with at least a path, RSE, DID scope and DID name, and optionally
+        a dataset scope and name
+    :param summary_file_paths: the paths of the upload summaries of the files
+    """
+    from rucio.common.exception import Duplicate, FileReplicaAlreadyExists
+
+    summaries = _load_summaries(summary_file_paths or [])
+    files = {}                      # RSE -> files
+    attachments = {}                # (dataset scope, dataset name) -> DIDs
+    for item in items:
+        did = {'scope': item['did_scope'], 'name': item['did_name']}
+        summary = summaries.get('{}:{}'.format(did['scope'], did['name']), {})
+        if all(summary.get(key) is not None for key in ('bytes', 'adler32', 'md5')):
+            fi = dict(did, bytes=summary['bytes'], adler32=summary['adler32'], md5=summary['md5'])
+        else:
+            logging.debug("No upload summary of {}, calculating its checksums".format(item['path']))
+            fi = dict(did, bytes=os.path.getsize(item['path']), **file_checksums(item['path']))
+        files.setdefault(item['rse'], []).append(fi)
+        if item.get('dataset_name'):
+            attachments.setdefault((item.get('dataset_scope', item['did_scope']), item['dataset_name']), []).append(did)
+
+    replica_client = get_client('ReplicaClient')
+    for rse, rse_files in files.items():
+        try:
+            replica_client.add_replicas(rse=rse, files=rse_files)
+        except (Duplicate, FileReplicaAlreadyExists):
+            logging.info("Some of {} replicas on {} are already registered, registering them one at a time".format(
+                len(rse_files), rse))
+            for fi in rse_files:
+                try:
+                    replica_client.add_replicas(rse=rse, files=[fi])
+                except (Duplicate, FileReplicaAlreadyExists):
+                    logging.debug("Replica of {}:{} on {} is already registered".format(fi['scope'], fi['name'], rse))
+    if attachments:
+        get_client('DIDClient').attach_dids_to_dids(attachments=[
+            {'scope': scope, 'name': name, 'dids': dids} for (scope, name), dids in attachments.items()
+        ], ignore_duplicate=True)
@@ -0,0 +1,431 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import logging
+import os
+import time
+import typing
+
+from rucio_extended_client.api.clients import get_client, get_client_pool
+from rucio_extended_client.api.items import call_with_arguments
+from rucio_extended_client.api.sections import VERIFICATION_SECTIONS, group_steps_into_phases
+from rucio_extended_client.api.step import describe_fqn
+from rucio_extended_client.api.stragglers import StragglerPolicy, keep_speculative_files, make_speculative_items, \
+    remove_abandoned_files
+from rucio_extended_client.common.checksum import DEFAULT_DIR_CHECKSUM_ALGORITHM, dir_checksum_from_file_hashes, \
+    file_hash, get_dir_checksum_algorithm
+
+
+def _call_with_thread_client(fqn: typing.Callable, **kwargs) -> typing.Any:
+    """ Call a function, first rebinding it to this thread's client if it is a method of a pooled Rucio client (whose
+    sessions can't be shared between threads).
+    """
+    return call_with_arguments(get_client_pool().rebind(fqn), kwargs)
+
+
+class AsyncAdapter:
+    """ Wraps a blocking Rucio client (or any object) so that its methods can be awaited.
+
+    Rucio's clients are blocking, so each call is run on an executor. The number of calls in flight is bounded by the
+    semaphore rather than by the executor, so one executor can be shared between adapters with different limits.
+    """
+    def __init__(self, client: typing.Any, executor: concurrent.futures.Executor, semaphore: asyncio.Semaphore = None):
+        """
+        :param client: the client to wrap
+        :param executor: the executor to run blocking calls on
+        :param semaphore: semaphore bounding the number of calls in flight (unbounded if not set)
+        """
+        self.client = client
+        self.executor = executor
+        self.semaphore = semaphore
+
+    def __getattr__(self, name: str) -> typing.Callable[..., typing.Awaitable[typing.Any]]:
+        return self.wrap(getattr(self.client, name), self.executor, self.semaphore)
+
+    @staticmethod
+    def wrap(fqn: typing.Callable, executor: concurrent.futures.Executor,
+             semaphore: asyncio.Semaphore = None) -> typing.Callable[..., typing.Awaitable[typing.Any]]:
+        """ Wrap a blocking function as a coroutine function. """
+        async def wrapped(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            if semaphore is None:
+                return await loop.run_in_executor(executor, functools.partial(fqn, *args, **kwargs))
+            async with semaphore:
+                return await loop.run_in_executor(executor, functools.partial(fqn, *args, **kwargs))
+        return wrapped
+
+
+def _clean_up_abandoned(items: typing.List[typing.Dict[str, typing.Any]], original_abandoned: bool,
+                        stray_paths: typing.Set[str], cleaned_up: concurrent.futures.Future, _) -> None:
+    """ Remove what an abandoned copy of a download left behind once it has finished, then mark it cleaned up. """
+    try:
+        remove_abandoned_files(items, original_abandoned, stray_paths)
+    finally:
+        cleaned_up.set_result(None)
+
+
+class AsyncPlanRunner:
+    """ Runs a plan on an asyncio event loop, keeping many steps in flight at once.
+
+    Steps are grouped into phases (see rucio_extended_client.api.sections) and the steps of a phase run concurrently,
+    bounded by a semaphore per operation class (catalog, transfer or local). Steps that are already done are skipped,
+    so a partially run plan can be resumed by either this runner or Plan.run.
+
+    Given a StragglerPolicy, transfer steps running well below the rate of the others are detected and, for downloads,
+    a speculative copy is run from another replica, keeping whichever copy finishes first. Uploads are only detected
+    (and logged), as a second upload of the same file to the same path would race with the first.
+    """
+    default_concurrency = {
+        'catalog': 64,
+        'transfer': 4,
+        'local': 16
+    }
+
+    def __init__(self, plan, concurrency: typing.Dict[str, int] = None, stragglers: StragglerPolicy = None):
+        """
+        :param plan: the plan to run
+        :param concurrency: mapping of operation class (catalog, transfer or local) to the maximum number of steps of
+            that class in flight
+        :param stragglers: policy for detecting and re-issuing straggling transfer steps (not detected if not set)
+        """
+        self.plan = plan
+        self.concurrency = {**self.default_concurrency, **(concurrency or {})}
+        self.stragglers = stragglers
+        self._speculated = []
+        self._n_speculating = 0
+        self._abandoned = []            # futures done once each abandoned copy has finished and been cleaned up
+
+    def run(self, dry_run: bool = False) -> None:
+        """ Run the entire plan.
+
+        :param dry_run: don't actually do anything, just log
+        """
+        logging.info("Running plan asynchronously with concurrency {}".format(self.concurrency))
+        try:
+            asyncio.run(self.run_async(dry_run))
+            logging.info("Reached end of plan")
+        except (Exception, KeyboardInterrupt) as e:
+            logging.critical("Encountered exception running plan: {}".format(repr(e)))
+            self.plan.current_step_number = next(
+                (idx for idx, step in enumerate(self.plan.steps) if not step.is_done), self.plan.number_of_steps)
+            self.plan.save("plan-dump.json")
+            exit()
+        finally:
+            if self.plan.metrics is not None:
+                self.plan.metrics.report()
+
+    def wait_for_abandoned(self, timeout: float = None) -> bool:
+        """ Wait for the copies of straggling steps abandoned by the last run to finish, and for what they left behind
+        to be removed (e.g. before verifying what was downloaded, which they would otherwise still be writing to).
+
+        :param timeout: the maximum number of seconds to wait (no limit if None)
+        :return: whether every abandoned copy has finished and been cleaned up
+        """
+        _, not_done = concurrent.futures.wait(self._abandoned, timeout=timeout)
+        return not not_done
+
+    async def run_async(self, dry_run: bool = False) -> None:
+        """ Run the entire plan, phase by phase.
+
+        :param dry_run: don't actually do anything, just log
+        """
+        semaphores = {operation_class: asyncio.Semaphore(limit) for operation_class, limit in self.concurrency.items()}
+        phases, verification_phases = self._split_phases()
+        with self._executor() as executor:
+            for phase in phases:
+                await self._run_phase(phase, semaphores, executor, dry_run)
+        await self._run_verification_phases(verification_phases, semaphores, dry_run)
+        self.plan.current_step_number = self.plan.number_of_steps
+
+    def _split_phases(self) -> typing.Tuple[typing.List[typing.List[int]], typing.List[typing.List[int]]]:
+        """ Group the steps of the plan into phases, separating the phases that verify what was transferred (see
+        _run_verification_phases).
+        """
+        phases, verification_phases = [], []
+        for phase in group_steps_into_phases(self.plan.steps):
+            if all(self.plan.steps[idx].section_name in VERIFICATION_SECTIONS for idx in phase):
+                verification_phases.append(phase)
+            else:
+                phases.append(phase)
+        return phases, verification_phases
+
+    async def _run_verification_phases(self, phases: typing.List[typing.List[int]],
+                                       semaphores: typing.Dict[str, asyncio.Semaphore], dry_run: bool = False) -> None:
+        """ Run the phases that verify what was transferred, once every abandoned copy of a straggling step has
+        finished and what it left behind has been removed.
+        """
+        if not phases:
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self.wait_for_abandoned)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=sum(self.concurrency.values())) as executor:
+            for phase in phases:
+                await self._run_phase(phase, semaphores, executor, dry_run)
+
+    @contextlib.contextmanager
+    def _executor(self) -> typing.Iterator[concurrent.futures.Executor]:
+        """ Context manager providing the executor that steps are run on (and, given a StragglerPolicy, another that
+        speculative copies of straggling steps are run on).
+
+        With a StragglerPolicy, the executors are shut down without waiting for the copies that lost, which would
+        otherwise hold up the end of the run until they finished. They are left to finish in the background (bounded by
+        their transfer timeout) and, if the plan ran to the end, what each leaves behind is removed once it has (see
+        wait_for_abandoned).
+        """
+        self._speculated = []
+        self._n_speculating = 0
+        self._abandoned = []
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=sum(self.concurrency.values()))
+        if self.stragglers is None:
+            with executor:
+                yield executor
+            return
+        self._speculative_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.stragglers.max_speculative)
+        try:
+            yield executor
+        finally:
+            executor.shutdown(wait=False)
+            self._speculative_executor.shutdown(wait=False)
+        if self._speculated:
+            renames = [step.arguments for step in self.plan.steps if step.section_name == 'rename_files']
+            stray_paths = {rename['src'] for rename in renames} - {rename['dst'] for rename in renames}
+            for items, original_abandoned, loser in self._speculated:
+                cleaned_up = concurrent.futures.Future()
+                loser.add_done_callback(functools.partial(
+                    _clean_up_abandoned, items, original_abandoned, stray_paths, cleaned_up))
+                self._abandoned.append(cleaned_up)
+        logging.info("{} straggling transfer steps, {} won by a speculative copy".format(
+            self.stragglers.n_stragglers, self.stragglers.n_speculative_wins))
+
+    async def _run_phase(self, phase: typing.List[int], semaphores: typing.Dict[str, asyncio.Semaphore],
+                         executor: concurrent.futures.Executor, dry_run: bool = False) -> None:
+        """ Run the pending steps of a phase concurrently, stopping at the first failure.
+
+        Steps are only scheduled once their semaphore has been acquired, so that the number of tasks (and not just the
+        number of calls in flight) is bounded, however many steps there are.
+        """
+        tasks = set()
+        failures = []
+        for idx in phase:
+            step = self.plan.steps[idx]
+            if step.is_done:
+                continue
+            if failures:
+                break
+            semaphore = semaphores[step.operation_class]
+            await semaphore.acquire()
+            task = asyncio.ensure_future(self._run_step(idx, executor, dry_run))
+            tasks.add(task)
+
+            def on_done(task, semaphore=semaphore):
+                tasks.discard(task)
+                semaphore.release()
+                if not task.cancelled() and task.exception() is not None:
+                    failures.append(task.exception())
+            task.add_done_callback(on_done)
+        if tasks:
+            await asyncio.wait(set(tasks))
+        if failures:
+            raise failures[0]
+
+    async def _run_step(self, idx: int, executor: concurrent.futures.Executor, dry_run: bool = False) -> typing.Any:
+        step = self.plan.steps[idx]
+        if logging.getLogger().isEnabledFor(logging.DEBUG):     # avoid formatting large arguments needlessly
+            logging.debug("{}: ({}) Running {} with parameters {}".format(
+                idx, step.section_name, describe_fqn(step.fqn), step.arguments))
+        if dry_run:
+            return None
+        st = time.perf_counter()
+        try:
+            if self.stragglers is not None and step.operation_class == 'transfer':
+                rtn = await self._run_transfer(idx, executor)
+            else:
+                rtn = await AsyncAdapter.wrap(functools.partial(_call_with_thread_client, step.fqn), executor)(
+                    **step.arguments)
+        except BaseException:
+            if self.plan.metrics is not None:
+                self.plan.metrics.record(step.section_name, step.fqn.__name__, time.perf_counter() - st,
+                                         step.size_bytes, success=False)
+            raise
+        if self.plan.metrics is not None:
+            self.plan.metrics.record(step.section_name, step.fqn.__name__, time.perf_counter() - st, step.size_bytes)
+            self.plan.metrics.report_if_due()
+        step.is_done = True
+        return rtn
+
+    async def _run_transfer(self, idx: int, executor: concurrent.futures.Executor) -> typing.Any:
+        """ Run a transfer step, checking every so often if it has become a straggler and, if so, running a speculative
+        copy of it. The result of whichever copy succeeds first is returned (the other is left to finish).
+        """
+        step = self.plan.steps[idx]
+        st = time.perf_counter()
+        concurrent_original = executor.submit(_call_with_thread_client, step.fqn, **step.arguments)
+        original = asyncio.wrap_future(concurrent_original)
+        copies = {original: concurrent_original}        # asyncio future -> the concurrent future it wraps
+        pending = {original}
+        speculative = None
+        is_straggler = False
+        exceptions = []
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=self.stragglers.check_interval,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    exceptions.append(future.exception())
+                    continue
+                if future is original:
+                    self.stragglers.record(step.size_bytes, time.perf_counter() - st)
+                else:
+                    logging.info("{}: ({}) Speculative copy finished first".format(idx, step.section_name))
+                    self.stragglers.n_speculative_wins += 1
+                    keep_speculative_files(step.arguments['items'])
+                for loser in pending:           # the losing copy's exception (if any) is of no interest
+                    loser.add_done_callback(lambda loser: loser.cancelled() or loser.exception())
+                    self._speculated.append((step.arguments['items'], future is speculative, copies[loser]))
+                return future.result()
+            if not pending or is_straggler or \
+                    not self.stragglers.is_straggler(step.size_bytes, time.perf_counter() - st):
+                continue
+            is_straggler = True
+            self.stragglers.n_stragglers += 1
+            if step.fqn.__name__ != 'download_dids' or self._n_speculating >= self.stragglers.max_speculative:
+                logging.warning("{}: ({}) Step is straggling after {:.0f}s".format(
+                    idx, step.section_name, time.perf_counter() - st))
+                continue
+            logging.warning("{}: ({}) Step is straggling after {:.0f}s, running a speculative copy".format(
+                idx, step.section_name, time.perf_counter() - st))
+            concurrent_speculative = await self._speculate(step)
+            speculative = asyncio.wrap_future(concurrent_speculative)
+            speculative.add_done_callback(self._on_speculative_done)
+            copies[speculative] = concurrent_speculative
+            pending.add(speculative)
+        raise exceptions[0]
+
+    async def _speculate(self, step) -> concurrent.futures.Future:
+        """ Start a speculative copy of a download step, from other replicas of its files where there are any. """
+        loop = asyncio.get_running_loop()
+        self._n_speculating += 1
+        try:
+            replicas = await loop.run_in_executor(self._speculative_executor, functools.partial(
+                self._list_replica_rses, step.arguments['items']))
+        except Exception as e:
+            logging.warning("Couldn't list replicas for a speculative copy: {}".format(repr(e)))
+            replicas = {}
+        arguments = dict(step.arguments, items=make_speculative_items(step.arguments['items'], replicas))
+        return self._speculative_executor.submit(_call_with_thread_client, step.fqn, **arguments)
+
+    def _on_speculative_done(self, _) -> None:
+        self._n_speculating -= 1
+
+    @staticmethod
+    def _list_replica_rses(items: typing.List[typing.Dict[str, typing.Any]]) -> typing.Dict[str, typing.List[str]]:
+        """ Get a mapping of the DID of each file downloaded by the items to the RSEs holding a replica of it. """
+        dids = [dict(zip(('scope', 'name'), item['did'].split(':'))) for item in items]
+        return {'{}:{}'.format(replica['scope'], replica['name']): list(replica['rses'])
+                for replica in get_client('ReplicaClient').list_replicas(dids=dids)}
+
+
+class HybridPlanRunner(AsyncPlanRunner):
+    """ Runs a plan like AsyncPlanRunner, but with CPU-bound hashing on a separate pool of processes.
+
+    When given the directory being uploaded, the files of each upload step are hashed in the process pool while the
+    step's upload (and those of other steps) proceeds in the thread pool. The directory checksum is then assembled from
+    these hashes and set in the add_metadata step, instead of being calculated in a separate pass over every file
+    before anything is uploaded. The number of files queued for hashing is bounded, so hashing can't run arbitrarily
+    far ahead of (or behind) the uploads.
+    """
+    def __init__(self, plan, concurrency: typing.Dict[str, int] = None, n_processes: int = None,
+                 root_directory: str = None, max_queued_hashes: int = None, stragglers: StragglerPolicy = None):
+        """
+        :param plan: the plan to run
+        :param concurrency: mapping of operation class (catalog, transfer or local) to the maximum number of steps of
+            that class in flight
+        :param n_processes: the number of hashing processes (the number of CPUs if not set)
+        :param root_directory: the directory being uploaded, to calculate the directory checksum of (the plan's root
+            directory if not set, and not calculated if neither is set)
+        :param max_queued_hashes: the maximum number of files queued for hashing (4 per process if not set)
+        :param stragglers: policy for detecting and re-issuing straggling transfer steps (not detected if not set)
+        """
+        super().__init__(plan, concurrency, stragglers)
+        self.n_processes = n_processes or os.cpu_count() or 1
+        self.root_directory = root_directory or plan.root_directory
+        self.max_queued_hashes = max_queued_hashes or 4 * self.n_processes
+        self._file_hashes = {}
+        self._dir_checksum_algorithm = DEFAULT_DIR_CHECKSUM_ALGORITHM
+
+    async def run_async(self, dry_run: bool = False) -> None:
+        """ Run the entire plan, phase by phase.
+
+        :param dry_run: don't actually do anything, just log
+        """
+        semaphores = {operation_class: asyncio.Semaphore(limit) for operation_class, limit in self.concurrency.items()}
+        self._hash_semaphore = asyncio.Semaphore(self.max_queued_hashes)
+        self._file_hashes = {}
+        self._dir_checksum_algorithm = self._get_dir_checksum_algorithm()
+        phases, verification_phases = self._split_phases()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.n_processes) as self._process_executor:
+            with self._executor() as executor:
+                for phase in phases:
+                    if self.root_directory and not dry_run:
+                        for idx in phase:
+                            step = self.plan.steps[idx]
+                            if step.section_name == 'add_metadata' and not step.is_done:
+                                self._set_dir_checksum(step, await self._get_dir_checksum())
+                    await self._run_phase(phase, semaphores, executor, dry_run)
+            await self._run_verification_phases(verification_phases, semaphores, dry_run)
+        self.plan.current_step_number = self.plan.number_of_steps
+
+    async def _hash_file(self, path: str) -> None:
+        """ Queue a file for hashing, waiting if the queue is full. """
+        relative_path = os.path.relpath(path, self.root_directory)
+        if relative_path in self._file_hashes:
+            return
+        await self._hash_semaphore.acquire()
+        future = asyncio.wrap_future(self._process_executor.submit(file_hash, path, self._dir_checksum_algorithm))
+        future.add_done_callback(lambda _: self._hash_semaphore.release())
+        self._file_hashes[relative_path] = future
+
+    async def _get_dir_checksum(self) -> str:
+        """ Wait for every file to be hashed (queueing any not already hashed, e.g. when resuming a plan) and assemble
+        the directory checksum.
+        """
+        for root, _, files in os.walk(self.root_directory, followlinks=True):
+            for fi in files:
+                await self._hash_file(os.path.join(root, fi))
+        file_hashes = {relative_path: await future for relative_path, future in self._file_hashes.items()}
+        dir_checksum = dir_checksum_from_file_hashes(self.root_directory, file_hashes, self._dir_checksum_algorithm)
+        logging.info("Calculated {} directory checksum {} from {} file hashes".format(
+            self._dir_checksum_algorithm, dir_checksum, len(file_hashes)))
+        return dir_checksum
+
+    @staticmethod
+    def _iter_metadata_hierarchies(step) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        """ Iterate over the hierarchy metadata (holding the directory checksum) set by an add_metadata step. """
+        # set_metadata_bulk, or set_dids_metadata_bulk if optimized
+        metas = [step.arguments.get('meta', {})] + [did['meta'] for did in step.arguments.get('dids', [])]
+        for meta in metas:
+            for value in meta.values():
+                if isinstance(value, dict) and 'dir_checksum' in value:
+                    yield value
+
+    def _get_dir_checksum_algorithm(self) -> str:
+        """ Get the algorithm the plan records the directory checksum as calculated with. """
+        for step in self.plan.steps:
+            if step.section_name == 'add_metadata':
+                for metadata_hierarchy in self._iter_metadata_hierarchies(step):
+                    return get_dir_checksum_algorithm(metadata_hierarchy)
+        return DEFAULT_DIR_CHECKSUM_ALGORITHM
+
+    @classmethod
+    def _set_dir_checksum(cls, step, dir_checksum: str) -> None:
+        for metadata_hierarchy in cls._iter_metadata_hierarchies(step):
+            metadata_hierarchy['dir_checksum'] = dir_checksum
+
+    async def _run_step(self, idx: int, executor: concurrent.futures.Executor, dry_run: bool = False) -> typing.Any:
+        step = self.plan.steps[idx]
+        if self.root_directory and not dry_run and step.section_name == 'upload_files':
+            for item in step.arguments.get('items', []):
+                if not os.path.relpath(item['path'], self.root_directory).startswith(os.pardir):    # not staged
+                    await self._hash_file(item['path'])
+        return await super()._run_step(idx, executor, dry_run)
@@ -0,0 +1,72 @@
+import typing
+
+
+def schedule_largest_first(
+        sizes: typing.Dict[typing.Any, int], num_threads: int = 4, batch_bytes: int = 1024**3,
+        max_batch_items: int = 1000) -> typing.List[typing.List[typing.Any]]:
+    """ Order items largest first and group them into batches for a pool of num_threads workers.
+
+    This is longest-processing-time-first scheduling: within a batch, the largest items are handed to the worker pool
+    first so that no large item is left to run on its own at the end. A batch is closed once it holds at least one
+    item per worker and at least batch_bytes in total, so that large items are spread across the workers while tiny
+    items are packed together (up to max_batch_items per batch).
+
+    :param sizes: mapping of item to size in bytes (None if unknown, in which case the item is scheduled last)
+    :param num_threads: the number of workers that will process each batch
+    :param batch_bytes: the minimum number of bytes in a batch before it is closed
+    :param max_batch_items: the maximum number of items in a batch
+    :return: a list of batches, each a list of items ordered largest first
+    """
+    ordered = sorted(sizes, key=lambda item: sizes[item] or 0, reverse=True)
+
+    batches = []
+    batch = []
+    batch_size = 0
+    for item in ordered:
+        batch.append(item)
+        batch_size += sizes[item] or 0
+        if (len(batch) >= num_threads and batch_size >= batch_bytes) or len(batch) >= max_batch_items:
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class WeightedStriper:
+    """ Stripes items across targets (e.g. RSEs) in proportion to their weights, balanced by bytes.
+
+    Each item is assigned to the target that would have the smallest weighted load (bytes assigned divided by weight)
+    after taking it, so that with items offered largest first, every target finishes at about the same time when
+    transfers to them run in parallel at rates proportional to their weights.
+    """
+    def __init__(self, weights: typing.Dict[str, float]):
+        """
+        :param weights: mapping of target to weight (e.g. its relative bandwidth)
+        """
+        if not weights or any(weight <= 0 for weight in weights.values()):
+            raise ValueError("weights must be positive")
+        self.weights = dict(weights)
+        self.bytes = {target: 0 for target in weights}
+
+    def assign(self, size: int) -> str:
+        """ Assign an item to a target.
+
+        :param size: size of the item in bytes
+        :return: the target
+        """
+        target = min(self.weights, key=lambda target: (self.bytes[target] + (size or 0)) / self.weights[target])
+        self.bytes[target] += size or 0
+        return target
+
+    def stripe(self, sizes: typing.Dict[typing.Any, int]) -> typing.Dict[str, typing.List[typing.Any]]:
+        """ Assign items to targets, largest first.
+
+        :param sizes: mapping of item to size in bytes
+        :return: mapping of target to the items assigned to it (targets with no items are omitted)
+        """
+        striped = {}
+        for item in sorted(sizes, key=lambda item: sizes[item] or 0, reverse=True):
+            striped.setdefault(self.assign(sizes[item]), []).append(item)
+        return striped
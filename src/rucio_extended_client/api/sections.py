@@ -0,0 +1,53 @@
+import typing
+
+from rucio_extended_client.api.step import Step
+
+# The order in which the sections of the upload and download plans can safely be run. Steps in a section only depend
+# on steps in earlier sections (e.g. attachments need both collections to exist, renames need the file to be
+# downloaded), so a plan can be run section by section with the steps of each section run in any order.
+SECTION_ORDER = (
+    'overwrite_existing',
+    'create_directories',
+    'create_root_container',
+    'create_files_dataset',
+    'create_collections',
+    'create_attachments',
+    'compress_files',
+    'upload_files',
+    'register_files',
+    'download_files',
+    'rename_files',
+    'remove_staged_files',
+    'add_root_container_rule',
+    'add_metadata',
+    'verify_dir_checksum'
+)
+
+# sections that verify what was transferred, which must not run while any copy of a transfer may still be writing
+VERIFICATION_SECTIONS = ('verify_dir_checksum',)
+
+
+def group_steps_into_phases(steps: typing.List[Step]) -> typing.List[typing.List[int]]:
+    """ Group the indices of steps into phases, where the steps of a phase can be run concurrently once all the steps
+    of the previous phases are done.
+
+    If every section is known, there is one phase per section in SECTION_ORDER. Otherwise, each run of consecutive
+    steps in the same section is a phase, preserving the order of the plan.
+
+    :param steps: the steps of a plan
+    :return: a list of phases, each a list of step indices in plan order
+    """
+    if all(step.section_name in SECTION_ORDER for step in steps):
+        phases = {}
+        for idx, step in enumerate(steps):
+            phases.setdefault(step.section_name, []).append(idx)
+        return [phases[section_name] for section_name in SECTION_ORDER if section_name in phases]
+
+    phases = []
+    last_section_name = None
+    for idx, step in enumerate(steps):
+        if not phases or step.section_name != last_section_name:
+            phases.append([])
+        phases[-1].append(idx)
+        last_section_name = step.section_name
+    return phases
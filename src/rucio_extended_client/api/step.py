@@ -1,9 +1,55 @@
+from importlib import import_module
+import typing
+
+from rucio_extended_client.api.clients import DeferredClient, get_client_class_name, get_client_pool, \
+    get_deferred_client
+from rucio_extended_client.api.items import UploadItems, decode_arguments, encode_arguments
+
+# names of the functions that move file content (everything else bound to a client is a catalog operation)
+TRANSFER_FUNCTION_NAMES = ('download_dids', 'upload')
+
+# argument keys holding lists of items that a single step operates on
+ITEM_ARGUMENT_KEYS = ('items', 'attachments', 'dids', 'files')
+
+
+def describe_fqn(fqn: typing.Callable) -> str:
+    """ Get a human readable description of a step's function. """
+    if hasattr(fqn, '__self__'):  # bound method
+        return "bound method {}.{}.{}".format(get_client_class_name(fqn), fqn.__name__, fqn.__module__)
+    return "function {}.{}".format(fqn.__module__, fqn.__name__)
+
+
+def get_operation_class(fqn: typing.Callable) -> str:
+    """ Classify a step's function as a transfer, a catalog operation or a local (filesystem) operation. """
+    return get_operation_class_from_names(fqn.__name__, get_client_class_name(fqn))
+
+
+def get_operation_class_from_names(function_name: str, function_class_name: str = None) -> str:
+    """ Classify a step's function as get_operation_class does, from its name and the name of its class (None if it
+    isn't a bound method).
+    """
+    if function_name in TRANSFER_FUNCTION_NAMES:
+        return 'transfer'
+    if function_class_name and function_class_name.endswith('Client'):
+        return 'catalog'
+    return 'local'
+
+
+def count_items(arguments: typing.Dict[str, typing.Any]) -> int:
+    """ Count the items (files, DIDs or attachments) a step operates on from its arguments. """
+    for key in ITEM_ARGUMENT_KEYS:
+        if isinstance(arguments.get(key), (list, UploadItems)):
+            return len(arguments[key])
+    return 1
+
+
 class Step:
-    def __init__(self, section_name, fqn, arguments, is_done=False):
+    def __init__(self, section_name, fqn, arguments, is_done=False, size_bytes=None):
         self._section_name = section_name
         self._fqn = fqn
         self._arguments = arguments
         self._is_done = is_done
+        self._size_bytes = size_bytes
 
     @property
     def section_name(self):
@@ -35,4 +81,64 @@ class Step:
 
     @is_done.setter
     def is_done(self, new_is_done):
-        self._is_done = new_is_done
\ No newline at end of file
+        self._is_done = new_is_done
+
+    @property
+    def size_bytes(self):
+        return self._size_bytes
+
+    @size_bytes.setter
+    def size_bytes(self, new_size_bytes):
+        self._size_bytes = new_size_bytes
+
+    @property
+    def n_items(self):
+        """ The number of items (files, DIDs or attachments) the step operates on. """
+        return count_items(self._arguments)
+
+    @property
+    def operation_class(self):
+        return get_operation_class(self._fqn)
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        """ Get a JSON serialisable description of the step, with the function described by name. """
+        fqn = self._fqn
+        return {
+            'section_name': self._section_name,
+            'function_name': fqn.__name__,
+            'function_class_name': get_client_class_name(fqn),
+            'function_module_name': fqn.__module__,
+            'arguments': encode_arguments(self._arguments),
+            'is_done': self._is_done,
+            'size_bytes': self._size_bytes
+        }
+
+    @classmethod
+    def from_dict(cls, step: typing.Dict[str, typing.Any], function_classes_to_objects: typing.Dict[str, typing.Any]) \
+            -> 'Step':
+        """ Make a step from a description made by to_dict.
+
+        :param step: the description
+        :param function_classes_to_objects: mapping of class name to instance, shared between calls to avoid
+            instantiating duplicate classes of the same type
+        """
+        if step['function_class_name']:     # bound method
+            try:
+                if step['function_class_name'] not in function_classes_to_objects:
+                    if step['function_class_name'] in get_client_pool():      # Rucio clients, made when first called
+                        function_classes_to_objects[step['function_class_name']] = \
+                        get_deferred_client(step['function_class_name'])
+                    else:
+                        function_classes_to_objects[step['function_class_name']] = \
+                        getattr(import_module(step['function_module_name']), step['function_class_name'])()
+                function_class_instance = function_classes_to_objects[step['function_class_name']]
+                if isinstance(function_class_instance, DeferredClient):         # saved from a client, so not checked
+                    fqn = function_class_instance.get_method(step['function_name'], check=False)
+                else:
+                    fqn = getattr(function_class_instance, step['function_name'])
+            except AttributeError:          # bound method with no class, just module
+                fqn = getattr(import_module(step['function_module_name']), step['function_name'])
+        else:                               # unbound method (e.g. class)
+            fqn = getattr(import_module(step['function_module_name']), step['function_name'])
+        return cls(step['section_name'], fqn, decode_arguments(step['arguments']), step['is_done'],
+                   step.get('size_bytes'))
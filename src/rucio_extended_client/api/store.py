@@ -0,0 +1,264 @@
+import json
+import logging
+import sqlite3
+import time
+import typing
+
+from rucio_extended_client.api.items import call_with_arguments
+from rucio_extended_client.api.step import Step, describe_fqn
+
+# suffixes of paths that are taken to be plan stores rather than JSON plans
+PLAN_STORE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS attributes (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS steps (
+    step_number INTEGER PRIMARY KEY,
+    section_name TEXT NOT NULL,
+    function_module_name TEXT NOT NULL,
+    function_class_name TEXT,
+    function_name TEXT NOT NULL,
+    operation_class TEXT NOT NULL,
+    arguments TEXT NOT NULL,
+    n_items INTEGER NOT NULL,
+    is_done INTEGER NOT NULL DEFAULT 0,
+    size_bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS steps_section_name ON steps (section_name);
+CREATE INDEX IF NOT EXISTS steps_function_name ON steps (function_name);
+CREATE INDEX IF NOT EXISTS steps_size_bytes ON steps (size_bytes);
+CREATE INDEX IF NOT EXISTS steps_is_done ON steps (is_done, step_number);
+CREATE INDEX IF NOT EXISTS steps_is_done_section_name_size_bytes ON steps (is_done, section_name, size_bytes);
+"""
+
+# columns of the steps table that can be queried, other than the arguments
+QUERY_COLUMNS = ('step_number', 'section_name', 'function_module_name', 'function_class_name', 'function_name',
+                 'operation_class', 'n_items', 'is_done', 'size_bytes')
+
+
+def is_plan_store_path(path: str) -> bool:
+    """ Check if a path is (to be) a plan store rather than a JSON plan, by its suffix. """
+    return path.lower().endswith(PLAN_STORE_SUFFIXES)
+
+
+class PlanStore:
+    """ A plan kept in a single SQLite file, for plans too large to keep in memory.
+
+    Steps are kept in plan order, with indexed columns for their section, function, status and size, so a partly run
+    plan can be queried (e.g. for pending uploads over 1 GB) without loading it. Steps are loaded a page at a time
+    when running, and each is marked as done by updating a single row as soon as it has run, so a run can be
+    interrupted and resumed at any point.
+    """
+    def __init__(self, path: str):
+        """
+        :param path: the path of the store (created if it doesn't exist)
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")          # cheap commits when marking steps as done
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self._function_classes_to_objects = {}                      # avoid instantiating duplicate classes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    @classmethod
+    def from_plan(cls, plan, path: str) -> 'PlanStore':
+        """ Make a store from a plan, replacing any existing store at the path.
+
+        :param plan: the plan
+        :param path: the path of the store
+        :return: the store
+        """
+        logging.info("Saving plan to store {}".format(path))
+        store = cls(path)
+        with store.connection:
+            store.connection.execute("DELETE FROM steps")
+            store.connection.execute("DELETE FROM attributes")
+        store.set_attributes(
+            root_suffix=plan.root_suffix, path_delimiter=plan.path_delimiter, hierarchy_key=plan.hierarchy_key)
+        if plan.root_directory:
+            store.set_attributes(root_directory=plan.root_directory)
+        store.append_steps(
+            step if idx >= plan.current_step_number or step.is_done else      # earlier steps have been skipped
+            Step(step.section_name, step.fqn, step.arguments, True, step.size_bytes)
+            for idx, step in enumerate(plan.steps))
+        return store
+
+    def to_plan(self, plan_cls=None):
+        """ Load the whole store into a plan (only for plans that fit in memory).
+
+        :param plan_cls: the class of plan to load into (Plan if not set)
+        """
+        if plan_cls is None:
+            from rucio_extended_client.api.plan import Plan      # avoid a circular import
+            plan_cls = Plan
+        attributes = self.get_attributes()
+        plan = plan_cls(**attributes)
+        plan.root_directory = attributes.get('root_directory')
+        plan.steps = [step for _, step in self.iter_steps()]
+        return plan
+
+    def get_attributes(self) -> typing.Dict[str, typing.Any]:
+        """ Get the attributes of the plan (e.g. root_suffix). """
+        return {row['key']: json.loads(row['value']) for row in self.connection.execute(
+            "SELECT key, value FROM attributes")}
+
+    def set_attributes(self, **attributes) -> None:
+        """ Set attributes of the plan. """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO attributes (key, value) VALUES (?, ?)", [
+                (key, json.dumps(value)) for key, value in attributes.items()])
+
+    def append_steps(self, steps: typing.Iterable[Step]) -> None:
+        """ Append steps, without holding them all in memory if given a generator.
+
+        :param steps: the steps to append, in plan order
+        """
+        first_step_number = self.connection.execute("SELECT COALESCE(MAX(step_number) + 1, 0) FROM steps").fetchone()[0]
+
+        def rows():
+            for step_number, step in enumerate(steps, first_step_number):
+                description = step.to_dict()
+                yield (step_number, description['section_name'], description['function_module_name'],
+                       description['function_class_name'], description['function_name'], step.operation_class,
+                       json.dumps(description['arguments']), step.n_items, int(step.is_done), step.size_bytes)
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO steps (step_number, section_name, function_module_name, function_class_name, "
+                "function_name, operation_class, arguments, n_items, is_done, size_bytes) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows())
+
+    @staticmethod
+    def _make_filter(section_name: str = None, is_done: bool = None, function_name: str = None,
+                     min_bytes: int = None, max_bytes: int = None) -> typing.Tuple[str, typing.List[typing.Any]]:
+        """ Make a WHERE clause (always starting with WHERE) and its parameters. """
+        clauses, parameters = ['1'], []
+        for column, operator, value in [('section_name', '=', section_name),
+                                        ('is_done', '=', None if is_done is None else int(is_done)),
+                                        ('function_name', '=', function_name), ('size_bytes', '>=', min_bytes),
+                                        ('size_bytes', '<=', max_bytes)]:
+            if value is not None:
+                clauses.append("{} {} ?".format(column, operator))
+                parameters.append(value)
+        return "WHERE " + " AND ".join(clauses), parameters
+
+    def count(self, **filters) -> int:
+        """ Count the steps matching filters (see query). """
+        where, parameters = self._make_filter(**filters)
+        return self.connection.execute("SELECT COUNT(*) FROM steps {}".format(where), parameters).fetchone()[0]
+
+    def query(self, section_name: str = None, is_done: bool = None, function_name: str = None, min_bytes: int = None,
+              max_bytes: int = None, limit: int = None) -> typing.List[typing.Dict[str, typing.Any]]:
+        """ Query steps, without loading their arguments.
+
+        :param section_name: only steps in this section
+        :param is_done: only steps that are (True) or aren't (False) done
+        :param function_name: only steps calling a function with this name (e.g. upload)
+        :param min_bytes: only steps of at least this many bytes
+        :param max_bytes: only steps of at most this many bytes
+        :param limit: the maximum number of steps to return
+        :return: a list of steps (as dictionaries of the queryable columns) in plan order
+        """
+        where, parameters = self._make_filter(section_name, is_done, function_name, min_bytes, max_bytes)
+        sql = "SELECT {} FROM steps {} ORDER BY step_number".format(', '.join(QUERY_COLUMNS), where)
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+        return [dict(row) for row in self.connection.execute(sql, parameters)]
+
+    def iter_steps(self, page_size: int = 1000, **filters) -> typing.Iterator[typing.Tuple[int, Step]]:
+        """ Iterate over steps in plan order, loading a page of steps at a time.
+
+        :param page_size: the number of steps to load at a time
+        :param filters: filters as for query
+        :return: an iterator of tuples of step number and step
+        """
+        where, parameters = self._make_filter(**filters)
+        last_step_number = -1
+        while True:
+            rows = self.connection.execute(
+                "SELECT * FROM steps {} AND step_number > ? ORDER BY step_number LIMIT ?".format(where),
+                parameters + [last_step_number, page_size]).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                description = dict(row)
+                description['arguments'] = json.loads(description['arguments'])
+                description['is_done'] = bool(description['is_done'])
+                yield row['step_number'], Step.from_dict(description, self._function_classes_to_objects)
+            last_step_number = rows[-1]['step_number']
+
+    def mark_done(self, step_number: int) -> None:
+        """ Mark a step as done. """
+        with self.connection:
+            self.connection.execute("UPDATE steps SET is_done = 1 WHERE step_number = ?", (step_number,))
+
+    def summarise(self) -> typing.Dict[str, typing.Any]:
+        """ Summarise the plan per section (in order of first appearance), as Plan.summarise does. """
+        def empty():
+            return {'n_steps': 0, 'n_done': 0, 'n_items': 0, 'bytes': 0, 'bytes_done': 0, 'n_catalog_calls': 0,
+                    'n_transfers': 0}
+
+        sections = {}
+        total = empty()
+        for row in self.connection.execute(
+                "SELECT section_name, COUNT(*) AS n_steps, SUM(is_done) AS n_done, SUM(n_items) AS n_items, "
+                "SUM(COALESCE(size_bytes, 0)) AS bytes, SUM(is_done * COALESCE(size_bytes, 0)) AS bytes_done, "
+                "SUM(operation_class = 'catalog') AS n_catalog_calls, "
+                "SUM(CASE WHEN operation_class = 'transfer' THEN n_items ELSE 0 END) AS n_transfers "
+                "FROM steps GROUP BY section_name ORDER BY MIN(step_number)"):
+            section = sections[row['section_name']] = empty()
+            for key in section:
+                section[key] = row[key]
+                total[key] += row[key]
+        return {'sections': sections, 'total': total}
+
+    def run(self, dry_run: bool = False, metrics=None, page_size: int = 1000) -> None:
+        """ Run the steps that aren't done, in plan order, marking each as done once it has run.
+
+        :param dry_run: don't actually do anything, just log
+        :param metrics: an instance of PlanMetrics to record per-step metrics in (not recorded if None)
+        :param page_size: the number of steps to load at a time
+        """
+        logging.info("Running plan from store {} ({} steps pending)".format(self.path, self.count(is_done=False)))
+        step_number = None
+        try:
+            for step_number, step in self.iter_steps(page_size=page_size, is_done=False):
+                if logging.getLogger().isEnabledFor(logging.DEBUG):     # avoid formatting large arguments needlessly
+                    logging.debug("{}: ({}) Running {} with parameters {}".format(
+                        step_number, step.section_name, describe_fqn(step.fqn), step.arguments))
+                if dry_run:
+                    continue
+                st = time.perf_counter()
+                try:
+                    call_with_arguments(step.fqn, step.arguments)
+                except BaseException:
+                    if metrics is not None:
+                        metrics.record(step.section_name, step.fqn.__name__, time.perf_counter() - st,
+                                       step.size_bytes, success=False)
+                    raise
+                if metrics is not None:
+                    metrics.record(step.section_name, step.fqn.__name__, time.perf_counter() - st, step.size_bytes)
+                    metrics.report_if_due()
+                self.mark_done(step_number)
+            logging.info("Reached end of plan")
+        except (Exception, KeyboardInterrupt) as e:
+            logging.critical("Encountered exception running step {}: {}".format(step_number, repr(e)))
+            logging.critical("Progress is saved in {}, run it again to resume".format(self.path))
+            exit()
+        finally:
+            if metrics is not None:
+                metrics.report()
@@ -0,0 +1,129 @@
+import logging
+import os
+import shutil
+import statistics
+import typing
+
+# The transfer timeout of a file is the time it would take at MIN_BYTES_PER_SECOND plus MIN_TRANSFER_SECONDS (for
+# setting up the transfer), as Rucio does for downloads with a minimum transfer speed. Files of unknown size get
+# DEFAULT_TRANSFER_TIMEOUT.
+MIN_BYTES_PER_SECOND = 1024**2
+MIN_TRANSFER_SECONDS = 60
+DEFAULT_TRANSFER_TIMEOUT = 3600
+
+# subdirectory of a download's base directory that its speculative copies are downloaded to
+SPECULATIVE_DIRECTORY = '.speculative'
+
+
+def get_transfer_timeout(size_bytes: int = None, min_bytes_per_second: float = MIN_BYTES_PER_SECOND,
+                         min_seconds: int = MIN_TRANSFER_SECONDS) -> int:
+    """ Get the timeout of a transfer of a file from its size.
+
+    :param size_bytes: the size of the file (DEFAULT_TRANSFER_TIMEOUT is returned if None)
+    :param min_bytes_per_second: the slowest rate the transfer is allowed to run at
+    :param min_seconds: the time allowed on top for setting up the transfer
+    :return: the timeout in seconds
+    """
+    if size_bytes is None:
+        return DEFAULT_TRANSFER_TIMEOUT
+    return int(min_seconds + size_bytes / min_bytes_per_second)
+
+
+class StragglerPolicy:
+    """ Detects transfer steps running well below the rate observed for the others, and decides which to re-issue.
+
+    The rate of each transfer step (its bytes over its wall time) is recorded when it finishes. Once enough have been
+    recorded, a step is a straggler if it has been running for more than slowdown times as long as it would take at
+    the median rate (and at least min_seconds). Steps of unknown size are never stragglers.
+    """
+    def __init__(self, slowdown: float = 4., min_seconds: float = 30., min_samples: int = 5,
+                 max_speculative: int = 4, check_interval: float = 1.):
+        """
+        :param slowdown: how many times longer than expected a step must take to be a straggler
+        :param min_seconds: the minimum time a step must take to be a straggler
+        :param min_samples: the number of finished steps needed to know the median rate
+        :param max_speculative: the maximum number of speculative copies of steps in flight at once
+        :param check_interval: seconds between checks of whether a step in flight has become a straggler
+        """
+        self.slowdown = slowdown
+        self.min_seconds = min_seconds
+        self.min_samples = min_samples
+        self.max_speculative = max_speculative
+        self.check_interval = check_interval
+        self.rates = []
+        self.n_stragglers = 0
+        self.n_speculative_wins = 0
+
+    def record(self, size_bytes: int, seconds: float) -> None:
+        """ Record a finished transfer step. """
+        if size_bytes and seconds > 0:
+            self.rates.append(size_bytes / seconds)
+
+    @property
+    def median_rate(self) -> typing.Union[None, float]:
+        """ The median rate (bytes/s) of the finished transfer steps, or None if too few have finished. """
+        if len(self.rates) < self.min_samples:
+            return None
+        return statistics.median(self.rates)
+
+    def is_straggler(self, size_bytes: int, seconds: float) -> bool:
+        """ Check if a transfer step has been running for long enough to be a straggler.
+
+        :param size_bytes: the number of bytes the step transfers
+        :param seconds: the time it has been running for
+        """
+        median_rate = self.median_rate
+        if not size_bytes or median_rate is None or seconds < self.min_seconds:
+            return False
+        return seconds > self.slowdown * size_bytes / median_rate
+
+
+def make_speculative_items(items: typing.List[typing.Dict[str, typing.Any]],
+                           replicas: typing.Dict[str, typing.List[str]]) -> typing.List[typing.Dict[str, typing.Any]]:
+    """ Make the items of a speculative copy of a download, each downloaded to the speculative subdirectory of its base
+    directory and, where its file has more than one replica, from a replica other than the first listed (which a
+    download tries first).
+
+    :param items: the items of the download
+    :param replicas: mapping of file DID to the RSEs holding a replica of it, in the order they are listed
+    """
+    speculative_items = []
+    for item in items:
+        speculative_item = dict(item, base_dir=os.path.join(item.get('base_dir', '.'), SPECULATIVE_DIRECTORY))
+        other_rses = [rse for rse in replicas.get(item['did'], [])[1:] if rse != item.get('rse')]
+        if other_rses:
+            speculative_item['rse'] = other_rses[0]
+        speculative_items.append(speculative_item)
+    return speculative_items
+
+
+def keep_speculative_files(items: typing.List[typing.Dict[str, typing.Any]]) -> None:
+    """ Move the files downloaded by a speculative copy of a download to where the download would have put them. """
+    for item in items:
+        name = item['did'].split(':')[1]
+        speculative_path = os.path.join(item.get('base_dir', '.'), SPECULATIVE_DIRECTORY, name)
+        if os.path.exists(speculative_path):
+            os.replace(speculative_path, os.path.join(item.get('base_dir', '.'), name))
+
+
+def remove_abandoned_files(items: typing.List[typing.Dict[str, typing.Any]], original_abandoned: bool,
+                           stray_paths: typing.Set[str] = frozenset()) -> None:
+    """ Remove what the losing copy of a download left behind, once it has finished and the plan has run.
+
+    The speculative subdirectories are always removed. If the speculative copy won, the original copy may have
+    downloaded a file after the speculative copy's file was moved into place and renamed, so that file is removed too
+    (if it is one that shouldn't be there once the plan has run).
+
+    :param items: the items of the (original) download
+    :param original_abandoned: whether the speculative copy won, so that the original copy was abandoned
+    :param stray_paths: paths that shouldn't exist once the plan has run (e.g. the sources of renames)
+    """
+    for item in items:
+        base_dir = item.get('base_dir', '.')
+        if original_abandoned:
+            path = os.path.join(base_dir, item['did'].split(':')[1])
+            for abandoned_path in (path + '.part', path if path in stray_paths else None):
+                if abandoned_path and os.path.isfile(abandoned_path):
+                    logging.debug("Removing {} left by an abandoned download".format(abandoned_path))
+                    os.remove(abandoned_path)
+        shutil.rmtree(os.path.join(base_dir, SPECULATIVE_DIRECTORY), ignore_errors=True)
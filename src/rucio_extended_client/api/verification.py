@@ -0,0 +1,36 @@
+import logging
+
+from rucio_extended_client.api.clients import get_client
+from rucio_extended_client.common.checksum import calculate_dir_checksum, get_dir_checksum_algorithm
+from rucio_extended_client.common.exceptions import ChecksumVerificationError
+
+
+def verify_dir_checksum(scope: str, name: str, metadata_plugin: str, hierarchy_key: str, path: str = None,
+                        jobs: int = 1) -> None:
+    """ Verify the checksum of a downloaded directory against that in its root container's metadata (skipping the
+    verification, with a warning, if the metadata has no checksum).
+
+    :param scope: the scope of the root container
+    :param name: the name of the root container
+    :param metadata_plugin: the metadata plugin holding the hierarchy metadata
+    :param hierarchy_key: metadata key holding the hierarchy metadata
+    :param path: the directory downloaded to (default: the name of the root container)
+    :param jobs: the number of processes to hash files with
+    """
+    metadata = get_client('DIDClient').get_metadata(scope=scope, name=name, plugin=metadata_plugin)
+    if 'dir_checksum' not in metadata[hierarchy_key]:
+        logging.warning("dir_checksum not in container metadata, skipping checksum verification")
+        return
+    logging.info("dir_checksum key found in metadata")
+    dir_checksum = metadata[hierarchy_key]['dir_checksum']
+    if dir_checksum is None:
+        logging.warning("dir_checksum is Nonetype, skipping checksum verification")
+        return
+    algorithm = get_dir_checksum_algorithm(metadata[hierarchy_key])
+    logging.info("verifying checksum ({})".format(algorithm))
+    this_dir_checksum = calculate_dir_checksum(path or name, algorithm=algorithm, jobs=jobs)
+    if dir_checksum != this_dir_checksum:
+        logging.critical("Checksum verification failed")
+        raise ChecksumVerificationError("Directory checksum does not match: {}!={}".format(
+            dir_checksum, this_dir_checksum))
+    logging.info("Checksum verification passed")
@@ -5,12 +5,19 @@ import configparser
 import logging
 import os
 
-from dirhash import dirhash
-from rucio.client.didclient import DIDClient
-
+from rucio_extended_client.common.checksum import DEFAULT_DIR_CHECKSUM_ALGORITHM, DIR_CHECKSUM_ALGORITHMS
+from rucio_extended_client.common.compression import ALGORITHMS, CompressionPolicy
 from rucio_extended_client.common.exceptions import ArgumentError, ConfigError, UnknownMethod
-from rucio_extended_client.api.plan import UploadPlanMetadata, UploadPlanNative, DownloadPlanMetadata, \
-    DownloadPlanNative
+from rucio_extended_client.api.manifest import Manifest
+from rucio_extended_client.api.metrics import PlanMetrics
+from rucio_extended_client.api.planfile import print_summary
+from rucio_extended_client.api.runners import AsyncPlanRunner, HybridPlanRunner
+from rucio_extended_client.api.store import PlanStore, is_plan_store_path
+from rucio_extended_client.api.stragglers import StragglerPolicy
+from rucio_extended_client.api.verification import verify_dir_checksum
+
+# The plans (and modules using them) are imported by the subcommands that need them, and Rucio, treelib and dirhash
+# only when used, so that every command starts quickly (see test/benchmarks/startup_benchmark.py).
 
 
 class Directory:
@@ -24,7 +31,176 @@ class Directory:
         self.directory_parser_subparsers = directory_parser.add_subparsers(help="directory based operations",
                                                                            dest='subcommand')
         self._add_download_arguments()
+        self._add_download_batch_arguments()
+        self._add_du_arguments()
+        self._add_ls_arguments()
         self._add_upload_arguments()
+        self._add_upload_batch_arguments()
+        self._add_watch_arguments()
+
+    def _set_logging(self, args, level=logging.INFO):
+        if args.v:
+            logging.basicConfig(
+                level=logging.DEBUG,
+                format="%(asctime)s [%(name)s] %(module)10s %(levelname)5s %(process)d\t%(message)s")
+        else:
+            logging.basicConfig(
+                level=level,
+                format="%(asctime)s [%(name)s] %(module)10s %(levelname)5s %(process)d\t%(message)s")
+
+    def _read_batch_list(self, path):
+        """ Read a batch list, one item per line with whitespace separated fields (blank lines and lines starting
+        with # are ignored).
+        """
+        if not path or not os.path.isfile(path):
+            raise ArgumentError("Batch list has not been set or does not exist")
+        with open(path, 'r') as fi:
+            return [line.split() for line in fi if line.strip() and not line.lstrip().startswith('#')]
+
+    def _add_manifest_arguments(self, parser):
+        parser.add_argument('path', help="path relative to root container", type=str, nargs='?', default='')
+        parser.add_argument('-c', help="path to configuration file", default="/usr/local/etc/config.ini", type=str)
+        parser.add_argument('-v', help="verbose?", action='store_true')
+        parser.add_argument('--cache', help="path to cached manifest (created if it doesn't exist)", type=str)
+        parser.add_argument('--name', help="name", type=str)
+        parser.add_argument('--refresh', help="refresh cached manifest?", action='store_true')
+        parser.add_argument('--scope', help="scope", type=str)
+
+    def _add_batch_arguments(self, parser):
+        parser.add_argument('--max-items-per-call', help="maximum number of DIDs or attachments in each coalesced "
+                                                         "catalog call", type=int, default=1000)
+
+    def _add_compression_arguments(self, parser):
+        parser.add_argument('--compress', help="compress files worth compressing before uploading them with this "
+                                               "algorithm", choices=ALGORITHMS)
+        parser.add_argument('--compress-min-bytes', help="only compress files of at least this many bytes", type=int,
+                            default=1024**2)
+        parser.add_argument('--compress-min-ratio', help="only compress files estimated to compress by at least this "
+                                                         "ratio", type=float, default=1.5)
+        parser.add_argument('--staging-dir', help="directory to write compressed files to before uploading them "
+                                                  "(default: in the system temporary directory)", type=str)
+
+    def _get_compression(self, args):
+        """ Get a compression policy if compression has been requested, otherwise None. """
+        if not args.compress:
+            return None
+        return CompressionPolicy(algorithm=args.compress, min_bytes=args.compress_min_bytes,
+                                 min_ratio=args.compress_min_ratio, staging_directory=args.staging_dir)
+
+    def _add_rse_arguments(self, parser):
+        parser.add_argument('--consolidate-rse', help="RSE expression for the root container rule, to consolidate "
+                                                      "the upload onto (default: the RSEs uploaded to)", type=str)
+        parser.add_argument('--rse', help="RSE to upload to, optionally as RSE:weight (can be repeated to stripe "
+                                          "uploads across RSEs in proportion to their weights)", action='append')
+
+    def _parse_rses(self, values):
+        """ Parse RSEs given as RSE[:weight] into the RSE if there is only one without a weight, otherwise a mapping
+        of RSE to weight.
+        """
+        if len(values) == 1 and ':' not in values[0]:
+            return values[0]
+        rses = {}
+        for value in values:
+            rse, _, weight = value.partition(':')
+            try:
+                rses[rse] = float(weight) if weight else 1.
+            except ValueError:
+                raise ArgumentError("weight of RSE {} is not a number".format(rse))
+            if rses[rse] <= 0:
+                raise ArgumentError("weight of RSE {} must be positive".format(rse))
+        return rses
+
+    def _add_describe_arguments(self, parser):
+        parser.add_argument('--bandwidth', help="bandwidth (MiB/s) to estimate the transfer time at in the plan "
+                                                "summary", type=float, default=100)
+        parser.add_argument('--full-plan', help="list every step of the plan instead of a summary?",
+                            action='store_true')
+        parser.add_argument('--page', help="only list this page of steps (starting at 1) with --full-plan", type=int)
+        parser.add_argument('--page-size', help="number of steps per page with --full-plan", type=int, default=100)
+
+    def _describe_plan(self, plan, args):
+        if not args.no_optimize:        # so that the plan described is the plan that is run (or saved)
+            plan.optimize()
+        plan.describe(full=args.full_plan, page=args.page, page_size=args.page_size,
+                      bandwidth=args.bandwidth * 1024**2)
+
+    def _add_execution_arguments(self, parser):
+        parser.add_argument('--catalog-concurrency', help="maximum catalog calls in flight with --executor async or "
+                                                          "hybrid", type=int, default=64)
+        parser.add_argument('--executor', help="how to run the plan", choices=['serial', 'async', 'hybrid'],
+                            default='serial')
+        parser.add_argument('--local-concurrency', help="maximum local operations in flight with --executor async or "
+                                                        "hybrid", type=int, default=16)
+        parser.add_argument('--no-optimize', help="run the plan as it is, without removing redundant steps or "
+                                                  "coalescing catalog calls?", action='store_true')
+        parser.add_argument('--processes', help="number of hashing processes with --executor hybrid (default: number "
+                                                "of CPUs)", type=int)
+        parser.add_argument('--save-plan', help="save the plan to this path instead of running it (as a SQLite plan "
+                                                "store if it ends in .db, .sqlite or .sqlite3)", type=str)
+        parser.add_argument('--speculate', help="with --executor async or hybrid, detect transfers running well below "
+                                                "the rate of the others and run a speculative copy of straggling "
+                                                "downloads from another replica?", action='store_true')
+        parser.add_argument('--straggler-slowdown', help="how many times longer than expected at the median rate a "
+                                                         "transfer must take to be a straggler with --speculate",
+                            type=float, default=4.)
+        parser.add_argument('--transfer-concurrency', help="maximum transfers in flight with --executor async or "
+                                                           "hybrid", type=int, default=4)
+
+    def _run_plan(self, plan, args, root_directory=None):
+        """ Run (or save) a plan, returning the async or hybrid runner that ran it, if any. """
+        if args.save_plan:
+            plan.save(args.save_plan)
+            return None
+        plan.metrics = self._get_metrics(args)
+        concurrency = {
+            'catalog': args.catalog_concurrency,
+            'transfer': args.transfer_concurrency,
+            'local': args.local_concurrency
+        }
+        stragglers = StragglerPolicy(slowdown=args.straggler_slowdown) if args.speculate else None
+        if args.executor == 'async':
+            runner = AsyncPlanRunner(plan, concurrency=concurrency, stragglers=stragglers)
+        elif args.executor == 'hybrid':
+            runner = HybridPlanRunner(plan, concurrency=concurrency, n_processes=args.processes,
+                                      root_directory=root_directory, stragglers=stragglers)
+        else:
+            plan.run(dry_run=args.dry_run, optimize=False)
+            return None
+        runner.run(dry_run=args.dry_run)
+        return runner
+
+    def _run_plan_store(self, args):
+        """ Run a plan store as it is, a page of steps at a time (so it is never loaded into memory). """
+        if args.executor != 'serial':
+            logging.warning("Plan stores are run serially, ignoring --executor {}".format(args.executor))
+        with PlanStore(args.p) as store:
+            if store.get_attributes().get('root_directory') and store.count(section_name='add_metadata', is_done=False):
+                raise ArgumentError("The directory checksum of this plan is calculated while uploading, so it can only "
+                                    "be resumed from a plan file with --executor hybrid")
+            print_summary(store.summarise(), bandwidth=args.bandwidth * 1024**2)
+            store.run(dry_run=args.dry_run, metrics=self._get_metrics(args))
+
+    def _add_du_arguments(self):
+        du_parser = self.directory_parser_subparsers.add_parser("du")
+        self._add_manifest_arguments(du_parser)
+
+    def _add_ls_arguments(self):
+        ls_parser = self.directory_parser_subparsers.add_parser("ls")
+        self._add_manifest_arguments(ls_parser)
+        ls_parser.add_argument('-l', help="long listing?", action='store_true')
+
+    def _add_metrics_arguments(self, parser):
+        parser.add_argument('--metrics-interval', help="seconds between periodic metrics reports", type=float,
+                            default=60)
+        parser.add_argument('--metrics-json', help="path to write JSON run report to", type=str)
+        parser.add_argument('--metrics-prometheus', help="path to write Prometheus textfile run report to", type=str)
+
+    def _get_metrics(self, args):
+        """ Get an instance of PlanMetrics if a report has been requested, otherwise None. """
+        if args.metrics_json or args.metrics_prometheus:
+            return PlanMetrics(json_path=args.metrics_json, prometheus_path=args.metrics_prometheus,
+                               report_interval=args.metrics_interval)
+        return None
 
     def _add_download_arguments(self):
         download_parser = self.directory_parser_subparsers.add_parser("download")
@@ -34,9 +210,41 @@ class Directory:
         download_parser.add_argument('-p', help="path to download plan", type=str)
         download_parser.add_argument('-v', help="verbose?", action='store_true')
         download_parser.add_argument('--dry-run', help="dry run?", action='store_true')
+        download_parser.add_argument('--exclude', help="don't download paths matching this glob (relative to root, "
+                                                       "can be repeated)", action='append')
+        download_parser.add_argument('--include', help="only download files matching this glob (relative to root, "
+                                                       "can be repeated)", action='append')
         download_parser.add_argument('--name', help="name", type=str)
         download_parser.add_argument('--scope', help="scope", type=str)
         download_parser.add_argument('--skip-checksum', help="skip checksum?", action='store_true')
+        download_parser.add_argument('--skip-existing', help="only download files that are missing locally or don't "
+                                                             "match the catalogue?", action='store_true')
+        download_parser.add_argument('--subpath', help="only download this path (relative to root)", type=str)
+        download_parser.add_argument('--threads', help="number of threads to download each batch of files with",
+                                     type=int, default=4)
+        self._add_describe_arguments(download_parser)
+        self._add_execution_arguments(download_parser)
+        self._add_metrics_arguments(download_parser)
+
+    def _add_download_batch_arguments(self):
+        download_batch_parser = self.directory_parser_subparsers.add_parser("download-batch")
+        download_batch_parser.add_argument('-c', help="path to configuration file", default="/usr/local/etc/config.ini",
+                                           type=str)
+        download_batch_parser.add_argument('-l', help="path to list of [scope:]name, one per line", type=str)
+        download_batch_parser.add_argument('-o', help="overwrite existing directories if they exist",
+                                           action='store_true')
+        download_batch_parser.add_argument('-v', help="verbose?", action='store_true')
+        download_batch_parser.add_argument('--dry-run', help="dry run?", action='store_true')
+        download_batch_parser.add_argument('--scope', help="scope of names listed without one", type=str)
+        download_batch_parser.add_argument('--skip-checksum', help="skip checksum?", action='store_true')
+        download_batch_parser.add_argument('--skip-existing', help="only download files that are missing locally or "
+                                                                   "don't match the catalogue?", action='store_true')
+        download_batch_parser.add_argument('--threads', help="number of threads to download each batch of files "
+                                                             "with", type=int, default=4)
+        self._add_batch_arguments(download_batch_parser)
+        self._add_describe_arguments(download_batch_parser)
+        self._add_execution_arguments(download_batch_parser)
+        self._add_metrics_arguments(download_batch_parser)
 
     def _add_upload_arguments(self):
         upload_parser = self.directory_parser_subparsers.add_parser("upload")
@@ -46,34 +254,79 @@ class Directory:
         upload_parser.add_argument('-n', help="root container name of upload", type=str)
         upload_parser.add_argument('-p', help="path to upload plan", type=str)
         upload_parser.add_argument('-v', help="verbose?", action='store_true')
+        upload_parser.add_argument('--deferred-registration', help="upload every file before registering any, "
+                                   "then register them in bulk?", action='store_true')
+        upload_parser.add_argument('--dir-checksum-algorithm', help="algorithm to calculate the directory "
+                                   "checksum with (recorded with it)", choices=DIR_CHECKSUM_ALGORITHMS,
+                                   default=DEFAULT_DIR_CHECKSUM_ALGORITHM)
         upload_parser.add_argument('--dry-run', help="dry run?", action='store_true')
         upload_parser.add_argument('--lifetime', help="rule lifetime for root container", type=int, default=3600)
-        upload_parser.add_argument('--rse', help="RSE to upload to", type=str)
         upload_parser.add_argument('--scope', help="scope", type=str)
         upload_parser.add_argument('--skip-checksum', help="skip checksum?", action='store_true')
+        self._add_compression_arguments(upload_parser)
+        self._add_rse_arguments(upload_parser)
+        self._add_describe_arguments(upload_parser)
+        self._add_execution_arguments(upload_parser)
+        self._add_metrics_arguments(upload_parser)
 
-    def download(self, args):
-        """ Download directory. """
-        if args.v:
-            logging.basicConfig(
-                level=logging.DEBUG,
-                format="%(asctime)s [%(name)s] %(module)10s %(levelname)5s %(process)d\t%(message)s")
-        else:
-            logging.basicConfig(
-                level=logging.INFO,
-                format="%(asctime)s [%(name)s] %(module)10s %(levelname)5s %(process)d\t%(message)s")
+    def _add_upload_batch_arguments(self):
+        upload_batch_parser = self.directory_parser_subparsers.add_parser("upload-batch")
+        upload_batch_parser.add_argument('-c', help="path to configuration file", default="/usr/local/etc/config.ini",
+                                         type=str)
+        upload_batch_parser.add_argument('-l', help="path to list of directories to upload, one per line, each "
+                                                    "optionally followed by its root container name", type=str)
+        upload_batch_parser.add_argument('-v', help="verbose?", action='store_true')
+        upload_batch_parser.add_argument('--deferred-registration', help="upload every file before registering "
+                                         "any, then register them in bulk?", action='store_true')
+        upload_batch_parser.add_argument('--dir-checksum-algorithm', help="algorithm to calculate the directory "
+                                         "checksum with (recorded with it)", choices=DIR_CHECKSUM_ALGORITHMS,
+                                         default=DEFAULT_DIR_CHECKSUM_ALGORITHM)
+        upload_batch_parser.add_argument('--dry-run', help="dry run?", action='store_true')
+        upload_batch_parser.add_argument('--lifetime', help="rule lifetime for root containers", type=int,
+                                         default=3600)
+        upload_batch_parser.add_argument('--scope', help="scope", type=str)
+        upload_batch_parser.add_argument('--skip-checksum', help="skip checksum?", action='store_true')
+        self._add_compression_arguments(upload_batch_parser)
+        self._add_rse_arguments(upload_batch_parser)
+        self._add_batch_arguments(upload_batch_parser)
+        self._add_describe_arguments(upload_batch_parser)
+        self._add_execution_arguments(upload_batch_parser)
+        self._add_metrics_arguments(upload_batch_parser)
 
-        if not args.c or not os.path.isfile(args.c):
-            raise ArgumentError("Configuration file has not been set or does not exist")
+    def _add_watch_arguments(self):
+        watch_parser = self.directory_parser_subparsers.add_parser("watch")
+        watch_parser.add_argument('-c', help="path to configuration file", default="/usr/local/etc/config.ini",
+                                  type=str)
+        watch_parser.add_argument('-d', help="directory to watch (previously uploaded)", type=str)
+        watch_parser.add_argument('-n', help="root container name of upload", type=str)
+        watch_parser.add_argument('-v', help="verbose?", action='store_true')
+        watch_parser.add_argument('--batch-seconds', help="seconds to wait for more files once a file is ready, to "
+                                                          "ingest them together", type=float, default=1)
+        watch_parser.add_argument('--dry-run', help="dry run?", action='store_true')
+        watch_parser.add_argument('--exclude', help="don't ingest files matching this glob (relative to root, can be "
+                                                    "repeated)", action='append')
+        watch_parser.add_argument('--include', help="only ingest files matching this glob (relative to root, can be "
+                                                    "repeated)", action='append')
+        watch_parser.add_argument('--max-batch-files', help="maximum number of files in each micro-batch", type=int,
+                                  default=1000)
+        watch_parser.add_argument('--max-retry-seconds', help="maximum seconds to wait before retrying a failed "
+                                                              "micro-batch", type=float, default=300)
+        watch_parser.add_argument('--poll-interval', help="seconds between scans of the directory when polling",
+                                  type=float, default=5)
+        watch_parser.add_argument('--polling', help="poll for changes instead of using inotify?", action='store_true')
+        watch_parser.add_argument('--retry-seconds', help="seconds to wait before retrying a failed micro-batch "
+                                                          "(doubled after each consecutive failure)", type=float,
+                                  default=1)
+        watch_parser.add_argument('--rse', help="RSE to upload to", type=str)
+        watch_parser.add_argument('--scope', help="scope", type=str)
+        watch_parser.add_argument('--settle-seconds', help="seconds a file must be unchanged for before it is "
+                                                           "ingested", type=float, default=2)
 
-        if args.p:
-            if not os.path.isfile(args.p):
-                raise ArgumentError("Plan given but path does not exist")
-        else:
-            if not args.scope:
-                raise ArgumentError("scope has not been set")
-            if not args.name:
-                raise ArgumentError("name has not been set")
+    def _get_download_plan_cls(self, args):
+        """ Get the download plan class and its keyword arguments, the metadata plugin and the hierarchy key from the
+        configuration file.
+        """
+        from rucio_extended_client.api.plan import DownloadPlanMetadata, DownloadPlanNative
 
         config = configparser.ConfigParser()
         config.read(args.c)
@@ -100,53 +353,39 @@ class Directory:
                 raise UnknownMethod("method {} is not understood".format(method))
         except KeyError as e:
             raise ConfigError("Key {} does not exist".format(e))
+        return download_plan_cls, download_plan_kwargs, metadata_plugin, hierarchy_key
 
-        # either load or make plan
-        if args.p:
-            plan = download_plan_cls.load(args.p)
-        else:
-            plan = download_plan_cls.make_plan_from_did(
-                root_container_scope=args.scope, root_container_name=args.name, metadata_plugin=metadata_plugin,
-                clobber=args.o, show_tree=True, **download_plan_kwargs)
-
-        plan.describe()
-        plan.run(dry_run=args.dry_run)
-
-        # Verify directory checksum if requested.
-        if not args.skip_checksum and not args.dry_run:
-            # Get metadata of root container
-            did_client = DIDClient()
-            metadata = did_client.get_metadata(scope=args.scope, name=args.name, plugin=metadata_plugin)
-
-            # Check for dir_checksum key
-            if 'dir_checksum' in metadata[hierarchy_key]:
-                logging.info("dir_checksum key found in metadata")
-                dir_checksum = metadata[hierarchy_key]['dir_checksum']
-                if dir_checksum is None:
-                    logging.warning("dir_checksum is Nonetype, skipping checksum verification")
-                else:
-                    logging.info("verifying checksum")
-                    this_dir_checksum = dirhash(args.name, algorithm='md5', empty_dirs=True)
-                    try:
-                        assert dir_checksum == this_dir_checksum
-                    except AssertionError as e:
-                        logging.critical("Checksum verification failed")
-                        raise ChecksumVerificationError("Directory checksum does not match: {}!={}".format(
-                            dir_checksum, this_dir_checksum))
-                    logging.info("Checksum verification passed")
-            else:
-                logging.warning("dir_checksum not in container metadata, skipping checksum verification")
+    def _get_verification_jobs(self, args):
+        """ Get the number of processes to hash files with when verifying a directory checksum. """
+        return (args.processes or os.cpu_count() or 1) if args.executor == 'hybrid' else 1
 
-    def upload(self, args):
-        """ Upload directory. """
-        if args.v:
-            logging.basicConfig(
-                level=logging.DEBUG,
-                format="%(asctime)s [%(name)s] %(module)10s %(levelname)5s %(process)d\t%(message)s")
-        else:
-            logging.basicConfig(
-                level=logging.INFO,
-                format="%(asctime)s [%(name)s] %(module)10s %(levelname)5s %(process)d\t%(message)s")
+    def _append_verification_steps(self, plan, dids, metadata_plugin, hierarchy_key, args):
+        """ Append steps verifying the checksum of each downloaded directory to a plan that is saved rather than run,
+        so that whatever runs it (e.g. the final shard of a partitioned plan) verifies what was downloaded.
+        """
+        for scope, name in dids:
+            plan.append_step("verify_dir_checksum", fqn=verify_dir_checksum, arguments={
+                'scope': scope,
+                'name': name,
+                'metadata_plugin': metadata_plugin,
+                'hierarchy_key': hierarchy_key,
+                'jobs': self._get_verification_jobs(args)
+            })
+
+    def _verify_dir_checksums(self, plan, runner, dids, metadata_plugin, hierarchy_key, args):
+        """ Verify the checksum of each downloaded directory against that in its root container's metadata, unless
+        the plan has verified them itself.
+        """
+        if any(step.section_name == 'verify_dir_checksum' for step in plan.steps):
+            return
+        if runner is not None:
+            runner.wait_for_abandoned()     # so that abandoned downloads don't change what is verified
+        for scope, name in dids:
+            verify_dir_checksum(scope, name, metadata_plugin, hierarchy_key, jobs=self._get_verification_jobs(args))
+
+    def download(self, args):
+        """ Download directory. """
+        self._set_logging(args)
 
         if not args.c or not os.path.isfile(args.c):
             raise ArgumentError("Configuration file has not been set or does not exist")
@@ -154,21 +393,129 @@ class Directory:
         if args.p:
             if not os.path.isfile(args.p):
                 raise ArgumentError("Plan given but path does not exist")
-        elif args.d:
-            if not args.lifetime:
-                raise ArgumentError("lifetime has not been set")
-            if not args.rse:
-                raise ArgumentError("rse has not been set")
+        else:
             if not args.scope:
                 raise ArgumentError("scope has not been set")
-            if not os.path.isdir(args.d):
-                raise ArgumentError("Directory given but path does not exist")
-            if not args.n:
-                logging.info("No upload name set, using directory name {}".format(args.d))
-                args.n = args.d
+            if not args.name:
+                raise ArgumentError("name has not been set")
+            if args.o and args.skip_existing:
+                raise ArgumentError("overwrite and skip existing cannot both be set")
+
+        if args.p and is_plan_store_path(args.p):
+            self._run_plan_store(args)
+            return
+
+        download_plan_cls, download_plan_kwargs, metadata_plugin, hierarchy_key = self._get_download_plan_cls(args)
+
+        # either load or make plan
+        if args.p:
+            plan = download_plan_cls.load(args.p)
         else:
-            raise ArgumentError("Neither a directory or plan has been specified")
-            exit()
+            plan = download_plan_cls.make_plan_from_did(
+                root_container_scope=args.scope, root_container_name=args.name, metadata_plugin=metadata_plugin,
+                clobber=args.o, show_tree=True, subpath=args.subpath, include=args.include, exclude=args.exclude,
+                num_threads=args.threads, skip_existing=args.skip_existing, **download_plan_kwargs)
+
+        # Verify directory checksum if requested (only meaningful if the whole directory has been downloaded), by the
+        # plan itself if it is saved rather than run.
+        do_checksum = not args.skip_checksum
+        if args.subpath or args.include or args.exclude:
+            logging.warning("Partial download requested, skipping checksum verification")
+            do_checksum = False
+        elif do_checksum and args.save_plan and not args.p:
+            self._append_verification_steps(plan, [(args.scope, args.name)], metadata_plugin, hierarchy_key, args)
+
+        self._describe_plan(plan, args)
+        runner = self._run_plan(plan, args)
+
+        if do_checksum and not args.dry_run and not args.save_plan:
+            self._verify_dir_checksums(plan, runner, [(args.scope, args.name)], metadata_plugin, hierarchy_key, args)
+
+    def download_batch(self, args):
+        """ Download many directories, planned together and run as a single plan. """
+        from rucio_extended_client.api.batch import merge_plans
+
+        self._set_logging(args)
+
+        if not args.c or not os.path.isfile(args.c):
+            raise ArgumentError("Configuration file has not been set or does not exist")
+        if args.o and args.skip_existing:
+            raise ArgumentError("overwrite and skip existing cannot both be set")
+        dids = []
+        for fields in self._read_batch_list(args.l):
+            scope, _, name = fields[0].rpartition(':')
+            scope = scope or args.scope
+            if not scope:
+                raise ArgumentError("scope has not been set for {}".format(fields[0]))
+            dids.append((scope, name))
+
+        download_plan_cls, download_plan_kwargs, metadata_plugin, hierarchy_key = self._get_download_plan_cls(args)
+        plans = []
+        for scope, name in dids:
+            logging.info("Planning download of {}:{}".format(scope, name))
+            plans.append(download_plan_cls.make_plan_from_did(
+                root_container_scope=scope, root_container_name=name, metadata_plugin=metadata_plugin,
+                clobber=args.o, show_tree=False, num_threads=args.threads, skip_existing=args.skip_existing,
+                **download_plan_kwargs))
+        plan = merge_plans(plans, max_items_per_call=args.max_items_per_call)
+        if not args.skip_checksum and args.save_plan:
+            self._append_verification_steps(plan, dids, metadata_plugin, hierarchy_key, args)
+
+        self._describe_plan(plan, args)
+        runner = self._run_plan(plan, args)
+
+        if not args.skip_checksum and not args.dry_run and not args.save_plan:
+            self._verify_dir_checksums(plan, runner, dids, metadata_plugin, hierarchy_key, args)
+
+    def _get_manifest(self, args):
+        """ Get a manifest, either from the cache or from the hierarchy metadata. """
+        self._set_logging(args, level=logging.WARNING)
+
+        if args.cache and os.path.isfile(args.cache) and not args.refresh:
+            return Manifest.load(args.cache)
+
+        if not args.c or not os.path.isfile(args.c):
+            raise ArgumentError("Configuration file has not been set or does not exist")
+        if not args.scope:
+            raise ArgumentError("scope has not been set")
+        if not args.name:
+            raise ArgumentError("name has not been set")
+
+        config = configparser.ConfigParser()
+        config.read(args.c)
+        try:
+            manifest = Manifest.from_did(
+                root_container_scope=args.scope, root_container_name=args.name,
+                method=config['hierarchy']['METHOD'].lower(), hierarchy_key=config['hierarchy']['METADATA_KEY'],
+                metadata_plugin=config['general']['METADATA_PLUGIN'],
+                fallback_root_suffix=config['hierarchy.native']['ROOT_SUFFIX'],
+                fallback_path_delimiter=config['hierarchy.native']['PATH_DELIMITER'])
+        except KeyError as e:
+            raise ConfigError("Key {} does not exist".format(e))
+        if args.cache:
+            manifest.save(args.cache)
+        return manifest
+
+    def du(self, args):
+        """ Summarise the number of files and size of a path in a directory. """
+        manifest = self._get_manifest(args)
+        usage = manifest.du(args.path)
+        print("{}\t{} files\t{} directories\t{}".format(
+            usage['bytes'], usage['n_files'], usage['n_dirs'], usage['path'] or '.'))
+
+    def ls(self, args):
+        """ List a path in a directory. """
+        manifest = self._get_manifest(args)
+        for entry in manifest.ls(args.path):
+            name = os.path.basename(entry['path']) + ('/' if entry['type'] == 'dir' else '')
+            if args.l:
+                print("{}\t{}\t{}".format(entry['bytes'], entry.get('did', '-'), name))
+            else:
+                print(name)
+
+    def _get_upload_plan_cls(self, args):
+        """ Get the upload plan class and its keyword arguments from the configuration file. """
+        from rucio_extended_client.api.plan import UploadPlanMetadata, UploadPlanNative
 
         config = configparser.ConfigParser()
         config.read(args.c)
@@ -194,14 +541,137 @@ class Directory:
                 raise UnknownMethod("method {} is not understood".format(method))
         except KeyError as e:
             raise ConfigError("Key {} does not exist".format(e))
+        return upload_plan_cls, upload_plan_kwargs
 
-        # either load or make plan
+    def upload(self, args):
+        """ Upload directory. """
+        self._set_logging(args)
+
+        if not args.c or not os.path.isfile(args.c):
+            raise ArgumentError("Configuration file has not been set or does not exist")
+
+        if args.p:
+            if not os.path.isfile(args.p):
+                raise ArgumentError("Plan given but path does not exist")
+        elif args.d:
+            if not args.lifetime:
+                raise ArgumentError("lifetime has not been set")
+            if not args.rse:
+                raise ArgumentError("rse has not been set")
+            if not args.scope:
+                raise ArgumentError("scope has not been set")
+            if not os.path.isdir(args.d):
+                raise ArgumentError("Directory given but path does not exist")
+            if not args.n:
+                logging.info("No upload name set, using directory name {}".format(args.d))
+                args.n = args.d
+        else:
+            raise ArgumentError("Neither a directory or plan has been specified")
+            exit()
+
+        if args.p and is_plan_store_path(args.p):
+            self._run_plan_store(args)
+            return
+
+        upload_plan_cls, upload_plan_kwargs = self._get_upload_plan_cls(args)
+
+        # either load or make plan (the hybrid executor calculates the checksum while uploading, unless the plan is only
+        # saved, as it may be run later by another executor)
+        root_directory = None
         if args.d:
-            plan = upload_plan_cls.make_plan_from_directory(args.d.rstrip('/'), args.n, rse=args.rse, scope=args.scope,
-                                                            lifetime=args.lifetime, do_checksum=not args.skip_checksum,
+            if args.executor == 'hybrid' and not args.skip_checksum and not args.save_plan:
+                root_directory = args.d.rstrip('/')
+            plan = upload_plan_cls.make_plan_from_directory(args.d.rstrip('/'), args.n, rse=self._parse_rses(args.rse),
+                                                            scope=args.scope, lifetime=args.lifetime,
+                                                            do_checksum=not args.skip_checksum and not root_directory,
+                                                            consolidate_rse=args.consolidate_rse,
+                                                            compression=self._get_compression(args),
+                                                            dir_checksum_algorithm=args.dir_checksum_algorithm,
+                                                            deferred_registration=args.deferred_registration,
                                                             **upload_plan_kwargs)
+            plan.root_directory = root_directory        # kept if the plan is dumped, to finish the checksum on resume
         elif args.p:
             plan = upload_plan_cls.load(args.p)
+            if plan.root_directory and args.executor != 'hybrid' and any(
+                    step.section_name == 'add_metadata' and not step.is_done for step in plan.steps):
+                raise ArgumentError("The directory checksum of this plan is calculated while uploading, so it can only "
+                                    "be resumed with --executor hybrid")
+
+        self._describe_plan(plan, args)
+        self._run_plan(plan, args, root_directory=root_directory)
+
+    def upload_batch(self, args):
+        """ Upload many directories, planned together and run as a single plan. """
+        from rucio_extended_client.api.batch import merge_plans
+
+        self._set_logging(args)
+
+        if not args.c or not os.path.isfile(args.c):
+            raise ArgumentError("Configuration file has not been set or does not exist")
+        if not args.lifetime:
+            raise ArgumentError("lifetime has not been set")
+        if not args.rse:
+            raise ArgumentError("rse has not been set")
+        if not args.scope:
+            raise ArgumentError("scope has not been set")
+        directories = []
+        for fields in self._read_batch_list(args.l):
+            directory = fields[0].rstrip('/')
+            if not os.path.isdir(directory):
+                raise ArgumentError("Directory {} does not exist".format(directory))
+            directories.append((directory, fields[1] if len(fields) > 1 else directory))
+
+        # the directory checksums are calculated while planning, as the hybrid executor only calculates one
+        upload_plan_cls, upload_plan_kwargs = self._get_upload_plan_cls(args)
+        rse = self._parse_rses(args.rse)
+        compression = self._get_compression(args)
+        plans = []
+        for directory, name in directories:
+            logging.info("Planning upload of {} as {}".format(directory, name))
+            plans.append(upload_plan_cls.make_plan_from_directory(directory, name, rse=rse, scope=args.scope,
+                                                                  lifetime=args.lifetime,
+                                                                  do_checksum=not args.skip_checksum,
+                                                                  consolidate_rse=args.consolidate_rse,
+                                                                  compression=compression,
+                                                                  dir_checksum_algorithm=args.dir_checksum_algorithm,
+                                                                  deferred_registration=args.deferred_registration,
+                                                                  **upload_plan_kwargs))
+        plan = merge_plans(plans, max_items_per_call=args.max_items_per_call)
+
+        self._describe_plan(plan, args)
+        self._run_plan(plan, args)
 
-        plan.describe()
-        plan.run(dry_run=args.dry_run)
+    def watch(self, args):
+        """ Watch a previously uploaded directory, ingesting new files into its hierarchy as they are written. """
+        from rucio_extended_client.api.ingest import IncrementalIngest
+
+        self._set_logging(args)
+
+        if not args.c or not os.path.isfile(args.c):
+            raise ArgumentError("Configuration file has not been set or does not exist")
+        if not args.d or not os.path.isdir(args.d):
+            raise ArgumentError("Directory has not been set or does not exist")
+        if not args.rse:
+            raise ArgumentError("rse has not been set")
+        if not args.scope:
+            raise ArgumentError("scope has not been set")
+        if not args.n:
+            logging.info("No upload name set, using directory name {}".format(args.d))
+            args.n = args.d
+
+        config = configparser.ConfigParser()
+        config.read(args.c)
+        try:
+            ingest = IncrementalIngest(
+                args.d, root_container_scope=args.scope, root_container_name=args.n, rse=args.rse,
+                method=config['hierarchy']['METHOD'].lower(), hierarchy_key=config['hierarchy']['METADATA_KEY'],
+                metadata_plugin=config['general']['METADATA_PLUGIN'],
+                fallback_root_suffix=config['hierarchy.native']['ROOT_SUFFIX'],
+                fallback_path_delimiter=config['hierarchy.native']['PATH_DELIMITER'], include=args.include,
+                exclude=args.exclude)
+        except KeyError as e:
+            raise ConfigError("Key {} does not exist".format(e))
+        ingest.watch(settle_seconds=args.settle_seconds, batch_seconds=args.batch_seconds,
+                     max_batch_files=args.max_batch_files, poll_interval=args.poll_interval,
+                     use_inotify=not args.polling, dry_run=args.dry_run, retry_seconds=args.retry_seconds,
+                     max_retry_seconds=args.max_retry_seconds)
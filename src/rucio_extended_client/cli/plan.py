@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+
+from rucio_extended_client.common.exceptions import ArgumentError
+from rucio_extended_client.api.planfile import PlanFileReader, compact_plan_file, print_summary
+from rucio_extended_client.api.store import PlanStore, is_plan_store_path
+
+# Modules that import the Rucio clients (rucio_extended_client.api.plan and rucio_extended_client.api.partition) are
+# imported by the subcommands that need them, so that inspecting a saved plan doesn't import Rucio.
+
+
+class Plan:
+    """ Class for adding operations on saved plans. """
+    def __init__(self):
+        pass
+
+    def add_to_argparse(self, subparsers):
+        """ Add arguments to plan based operations to argparse"""
+        plan_parser = subparsers.add_parser("plan")
+        self.plan_parser_subparsers = plan_parser.add_subparsers(help="plan based operations", dest='subcommand')
+        self._add_compact_arguments()
+        self._add_grep_arguments()
+        self._add_partition_arguments()
+        self._add_pending_arguments()
+        self._add_query_arguments()
+        self._add_run_shard_arguments()
+        self._add_shard_status_arguments()
+        self._add_stats_arguments()
+
+    def _add_compact_arguments(self):
+        compact_parser = self.plan_parser_subparsers.add_parser("compact")
+        compact_parser.add_argument('-o', help="path to write the compacted plan to (default: in place)", type=str)
+        compact_parser.add_argument('-p', help="path to plan", type=str)
+
+    def _add_grep_arguments(self):
+        grep_parser = self.plan_parser_subparsers.add_parser("grep")
+        grep_parser.add_argument('pattern', help="regular expression to match against each step's JSON description",
+                                 type=str, nargs='?')
+        grep_parser.add_argument('-p', help="path to plan", type=str)
+        grep_parser.add_argument('--done', help="only steps that are done?", action='store_true')
+        grep_parser.add_argument('--full', help="print each step's JSON description?", action='store_true')
+        grep_parser.add_argument('--limit', help="maximum number of steps to list", type=int)
+        grep_parser.add_argument('--pending', help="only steps that are not done?", action='store_true')
+        grep_parser.add_argument('--section', help="only steps in this section", type=str)
+
+    def _add_partition_arguments(self):
+        partition_parser = self.plan_parser_subparsers.add_parser("partition")
+        partition_parser.add_argument('-n', help="number of transfer shards", type=int, default=2)
+        partition_parser.add_argument('-o', help="path prefix for the shards (default: plan path without .json)",
+                                      type=str)
+        partition_parser.add_argument('-p', help="path to plan", type=str)
+        partition_parser.add_argument('-v', help="verbose?", action='store_true')
+
+    def _add_pending_arguments(self):
+        pending_parser = self.plan_parser_subparsers.add_parser("pending")
+        pending_parser.add_argument('-p', help="path to plan", type=str)
+        pending_parser.add_argument('--count', help="only print the number of pending steps?", action='store_true')
+        pending_parser.add_argument('--full', help="print each step's JSON description?", action='store_true')
+        pending_parser.add_argument('--limit', help="maximum number of steps to list", type=int)
+
+    def _add_query_arguments(self):
+        query_parser = self.plan_parser_subparsers.add_parser("query")
+        query_parser.add_argument('-p', help="path to plan store", type=str)
+        query_parser.add_argument('--count', help="only print the number of matching steps?", action='store_true')
+        query_parser.add_argument('--done', help="only steps that are done?", action='store_true')
+        query_parser.add_argument('--function', help="only steps calling this function (e.g. upload)", type=str)
+        query_parser.add_argument('--limit', help="maximum number of steps to list", type=int)
+        query_parser.add_argument('--max-bytes', help="only steps of at most this many bytes", type=int)
+        query_parser.add_argument('--min-bytes', help="only steps of at least this many bytes", type=int)
+        query_parser.add_argument('--pending', help="only steps that are not done?", action='store_true')
+        query_parser.add_argument('--section', help="only steps in this section", type=str)
+
+    def _add_run_shard_arguments(self):
+        run_shard_parser = self.plan_parser_subparsers.add_parser("run-shard")
+        run_shard_parser.add_argument('-m', help="path to shard manifest", type=str)
+        run_shard_parser.add_argument('-s', help="name of shard to run", type=str)
+        run_shard_parser.add_argument('-v', help="verbose?", action='store_true')
+        run_shard_parser.add_argument('--dry-run', help="dry run?", action='store_true')
+        run_shard_parser.add_argument('--no-wait', help="fail rather than wait if the shards this one depends on "
+                                                        "are not done?", action='store_true')
+        run_shard_parser.add_argument('--poll-interval', help="seconds between checks of the shards this one depends "
+                                                              "on", type=float, default=10)
+
+    def _add_shard_status_arguments(self):
+        shard_status_parser = self.plan_parser_subparsers.add_parser("shard-status")
+        shard_status_parser.add_argument('-m', help="path to shard manifest", type=str)
+
+    def _add_stats_arguments(self):
+        stats_parser = self.plan_parser_subparsers.add_parser("stats")
+        stats_parser.add_argument('-p', help="path to plan or plan store", type=str)
+        stats_parser.add_argument('--bandwidth', help="bandwidth to estimate the transfer time at (MiB/s)",
+                                  type=float, default=100)
+
+    def _set_logging(self, args):
+        if args.v:
+            logging.basicConfig(
+                level=logging.DEBUG,
+                format="%(asctime)s [%(name)s] %(module)10s %(levelname)5s %(process)d\t%(message)s")
+        else:
+            logging.basicConfig(
+                level=logging.INFO,
+                format="%(asctime)s [%(name)s] %(module)10s %(levelname)5s %(process)d\t%(message)s")
+
+    def _get_plan_reader(self, args):
+        if not args.p or not os.path.isfile(args.p) or is_plan_store_path(args.p):
+            raise ArgumentError("Plan has not been set or does not exist (use query for plan stores)")
+        return PlanFileReader(args.p)
+
+    def _print_steps(self, steps, full=False, limit=None):
+        """ Print steps from PlanFileReader.iter_steps, one per line. """
+        for idx, (step_number, head, line) in enumerate(steps):
+            if limit is not None and idx >= limit:
+                break
+            if full:
+                print("{}\t{}".format(step_number, line.decode()))
+                continue
+            size_bytes = head['size_bytes'] if head['size_bytes'] is not None else '-'
+            print("{}\t{}\t{}\t{}\t{} items\t{} bytes".format(
+                step_number, head['section_name'], 'RAN' if head['is_done'] else 'RUN', head['function_name'],
+                head['n_items'], size_bytes))
+
+    def compact(self, args):
+        """ Drop the steps of a saved plan that are done, so it is quicker to load and resume. """
+        reader = self._get_plan_reader(args)
+        n_dropped = compact_plan_file(reader.path, args.o)
+        print("Dropped {} done steps, written to {}".format(n_dropped, args.o or args.p))
+
+    def grep(self, args):
+        """ List the steps of a saved plan matching a pattern, without loading the plan. """
+        if args.done and args.pending:
+            raise ArgumentError("done and pending cannot both be set")
+        reader = self._get_plan_reader(args)
+        self._print_steps(reader.iter_steps(
+            section_name=args.section, is_done=True if args.done else (False if args.pending else None),
+            pattern=args.pattern), full=args.full, limit=args.limit)
+
+    def partition(self, args):
+        """ Partition a saved plan into shards for running on several hosts. """
+        from rucio_extended_client.api import plan as plan_api
+        from rucio_extended_client.api.partition import save_partitioned_plan
+
+        self._set_logging(args)
+        if not args.p or not os.path.isfile(args.p):
+            raise ArgumentError("Plan has not been set or does not exist")
+        if args.n < 1:
+            raise ArgumentError("number of shards must be at least 1")
+        prefix = args.o or (args.p[:-len('.json')] if args.p.endswith('.json') else args.p)
+
+        manifest_path = save_partitioned_plan(plan_api.Plan.load(args.p), args.n, prefix)
+        print("Run each shard with: rucio-extended plan run-shard -m {} -s <shard>".format(manifest_path))
+
+    def pending(self, args):
+        """ List the steps of a saved plan that are still to run, without loading the plan. """
+        reader = self._get_plan_reader(args)
+        if args.count:
+            print(reader.summary['total']['n_steps'] - reader.summary['total']['n_done'])
+            return
+        self._print_steps(reader.iter_steps(is_done=False), full=args.full, limit=args.limit)
+
+    def query(self, args):
+        """ Query the steps of a plan store. """
+        if not args.p or not os.path.isfile(args.p) or not is_plan_store_path(args.p):
+            raise ArgumentError("Plan store has not been set or does not exist")
+        if args.done and args.pending:
+            raise ArgumentError("done and pending cannot both be set")
+
+        filters = {
+            'section_name': args.section,
+            'is_done': True if args.done else (False if args.pending else None),
+            'function_name': args.function,
+            'min_bytes': args.min_bytes,
+            'max_bytes': args.max_bytes
+        }
+        with PlanStore(args.p) as store:
+            if args.count:
+                print(store.count(**filters))
+                return
+            for step in store.query(limit=args.limit, **filters):
+                size_bytes = step['size_bytes'] if step['size_bytes'] is not None else '-'
+                print("{}\t{}\t{}\t{}\t{} items\t{} bytes".format(
+                    step['step_number'], step['section_name'], 'RAN' if step['is_done'] else 'RUN',
+                    step['function_name'], step['n_items'], size_bytes))
+
+    def run_shard(self, args):
+        """ Run a shard of a partitioned plan. """
+        from rucio_extended_client.api.partition import ShardRunner
+
+        self._set_logging(args)
+        if not args.m or not os.path.isfile(args.m):
+            raise ArgumentError("Shard manifest has not been set or does not exist")
+        if not args.s:
+            raise ArgumentError("shard has not been set")
+
+        ShardRunner(args.m, args.s, poll_interval=args.poll_interval).run(dry_run=args.dry_run,
+                                                                          wait=not args.no_wait)
+
+    def shard_status(self, args):
+        """ Show the progress of each shard of a partitioned plan. """
+        from rucio_extended_client.api.partition import ShardJournal
+
+        if not args.m or not os.path.isfile(args.m):
+            raise ArgumentError("Shard manifest has not been set or does not exist")
+
+        with open(args.m, 'r') as fi:
+            manifest = json.load(fi)
+        state = ShardJournal(manifest['journal_path']).read()
+        for shard in manifest['shards']:
+            shard_state = state.get(shard['name'], {'done_steps': set(), 'is_done': False, 'hosts': set()})
+            status = 'done' if shard_state['is_done'] else ('started' if shard_state['hosts'] else 'pending')
+            print("{}\t{}\t{}/{} steps\t{} bytes\t{}".format(
+                shard['name'], status, len(shard_state['done_steps']), shard['n_steps'], shard['size_bytes'],
+                ','.join(sorted(shard_state['hosts'])) or '-'))
+
+    def stats(self, args):
+        """ Summarise a saved plan (or plan store) per section, without loading the plan. """
+        if not args.p or not os.path.isfile(args.p):
+            raise ArgumentError("Plan has not been set or does not exist")
+        if is_plan_store_path(args.p):
+            with PlanStore(args.p) as store:
+                summary = store.summarise()
+        else:
+            summary = PlanFileReader(args.p).summary
+        print_summary(summary, bandwidth=args.bandwidth * 1024**2)
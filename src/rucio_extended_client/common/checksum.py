@@ -0,0 +1,145 @@
+import concurrent.futures
+import hashlib
+import logging
+import os
+import typing
+import zlib
+
+# the hashlib algorithms a directory checksum can be calculated with, and the one assumed for directories uploaded
+# without one recorded. md5 is much slower than sha1 or sha256 on CPUs with SHA extensions, and than blake2b on some
+# 64-bit CPUs without them.
+DIR_CHECKSUM_ALGORITHMS = ('blake2b', 'blake2s', 'md5', 'sha1', 'sha256', 'sha512')
+DEFAULT_DIR_CHECKSUM_ALGORITHM = 'md5'
+
+
+def adler32(path: str, chunk_size: int = 8*1024**2) -> str:
+    """ Calculate the adler32 checksum of a file, formatted as Rucio does.
+
+    :param path: the path of the file
+    :param chunk_size: the number of bytes to read at a time
+    :return: the checksum as a zero-padded hexadecimal string
+    """
+    checksum = 1
+    with open(path, 'rb') as fi:
+        for chunk in iter(lambda: fi.read(chunk_size), b''):
+            checksum = zlib.adler32(chunk, checksum)
+    return '{:08x}'.format(checksum & 0xffffffff)
+
+
+def file_checksums(path: str, chunk_size: int = 8*1024**2) -> typing.Dict[str, str]:
+    """ Calculate the checksums Rucio registers a file with (adler32 and md5), reading the file once.
+
+    :param path: the path of the file
+    :param chunk_size: the number of bytes to read at a time
+    :return: a dictionary of the adler32 and md5 checksums, formatted as Rucio does
+    """
+    checksum = 1
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fi:
+        for chunk in iter(lambda: fi.read(chunk_size), b''):
+            checksum = zlib.adler32(chunk, checksum)
+            md5.update(chunk)
+    return {'adler32': '{:08x}'.format(checksum & 0xffffffff), 'md5': md5.hexdigest()}
+
+
+def file_hash(path: str, algorithm: str = 'md5', chunk_size: int = 1024**2) -> str:
+    """ Calculate the hash of a file, as dirhash does for each file in a directory.
+
+    :param path: the path of the file
+    :param algorithm: the hashlib algorithm to use
+    :param chunk_size: the number of bytes to read at a time
+    :return: the hash as a hexadecimal string
+    """
+    hasher = hashlib.new(algorithm)
+    with open(path, 'rb') as fi:
+        for chunk in iter(lambda: fi.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def calculate_dir_checksum(root_directory: str, algorithm: str = DEFAULT_DIR_CHECKSUM_ALGORITHM, jobs: int = 1) -> str:
+    """ Calculate the checksum of a directory with dirhash.
+
+    :param root_directory: the directory
+    :param algorithm: the hashlib algorithm to use (see DIR_CHECKSUM_ALGORITHMS)
+    :param jobs: the number of processes to hash files with
+    :return: the checksum as a hexadecimal string
+    """
+    from dirhash import dirhash
+    return dirhash(root_directory, algorithm=algorithm, empty_dirs=True, jobs=jobs)
+
+
+def get_dir_checksum_algorithm(metadata_hierarchy: typing.Dict[str, typing.Any]) -> str:
+    """ Get the algorithm the directory checksum in a root container's hierarchy metadata was calculated with. """
+    return metadata_hierarchy.get('dir_checksum_algorithm') or DEFAULT_DIR_CHECKSUM_ALGORITHM
+
+
+def dir_checksum_from_file_hashes(root_directory: str, file_hashes: typing.Dict[str, str],
+                                  algorithm: str = 'md5') -> str:
+    """ Calculate the checksum of a directory from precomputed file hashes.
+
+    This gives the same result as dirhash(root_directory, algorithm, empty_dirs=True) but only walks the directory,
+    so that the (expensive) file hashes can be calculated elsewhere, e.g. in parallel with other work.
+
+    :param root_directory: the directory
+    :param file_hashes: mapping of file path (relative to root_directory) to its hash, for every file in the directory
+    :param algorithm: the hashlib algorithm used for the file hashes
+    :return: the checksum as a hexadecimal string
+    """
+    dir_hashes = {}
+    for root, dirs, files in os.walk(root_directory, topdown=False, followlinks=True):
+        relative_root = os.path.relpath(root, root_directory)
+        relative_root = '' if relative_root == '.' else relative_root
+        entry_descriptors = [
+            '\000'.join(sorted(['data:{}'.format(file_hashes[os.path.join(relative_root, fi)]), 'name:{}'.format(fi)]))
+            for fi in files
+        ] + [
+            '\000'.join(sorted(['dirhash:{}'.format(dir_hashes[os.path.join(relative_root, dir)]),
+                                 'name:{}'.format(dir)]))
+            for dir in dirs
+        ]
+        descriptor = '\000\000'.join(sorted(entry_descriptors))
+        dir_hashes[relative_root] = hashlib.new(algorithm, descriptor.encode('utf-8')).hexdigest()
+    return dir_hashes['']
+
+
+def is_file_up_to_date(path: str, size_bytes: int = None, checksum: str = None) -> bool:
+    """ Check if a local file exists and matches the catalogue size and adler32 checksum.
+
+    The (cheap) size comparison is made first, the checksum is only calculated if the sizes match.
+
+    :param path: the path of the local file
+    :param size_bytes: the expected size in bytes (not compared if None)
+    :param checksum: the expected adler32 checksum (not compared if None)
+    :return: True if the file exists and matches
+    """
+    try:
+        if size_bytes is not None and os.stat(path).st_size != size_bytes:
+            return False
+        if checksum is not None:
+            return adler32(path) == checksum.lower().zfill(8)
+        return os.path.isfile(path)
+    except OSError:
+        return False
+
+
+def find_up_to_date_files(expected: typing.Dict[str, typing.Tuple[int, str]], num_workers: int = 8) \
+        -> typing.Set[str]:
+    """ Find local files that already match the catalogue, checking in parallel.
+
+    :param expected: mapping of local path to a tuple of (size in bytes, adler32 checksum)
+    :param num_workers: the number of files to check concurrently
+    :return: the set of local paths that exist and match
+    """
+    up_to_date = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(is_file_up_to_date, path, size_bytes, checksum): path
+            for path, (size_bytes, checksum) in expected.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            if future.result():
+                up_to_date.add(futures[future])
+    logging.info("{} of {} files already exist locally and match the catalogue".format(
+        len(up_to_date), len(expected)))
+    return up_to_date
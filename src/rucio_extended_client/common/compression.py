@@ -0,0 +1,154 @@
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import typing
+
+from rucio_extended_client.common.exceptions import CompressionError
+
+ALGORITHMS = ('gzip', 'zstd')
+
+# default compression levels, favouring speed (compression shouldn't be slower than the network)
+DEFAULT_LEVELS = {
+    'gzip': 6,
+    'zstd': 3
+}
+
+# the directory compressed files are written to before being uploaded, if not set (local to the host planning)
+DEFAULT_STAGING_DIRECTORY = os.path.join(tempfile.gettempdir(), 'rucio-extended-staging')
+
+
+def _get_zstd():
+    """ Get a zstd module: compression.zstd from the standard library (Python 3.14+), otherwise zstandard. """
+    try:
+        from compression import zstd
+        return zstd
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        raise CompressionError("zstd compression needs Python 3.14 or later, or the zstandard package")
+
+
+def _check_algorithm(algorithm: str) -> None:
+    if algorithm not in ALGORITHMS:
+        raise CompressionError("compression algorithm {} is not understood (one of {})".format(
+            algorithm, ', '.join(ALGORITHMS)))
+
+
+def compress_bytes(data: bytes, algorithm: str, level: int = None) -> bytes:
+    """ Compress bytes in memory.
+
+    :param data: the bytes to compress
+    :param algorithm: the compression algorithm (gzip or zstd)
+    :param level: the compression level (a default favouring speed if not set)
+    :return: the compressed bytes
+    """
+    _check_algorithm(algorithm)
+    level = level or DEFAULT_LEVELS[algorithm]
+    if algorithm == 'gzip':
+        return gzip.compress(data, compresslevel=level)
+    zstd = _get_zstd()
+    if zstd.__name__ == 'zstandard':
+        return zstd.ZstdCompressor(level=level).compress(data)
+    return zstd.compress(data, level=level)
+
+
+def open_compressed(path: str, mode: str, algorithm: str, level: int = None) -> typing.BinaryIO:
+    """ Open a compressed file for streaming (binary) reads or writes.
+
+    :param path: the path of the file
+    :param mode: 'rb' or 'wb'
+    :param algorithm: the compression algorithm (gzip or zstd)
+    :param level: the compression level when writing (a default favouring speed if not set)
+    """
+    _check_algorithm(algorithm)
+    level = level or DEFAULT_LEVELS[algorithm]
+    if algorithm == 'gzip':
+        return gzip.open(path, mode, compresslevel=level)
+    zstd = _get_zstd()
+    if zstd.__name__ == 'zstandard':
+        return zstd.open(path, mode, cctx=zstd.ZstdCompressor(level=level) if 'w' in mode else None)
+    return zstd.open(path, mode, level=level) if 'w' in mode else zstd.open(path, mode)
+
+
+def compress_file(src: str, dst: str, algorithm: str, level: int = None, chunk_size: int = 8*1024**2) -> None:
+    """ Compress a file, streaming a chunk at a time. The compressed file only appears at dst once it is complete.
+
+    :param src: the path of the file to compress
+    :param dst: the path of the compressed file
+    :param algorithm: the compression algorithm (gzip or zstd)
+    :param level: the compression level (a default favouring speed if not set)
+    :param chunk_size: the number of bytes to read at a time
+    """
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    with open(src, 'rb') as fi, open_compressed(dst + '.part', 'wb', algorithm, level) as fo:
+        shutil.copyfileobj(fi, fo, chunk_size)
+    os.replace(dst + '.part', dst)
+
+
+def decompress_file(src: str, dst: str, algorithm: str, n_bytes: int = None, chunk_size: int = 8*1024**2) -> None:
+    """ Decompress a file, streaming a chunk at a time, then remove the compressed file. The decompressed file only
+    appears at dst once it is complete.
+
+    :param src: the path of the compressed file
+    :param dst: the path of the decompressed file
+    :param algorithm: the compression algorithm (gzip or zstd)
+    :param n_bytes: the expected size of the decompressed file in bytes (not checked if None)
+    :param chunk_size: the number of bytes to read at a time
+    """
+    with open_compressed(src, 'rb', algorithm) as fi, open(dst + '.part', 'wb') as fo:
+        shutil.copyfileobj(fi, fo, chunk_size)
+    decompressed_bytes = os.path.getsize(dst + '.part')
+    if n_bytes is not None and decompressed_bytes != n_bytes:
+        os.remove(dst + '.part')
+        raise CompressionError("Decompressed {} is {} bytes, expected {}".format(src, decompressed_bytes, n_bytes))
+    os.replace(dst + '.part', dst)
+    os.remove(src)
+
+
+class CompressionPolicy:
+    """ Decides which files to compress before uploading, and where to stage the compressed files.
+
+    A file is compressed if it is at least min_bytes and a sample from its start compresses by at least min_ratio, so
+    that files which are small or already compressed (e.g. images, or compressed archives) are uploaded as they are.
+    """
+    def __init__(self, algorithm: str = 'gzip', min_bytes: int = 1024**2, min_ratio: float = 1.5, level: int = None,
+                 staging_directory: str = None, sample_bytes: int = 1024**2):
+        """
+        :param algorithm: the compression algorithm (gzip or zstd)
+        :param min_bytes: only compress files of at least this many bytes
+        :param min_ratio: only compress files whose sample compresses by at least this ratio
+        :param level: the compression level (a default favouring speed if not set)
+        :param staging_directory: directory to write compressed files to before uploading them (a directory in the
+            system temporary directory if not set)
+        :param sample_bytes: the number of bytes from the start of each file to estimate the ratio from
+        """
+        _check_algorithm(algorithm)
+        if algorithm == 'zstd':
+            _get_zstd()                         # fail when planning rather than when running
+        self.algorithm = algorithm
+        self.min_bytes = min_bytes
+        self.min_ratio = min_ratio
+        self.level = level
+        self.staging_directory = staging_directory or DEFAULT_STAGING_DIRECTORY
+        self.sample_bytes = sample_bytes
+
+    def estimate_ratio(self, path: str, size: int = None) -> typing.Union[None, float]:
+        """ Estimate the compression ratio of a file if it is worth compressing.
+
+        :param path: the path of the file
+        :param size: the size of the file in bytes, if already known
+        :return: the estimated ratio of original to compressed size, or None if the file isn't worth compressing
+        """
+        size = os.path.getsize(path) if size is None else size
+        if size < self.min_bytes or size == 0:
+            return None
+        with open(path, 'rb') as fi:
+            sample = fi.read(self.sample_bytes)
+        ratio = len(sample) / max(1, len(compress_bytes(sample, self.algorithm, self.level)))
+        logging.debug("Estimated {} compression ratio of {} as {:.2f}".format(self.algorithm, path, ratio))
+        return ratio if ratio >= self.min_ratio else None
@@ -10,6 +10,12 @@ class ChecksumVerificationError(Exception):
         super().__init__(self.message)
 
 
+class CompressionError(Exception):
+    def __init__(self, message, **kwargs):
+        self.message = message
+        super().__init__(self.message)
+
+
 class ConfigError(Exception):
     def __init__(self, message, **kwargs):
         self.message = message
@@ -21,8 +27,22 @@ class DataFormatError(Exception):
         self.message = message
         super().__init__(self.message)
 
+
+class InjectedFailureError(Exception):
+    def __init__(self, message, **kwargs):
+        self.message = message
+        super().__init__(self.message)
+
+
+class ShardDependencyError(Exception):
+    def __init__(self, message, **kwargs):
+        self.message = message
+        super().__init__(self.message)
+
+
 class UnknownMethod(Exception):
     def __init__(self, message, **kwargs):
         self.message = message
         super().__init__(self.message)
 
+
@@ -0,0 +1,85 @@
+import fnmatch
+import typing
+
+
+class PathSelector:
+    """ Class for selecting a subset of paths from a hierarchy, relative to the root container. """
+    def __init__(self, subpath: str = None, include: typing.List[str] = None, exclude: typing.List[str] = None):
+        """
+        :param subpath: only select paths at or below this path (relative to the root container)
+        :param include: glob patterns (relative to the root container), of which a file must match at least one
+        :param exclude: glob patterns (relative to the root container), of which a path (and the directories above it)
+            must match none
+        """
+        self.subpath = subpath.strip('/') if subpath else None
+        self.include = list(include) if include else []
+        self.exclude = list(exclude) if exclude else []
+
+    @property
+    def is_selective(self):
+        return bool(self.subpath or self.include or self.exclude)
+
+    def _is_excluded(self, relative_path: str) -> bool:
+        """ Check if a path, or any directory above it, matches an exclude pattern. """
+        parts = relative_path.split('/')
+        return any(fnmatch.fnmatchcase('/'.join(parts[:idx]), pattern)
+                   for idx in range(1, len(parts) + 1) for pattern in self.exclude)
+
+    def _is_within_subpath(self, relative_path: str) -> bool:
+        if not self.subpath:
+            return True
+        return relative_path == self.subpath or relative_path.startswith(self.subpath + '/')
+
+    def is_file_selected(self, relative_path: str) -> bool:
+        """ Check if a file should be selected.
+
+        :param relative_path: path of the file relative to the root container
+        :return: True if the file is selected
+        """
+        if not self._is_within_subpath(relative_path):
+            return False
+        if self.include and not any(fnmatch.fnmatchcase(relative_path, pattern) for pattern in self.include):
+            return False
+        return not self._is_excluded(relative_path)
+
+    def is_collection_selected(self, relative_path: str) -> bool:
+        """ Check if a collection (directory) could contain selected files, i.e. if it is worth traversing.
+
+        A collection is worth traversing if it lies on the route to the subpath or is within it, and has not been
+        excluded in its entirety.
+
+        :param relative_path: path of the directory relative to the root container ('' for the root)
+        :return: True if the collection should be traversed
+        """
+        relative_path = relative_path.strip('/')
+        if not relative_path:
+            return True
+        if self._is_excluded(relative_path):
+            return False
+        if self.subpath:
+            return self._is_within_subpath(relative_path) or self.subpath.startswith(relative_path + '/')
+        return True
+
+    def is_file_directory_selected(self, relative_path: str) -> bool:
+        """ Check if files directly inside a directory could be selected, i.e. if it is worth listing its files.
+
+        :param relative_path: path of the directory relative to the root container ('' for the root)
+        :return: True if the files in this directory should be listed
+        """
+        relative_path = relative_path.strip('/')
+        if not self._is_within_subpath(relative_path):
+            return False
+        return not relative_path or not self._is_excluded(relative_path)
+
+    def is_directory_selected(self, relative_path: str) -> bool:
+        """ Check if a directory should be created locally in its own right, i.e. without a selected file inside it.
+
+        :param relative_path: path of the directory relative to the root container ('' for the root)
+        :return: True if the directory is selected
+        """
+        relative_path = relative_path.strip('/')
+        if self.include:
+            return False
+        if self.subpath and not self._is_within_subpath(relative_path):
+            return False
+        return not relative_path or not self._is_excluded(relative_path)
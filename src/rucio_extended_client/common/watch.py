@@ -0,0 +1,220 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+import typing
+
+# inotify event masks (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')        # wd, mask, cookie, len
+
+
+def _load_inotify() -> typing.Union[None, ctypes.CDLL]:
+    """ Get libc if it provides inotify, otherwise None. """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1') or not hasattr(libc, 'inotify_add_watch'):
+        return None
+    return libc
+
+
+def list_files(root_directory: str) -> typing.Iterator[str]:
+    """ List the paths of every file below a directory. """
+    for root, _, files in os.walk(root_directory, followlinks=True):
+        for fi in files:
+            yield os.path.join(root, fi)
+
+
+class InotifyWatcher:
+    """ Watches a directory tree for files that have been closed after writing (or moved in), using inotify.
+
+    Waiting for events costs nothing while the tree is idle. Directories created in the tree are watched as they appear
+    (and any files already in them reported), and the whole tree is rescanned if the kernel's event queue overflows.
+    """
+    def __init__(self, root_directory: str, libc: ctypes.CDLL = None):
+        """
+        :param root_directory: the directory to watch
+        :param libc: libc, if already loaded
+        """
+        self.root_directory = root_directory
+        self.libc = libc or _load_inotify()
+        if self.libc is None:
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}           # wd -> directory
+        self._rescanned = []        # files found while adding watches, reported by the next call to poll
+        self._add_watches(root_directory)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def _add_watches(self, directory: str) -> None:
+        """ Watch a directory and every directory below it, queueing the files already in them to be reported. """
+        for root, _, files in os.walk(directory, followlinks=True):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                logging.warning("Could not watch directory {} (errno {})".format(root, ctypes.get_errno()))
+                continue
+            self.watches[wd] = root
+            self._rescanned.extend(os.path.join(root, fi) for fi in files)
+
+    def poll(self, timeout: float = None) -> typing.List[str]:
+        """ Wait for files to be closed after writing or moved into the tree.
+
+        :param timeout: the maximum time to wait (seconds, or forever if None)
+        :return: the paths of the files
+        """
+        paths, self._rescanned = self._rescanned, []
+        if paths:
+            timeout = 0
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return paths
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+                name = os.fsdecode(buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0'))
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    logging.warning("inotify event queue overflowed, rescanning {}".format(self.root_directory))
+                    paths.extend(list_files(self.root_directory))
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None or not name:
+                    continue
+                path = os.path.join(directory, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self._add_watches(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    paths.append(path)
+        paths.extend(self._rescanned)
+        self._rescanned = []
+        return paths
+
+
+class PollingWatcher:
+    """ Watches a directory tree for new or changed files by comparing the size and modification time of every file
+    at an interval. Used where inotify isn't available (e.g. on some network filesystems).
+    """
+    def __init__(self, root_directory: str, interval: float = 5):
+        """
+        :param root_directory: the directory to watch
+        :param interval: seconds between scans of the tree
+        """
+        self.root_directory = root_directory
+        self.interval = interval
+        self.snapshot = {}          # path -> (size, mtime)
+        self._last_scan = None
+
+    def close(self) -> None:
+        pass
+
+    def poll(self, timeout: float = None) -> typing.List[str]:
+        """ Wait until the next scan is due, then scan for new or changed files.
+
+        :param timeout: the maximum time to wait (seconds, or until the next scan if None)
+        :return: the paths of the files (every file on the first scan)
+        """
+        if self._last_scan is not None:
+            wait = self._last_scan + self.interval - time.monotonic()
+            if timeout is not None and timeout < wait:
+                time.sleep(max(0, timeout))
+                return []
+            time.sleep(max(0, wait))
+        self._last_scan = time.monotonic()
+        snapshot = {}
+        for path in list_files(self.root_directory):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+        paths = [path for path, signature in snapshot.items() if self.snapshot.get(path) != signature]
+        self.snapshot = snapshot
+        return paths
+
+
+def make_watcher(root_directory: str, poll_interval: float = 5, use_inotify: bool = True) \
+        -> typing.Union[InotifyWatcher, PollingWatcher]:
+    """ Make an InotifyWatcher if possible, otherwise a PollingWatcher.
+
+    :param root_directory: the directory to watch
+    :param poll_interval: seconds between scans of the tree if polling
+    :param use_inotify: use inotify if available
+    """
+    if use_inotify:
+        try:
+            return InotifyWatcher(root_directory)
+        except OSError as e:
+            logging.warning("Can't use inotify ({}), polling every {}s instead".format(e, poll_interval))
+    return PollingWatcher(root_directory, interval=poll_interval)
+
+
+class StabilityTracker:
+    """ Debounces files, only reporting a file as ready once its size and modification time have been unchanged for a
+    settling time.
+    """
+    def __init__(self, settle_seconds: float = 2):
+        """
+        :param settle_seconds: how long a file must be unchanged for
+        """
+        self.settle_seconds = settle_seconds
+        self.pending = {}           # path -> ((size, mtime), time first seen with this signature)
+
+    def add(self, path: str, now: float = None) -> None:
+        """ Start (or restart) tracking a file. """
+        self.pending.pop(path, None)
+        self._update(path, time.monotonic() if now is None else now)
+
+    def _update(self, path: str, now: float) -> None:
+        try:
+            stat = os.stat(path)
+        except OSError:                 # removed (e.g. a temporary file that was renamed)
+            self.pending.pop(path, None)
+            return
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if path not in self.pending or self.pending[path][0] != signature:
+            self.pending[path] = (signature, now)
+
+    def pop_ready(self, now: float = None) -> typing.List[str]:
+        """ Stop tracking, and get, the files that have been unchanged for the settling time. """
+        now = time.monotonic() if now is None else now
+        ready = []
+        for path in list(self.pending):
+            self._update(path, now)
+            if path in self.pending and now - self.pending[path][1] >= self.settle_seconds:
+                ready.append(path)
+                del self.pending[path]
+        return ready
+
+    def time_until_ready(self, now: float = None) -> typing.Union[None, float]:
+        """ Get the time until the next file could be ready (None if no files are being tracked). """
+        if not self.pending:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0, min(since for _, since in self.pending.values()) + self.settle_seconds - now)
@@ -0,0 +1,428 @@
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import typing
+import uuid
+
+from rucio.common.exception import DataIdentifierAlreadyExists, DataIdentifierNotFound, Duplicate, NoFilesDownloaded
+
+from rucio_extended_client.common.checksum import adler32
+from rucio_extended_client.common.exceptions import InjectedFailureError
+
+
+class FakeRucio:
+    """ An in-memory stand-in for a Rucio server, for running plans offline.
+
+    The DID graph, metadata, replicas and rules are kept in memory and file payloads are stored in a temporary
+    directory. Every client call can be given a latency and a failure rate, and transfers a bandwidth limit, so that
+    execution performance can be measured without a network.
+    """
+    def __init__(self, storage_dir: str = None, latency: typing.Union[float, typing.Dict[str, float]] = 0.,
+                 bandwidth: float = None, failure_rate: typing.Union[float, typing.Dict[str, float]] = 0.,
+                 seed: int = None, rse_latency: typing.Dict[str, float] = None):
+        """
+        :param storage_dir: directory to store file payloads in (a temporary directory if not set)
+        :param latency: seconds added to every call, or a mapping of call name to seconds (key 'default' for others)
+        :param bandwidth: bytes per second of each transfer (unlimited if not set)
+        :param failure_rate: probability of a call failing, or a mapping of call name to probability (key 'default'
+            for others)
+        :param seed: seed for the failure injection random number generator
+        :param rse_latency: mapping of RSE to seconds added to every transfer to or from it (e.g. to make stragglers)
+        """
+        self.storage_dir = storage_dir or tempfile.mkdtemp(prefix='fake-rucio-')
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.rse_latency = rse_latency or {}
+        self.calls = collections.Counter()
+        self.dids = {}                      # (scope, name) -> {'type': ..., 'bytes': ..., 'adler32': ..., 'md5': ...}
+        self.children = {}                  # (scope, name) -> {(scope, name): None} (ordered)
+        self.parents = collections.defaultdict(set)
+        self.metadata = collections.defaultdict(dict)
+        self.replicas = collections.defaultdict(dict)      # (scope, name) -> {rse: payload path}
+        self.rules = {}
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+
+    def _get_setting(self, setting: typing.Union[float, typing.Dict[str, float]], call_name: str) -> float:
+        if isinstance(setting, dict):
+            return setting.get(call_name, setting.get('default', 0.))
+        return setting
+
+    def call(self, call_name: str) -> None:
+        """ Account for a client call, injecting latency and failures. """
+        with self._lock:
+            self.calls[call_name] += 1
+            is_failure = self._random.random() < self._get_setting(self.failure_rate, call_name)
+        latency = self._get_setting(self.latency, call_name)
+        if latency:
+            time.sleep(latency)
+        if is_failure:
+            raise InjectedFailureError("Injected failure in call to {}".format(call_name))
+
+    def transfer(self, n_bytes: int, rse: str = None) -> None:
+        """ Account for the time taken to transfer n_bytes (to or from rse). """
+        if self.bandwidth:
+            time.sleep(n_bytes / self.bandwidth)
+        if self.rse_latency.get(rse):
+            time.sleep(self.rse_latency[rse])
+
+    def get_did(self, scope: str, name: str) -> typing.Dict[str, typing.Any]:
+        try:
+            return self.dids[(scope, name)]
+        except KeyError:
+            raise DataIdentifierNotFound("Data identifier '{}:{}' not found".format(scope, name))
+
+    def add_did(self, scope: str, name: str, did_type: str, **attributes) -> None:
+        with self._lock:
+            if (scope, name) in self.dids:
+                raise DataIdentifierAlreadyExists("Data Identifier '{}:{}' already exists".format(scope, name))
+            self.dids[(scope, name)] = {'type': did_type, **attributes}
+            if did_type != 'FILE':
+                self.children[(scope, name)] = {}
+
+    def attach(self, scope: str, name: str, dids: typing.List[typing.Dict[str, str]]) -> None:
+        with self._lock:
+            self.get_did(scope, name)
+            for did in dids:
+                self.get_did(did['scope'], did['name'])
+                self.children[(scope, name)][(did['scope'], did['name'])] = None
+                self.parents[(did['scope'], did['name'])].add((scope, name))
+
+    def list_files(self, scope: str, name: str) -> typing.Iterator[typing.Tuple[str, str]]:
+        """ Recursively list the files beneath a DID. """
+        did = self.get_did(scope, name)
+        if did['type'] == 'FILE':
+            yield (scope, name)
+            return
+        for child_scope, child_name in list(self.children[(scope, name)]):
+            yield from self.list_files(child_scope, child_name)
+
+    def payload_path(self, scope: str, name: str) -> str:
+        return os.path.join(self.storage_dir, scope, name)
+
+    def cleanup(self) -> None:
+        """ Remove the stored file payloads. """
+        shutil.rmtree(self.storage_dir, ignore_errors=True)
+
+    @contextlib.contextmanager
+    def patch(self):
+        """ Context manager to make the planners and runners use fake clients backed by this instance (which also
+        becomes the default instance for fake clients created without one).
+        """
+        from rucio_extended_client.api.clients import ClientPool, get_client_pool, set_client_pool
+
+        original_pool = get_client_pool()
+        original_default = get_default_rucio()
+        set_default_rucio(self)
+        set_client_pool(ClientPool(factories={
+            name: (lambda pool, client_cls=client_cls: client_cls(self)) for name, client_cls in FAKE_CLIENTS.items()
+        }, classes={name: (lambda client_cls=client_cls: client_cls) for name, client_cls in FAKE_CLIENTS.items()}))
+        try:
+            yield self
+        finally:
+            set_client_pool(original_pool)
+            set_default_rucio(original_default)
+
+
+_default_rucio = None
+
+
+def get_default_rucio() -> FakeRucio:
+    """ Get the instance of FakeRucio used by fake clients created without one. """
+    global _default_rucio
+    if _default_rucio is None:
+        _default_rucio = FakeRucio()
+    return _default_rucio
+
+
+def set_default_rucio(rucio: FakeRucio) -> None:
+    """ Set the instance of FakeRucio used by fake clients created without one. """
+    global _default_rucio
+    _default_rucio = rucio
+
+
+class _FakeClient:
+    def __init__(self, rucio: FakeRucio = None, **kwargs):
+        """
+        :param rucio: the instance of FakeRucio to use (the default instance if not set)
+        """
+        self.rucio = rucio or get_default_rucio()
+
+
+class FakeDIDClient(_FakeClient):
+    """ Fake of rucio.client.didclient.DIDClient. """
+    def add_container(self, scope: str, name: str, **kwargs) -> bool:
+        self.rucio.call('add_container')
+        self.rucio.add_did(scope, name, 'CONTAINER')
+        return True
+
+    def add_dataset(self, scope: str, name: str, **kwargs) -> bool:
+        self.rucio.call('add_dataset')
+        self.rucio.add_did(scope, name, 'DATASET')
+        return True
+
+    def add_dids(self, dids: typing.List[typing.Dict[str, typing.Any]]) -> bool:
+        self.rucio.call('add_dids')
+        for did in dids:
+            self.rucio.add_did(did['scope'], did['name'], did['type'].upper())
+        return True
+
+    def attach_dids(self, scope: str, name: str, dids: typing.List[typing.Dict[str, str]], **kwargs) -> bool:
+        self.rucio.call('attach_dids')
+        self.rucio.attach(scope, name, dids)
+        return True
+
+    def _attach_bulk(self, call_name: str, attachments: typing.List[typing.Dict[str, typing.Any]]) -> bool:
+        self.rucio.call(call_name)
+        for attachment in attachments:
+            self.rucio.attach(attachment['scope'], attachment['name'], attachment['dids'])
+        return True
+
+    def add_containers_to_containers(self, attachments: typing.List[typing.Dict[str, typing.Any]]) -> bool:
+        return self._attach_bulk('add_containers_to_containers', attachments)
+
+    def add_datasets_to_containers(self, attachments: typing.List[typing.Dict[str, typing.Any]]) -> bool:
+        return self._attach_bulk('add_datasets_to_containers', attachments)
+
+    def add_files_to_datasets(self, attachments: typing.List[typing.Dict[str, typing.Any]], **kwargs) -> bool:
+        return self._attach_bulk('add_files_to_datasets', attachments)
+
+    def attach_dids_to_dids(self, attachments: typing.List[typing.Dict[str, typing.Any]], **kwargs) -> bool:
+        return self._attach_bulk('attach_dids_to_dids', attachments)
+
+    def get_metadata(self, scope: str, name: str, plugin: str = 'DID_COLUMN') -> typing.Dict[str, typing.Any]:
+        self.rucio.call('get_metadata')
+        did = self.rucio.get_did(scope, name)
+        if plugin == 'DID_COLUMN':
+            return {'scope': scope, 'name': name, 'did_type': did['type'], 'bytes': did.get('bytes')}
+        return dict(self.rucio.metadata[(scope, name)])
+
+    def set_metadata(self, scope: str, name: str, key: str, value: typing.Any, **kwargs) -> bool:
+        self.rucio.call('set_metadata')
+        self.rucio.get_did(scope, name)
+        self.rucio.metadata[(scope, name)][key] = value
+        return True
+
+    def set_metadata_bulk(self, scope: str, name: str, meta: typing.Dict[str, typing.Any], **kwargs) -> bool:
+        self.rucio.call('set_metadata_bulk')
+        self.rucio.get_did(scope, name)
+        self.rucio.metadata[(scope, name)].update(meta)
+        return True
+
+    def set_dids_metadata_bulk(self, dids: typing.List[typing.Dict[str, typing.Any]], **kwargs) -> bool:
+        self.rucio.call('set_dids_metadata_bulk')
+        for did in dids:
+            self.rucio.get_did(did['scope'], did['name'])
+        for did in dids:
+            self.rucio.metadata[(did['scope'], did['name'])].update(did['meta'])
+        return True
+
+    def list_content(self, scope: str, name: str) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        self.rucio.call('list_content')
+        self.rucio.get_did(scope, name)
+        for child_scope, child_name in list(self.rucio.children[(scope, name)]):
+            child = self.rucio.dids[(child_scope, child_name)]
+            yield {
+                'scope': child_scope,
+                'name': child_name,
+                'type': child['type'],
+                'bytes': child.get('bytes'),
+                'adler32': child.get('adler32'),
+                'md5': child.get('md5')
+            }
+
+    def list_files(self, scope: str, name: str, long: bool = False) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        self.rucio.call('list_files')
+        for file_scope, file_name in self.rucio.list_files(scope, name):
+            fi = self.rucio.dids[(file_scope, file_name)]
+            yield {
+                'scope': file_scope,
+                'name': file_name,
+                'bytes': fi['bytes'],
+                'adler32': fi['adler32'],
+                'md5': fi['md5'],
+                'guid': fi.get('guid'),
+                'events': None
+            }
+
+    def list_parent_dids(self, scope: str, name: str) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        self.rucio.call('list_parent_dids')
+        self.rucio.get_did(scope, name)
+        for parent_scope, parent_name in sorted(self.rucio.parents[(scope, name)]):
+            yield {'scope': parent_scope, 'name': parent_name, 'type': self.rucio.dids[(parent_scope, parent_name)]['type']}
+
+    def list_dids(self, scope: str, filters: typing.List[typing.Dict[str, typing.Any]], did_type: str = 'collection',
+                  long: bool = False, recursive: bool = False) -> typing.Iterator[typing.Any]:
+        self.rucio.call('list_dids')
+        names = set(filt['name'] for filt in filters if 'name' in filt)
+        to_visit = [(scope, name) for name in names if (scope, name) in self.rucio.dids]
+        seen = set()
+        while to_visit:
+            did = to_visit.pop()
+            if did in seen:
+                continue
+            seen.add(did)
+            did_attributes = self.rucio.dids[did]
+            if did_type == 'all' or did_type == 'collection' and did_attributes['type'] != 'FILE' or \
+                    did_type.upper() == did_attributes['type']:
+                if long:
+                    yield {'scope': did[0], 'name': did[1], 'did_type': did_attributes['type'],
+                           'bytes': did_attributes.get('bytes'), 'length': None}
+                else:
+                    yield did[1]
+            if recursive and did_attributes['type'] != 'FILE':
+                to_visit.extend(self.rucio.children[did])
+
+
+class FakeReplicaClient(_FakeClient):
+    """ Fake of rucio.client.replicaclient.ReplicaClient. """
+    def add_replicas(self, rse: str, files: typing.List[typing.Dict[str, typing.Any]], **kwargs) -> bool:
+        self.rucio.call('add_replicas')
+        with self.rucio._lock:
+            if any(rse in self.rucio.replicas.get((fi['scope'], fi['name']), {}) for fi in files):
+                raise Duplicate("File replica already exists!")
+            for fi in files:
+                if (fi['scope'], fi['name']) not in self.rucio.dids:
+                    self.rucio.add_did(fi['scope'], fi['name'], 'FILE', bytes=fi['bytes'], adler32=fi.get('adler32'),
+                                       md5=fi.get('md5'))
+                self.rucio.replicas[(fi['scope'], fi['name'])][rse] = self.rucio.payload_path(fi['scope'], fi['name'])
+        return True
+
+    def list_replicas(self, dids: typing.List[typing.Dict[str, str]], **kwargs) \
+            -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        self.rucio.call('list_replicas')
+        for did in dids:
+            for file_scope, file_name in self.rucio.list_files(did['scope'], did['name']):
+                fi = self.rucio.dids[(file_scope, file_name)]
+                rses = self.rucio.replicas.get((file_scope, file_name), {})
+                yield {
+                    'scope': file_scope,
+                    'name': file_name,
+                    'bytes': fi['bytes'],
+                    'adler32': fi['adler32'],
+                    'md5': fi['md5'],
+                    'rses': {rse: [path] for rse, path in rses.items()},
+                    'states': {rse: 'AVAILABLE' for rse in rses}
+                }
+
+
+class FakeRuleClient(_FakeClient):
+    """ Fake of rucio.client.ruleclient.RuleClient. """
+    def add_replication_rule(self, dids: typing.List[typing.Dict[str, str]], copies: int, rse_expression: str,
+                             **kwargs) -> typing.List[str]:
+        self.rucio.call('add_replication_rule')
+        for did in dids:
+            self.rucio.get_did(did['scope'], did['name'])
+        rule_id = uuid.uuid4().hex
+        self.rucio.rules[rule_id] = {'dids': dids, 'copies': copies, 'rse_expression': rse_expression, **kwargs}
+        return [rule_id]
+
+
+class FakeUploadClient(_FakeClient):
+    """ Fake of rucio.client.uploadclient.UploadClient. """
+    def _upload_item(self, item: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        self.rucio.call('upload_item')
+        path = item['path']
+        scope = item['did_scope']
+        name = item.get('did_name') or os.path.basename(path)
+        n_bytes = os.stat(path).st_size
+
+        # Transfer the payload.
+        self.rucio.transfer(n_bytes, item.get('rse'))
+        payload_path = self.rucio.payload_path(scope, name)
+        os.makedirs(os.path.dirname(payload_path), exist_ok=True)
+        shutil.copyfile(path, payload_path)
+        with open(path, 'rb') as fi:
+            md5 = hashlib.md5(fi.read()).hexdigest()
+        checksum = adler32(path)
+        summary = {'scope': scope, 'name': name, 'bytes': n_bytes, 'rse': item.get('rse'), 'adler32': checksum,
+                   'md5': md5}
+        if item.get('no_register'):
+            return summary
+
+        # Register the file, its replica and its attachment to a dataset.
+        with self.rucio._lock:
+            if (scope, name) in self.rucio.dids:
+                if self.rucio.dids[(scope, name)]['adler32'] != checksum:
+                    raise DataIdentifierAlreadyExists("Data Identifier '{}:{}' already exists".format(scope, name))
+            else:
+                self.rucio.add_did(scope, name, 'FILE', bytes=n_bytes, adler32=checksum, md5=md5)
+            self.rucio.replicas[(scope, name)][item['rse']] = payload_path
+            if item.get('dataset_name'):
+                dataset_scope = item.get('dataset_scope', scope)
+                if (dataset_scope, item['dataset_name']) not in self.rucio.dids:
+                    self.rucio.add_did(dataset_scope, item['dataset_name'], 'DATASET')
+                self.rucio.attach(dataset_scope, item['dataset_name'], [{'scope': scope, 'name': name}])
+        return summary
+
+    def upload(self, items: typing.List[typing.Dict[str, typing.Any]], summary_file_path: str = None, **kwargs) -> int:
+        self.rucio.call('upload')
+        summaries = {}
+        for item in items:
+            logging.debug("Fake uploading {}".format(item['path']))
+            summary = self._upload_item(item)
+            summaries['{}:{}'.format(summary['scope'], summary['name'])] = summary
+        if summary_file_path:
+            with open(summary_file_path, 'w') as fi:
+                json.dump(summaries, fi)
+        return 0
+
+
+class FakeDownloadClient(_FakeClient):
+    """ Fake of rucio.client.downloadclient.DownloadClient. """
+    def _download_file(self, scope: str, name: str, item: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        self.rucio.call('download_file')
+        fi = self.rucio.get_did(scope, name)
+        replicas = self.rucio.replicas.get((scope, name))
+        if not replicas:
+            raise NoFilesDownloaded("No replicas of {}:{}".format(scope, name))
+        rse = item['rse'] if item.get('rse') in replicas else next(iter(replicas))
+        source = replicas[rse]
+
+        base_dir = item.get('base_dir', '.')
+        dest_dir = base_dir if item.get('no_subdir') else os.path.join(base_dir, scope)
+        dest_path = os.path.join(dest_dir, name)
+        os.makedirs(dest_dir, exist_ok=True)
+        self.rucio.transfer(fi['bytes'], rse)
+        shutil.copyfile(source, dest_path)
+        return {
+            'did': '{}:{}'.format(scope, name),
+            'scope': scope,
+            'name': name,
+            'bytes': fi['bytes'],
+            'adler32': fi['adler32'],
+            'dest_file_paths': [dest_path],
+            'clientState': 'DONE'
+        }
+
+    def download_dids(self, items: typing.List[typing.Dict[str, typing.Any]], num_threads: int = 2, **kwargs) \
+            -> typing.List[typing.Dict[str, typing.Any]]:
+        self.rucio.call('download_dids')
+        to_download = []
+        for item in items:
+            scope, name = item['did'].split(':')
+            for file_scope, file_name in self.rucio.list_files(scope, name):
+                to_download.append((file_scope, file_name, item))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+            futures = [executor.submit(self._download_file, *args) for args in to_download]
+            return [future.result() for future in futures]
+
+
+# mapping of the names of Rucio client classes to their fakes
+FAKE_CLIENTS = {
+    'DIDClient': FakeDIDClient,
+    'DownloadClient': FakeDownloadClient,
+    'ReplicaClient': FakeReplicaClient,
+    'RuleClient': FakeRuleClient,
+    'UploadClient': FakeUploadClient
+}
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+""" Benchmarks for making, serialising and running plans on synthetic directory trees.
+
+Each case (a tree shape at a number of files) is run in its own subprocess against an in-memory Rucio stand-in so that
+its peak RSS can be measured in isolation. Results are written as JSON and can be compared against a stored baseline,
+e.g.
+
+    python test/benchmarks/plan_benchmarks.py --sizes 10000 --output baseline.json
+    python test/benchmarks/plan_benchmarks.py --sizes 10000 --baseline baseline.json
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+SHAPES = ('wide', 'deep', 'tiny', 'huge')
+STAGES = ('make_tree', 'dir_checksum', 'make_upload_plan', 'save', 'load', 'run_upload', 'make_download_plan',
+          'run_download')
+
+
+def _write_file(path: str, size_bytes: int) -> None:
+    with open(path, 'wb') as fi:
+        if size_bytes > 1024**2:
+            fi.truncate(size_bytes)         # sparse, to save disk space
+        else:
+            fi.write(b'x' * size_bytes)
+
+
+def make_tree(root: str, shape: str, n_files: int, huge_file_bytes: int = 8 * 1024**2) -> None:
+    """ Make a synthetic directory tree.
+
+    :param root: the directory to make the tree in
+    :param shape: wide (a single level of many directories), deep (long chains of nested directories), tiny (a
+        balanced tree of one byte files) or huge (a few large files)
+    :param n_files: the number of files to make (huge trees have n_files // 10000 files, and at least two)
+    :param huge_file_bytes: the size of each file in huge trees
+    """
+    if shape == 'wide':
+        n_dirs = max(2, int(math.sqrt(n_files)))
+        paths = [os.path.join('d{}'.format(idx % n_dirs), 'f{}'.format(idx)) for idx in range(n_files)]
+        size_bytes = 1024
+    elif shape == 'deep':
+        depth = 50
+        paths = []
+        for idx in range(n_files):
+            chain, level = divmod(idx // 10, depth)
+            paths.append(os.path.join(*['d{}_{}'.format(chain, lvl) for lvl in range(level + 1)], 'f{}'.format(idx)))
+        size_bytes = 1024
+    elif shape == 'tiny':
+        paths = []
+        for idx in range(n_files):
+            dir_idx = idx // 10
+            parts = []
+            while True:
+                parts.insert(0, 'd{}'.format(dir_idx % 10))
+                dir_idx //= 10
+                if not dir_idx:
+                    break
+            paths.append(os.path.join(*parts, 'f{}'.format(idx)))
+        size_bytes = 1
+    elif shape == 'huge':
+        paths = [os.path.join('d{}'.format(idx % 2), 'f{}'.format(idx)) for idx in range(max(2, n_files // 10000))]
+        size_bytes = huge_file_bytes
+    else:
+        raise ValueError("shape {} is not understood".format(shape))
+
+    for path in paths:
+        os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+        _write_file(os.path.join(root, path), size_bytes)
+
+
+def _peak_rss_bytes() -> int:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024      # kB on Linux
+
+
+def run_case(shape: str, n_files: int, method: str, workdir: str, latency: float = 0., bandwidth: float = None,
+             huge_file_bytes: int = 8 * 1024**2, executor: str = 'serial') -> typing.Dict[str, typing.Any]:
+    """ Run a single benchmark case in this process.
+
+    :return: a dictionary of the wall time and peak RSS (so far) after each stage
+    """
+    from dirhash import dirhash
+
+    from rucio_extended_client.api.plan import DownloadPlanMetadata, DownloadPlanNative, Plan, UploadPlanMetadata, \
+        UploadPlanNative
+    from rucio_extended_client.api.runners import AsyncPlanRunner, HybridPlanRunner
+    from rucio_extended_client.testing.fake import FakeRucio
+
+    upload_cls, download_cls = {
+        'metadata': (UploadPlanMetadata, DownloadPlanMetadata),
+        'native': (UploadPlanNative, DownloadPlanNative)
+    }[method]
+
+    def run(plan, root_directory=None):
+        if executor == 'async':
+            AsyncPlanRunner(plan).run()
+        elif executor == 'hybrid':
+            HybridPlanRunner(plan, root_directory=root_directory).run()
+        else:
+            plan.run()
+
+    results = {}
+
+    def timed(stage, func, *args, **kwargs):
+        st = time.perf_counter()
+        rtn = func(*args, **kwargs)
+        results[stage] = {'seconds': time.perf_counter() - st, 'peak_rss_bytes': _peak_rss_bytes()}
+        logging.info("{} {} {}: {} took {:.3f}s".format(shape, n_files, method, stage, results[stage]['seconds']))
+        return rtn
+
+    src = os.path.join(workdir, 'src')
+    plan_path = os.path.join(workdir, 'plan.json')
+    os.chdir(workdir)
+    timed('make_tree', make_tree, src, shape, n_files, huge_file_bytes)
+    timed('dir_checksum', dirhash, src, algorithm='md5', empty_dirs=True)
+
+    rucio = FakeRucio(storage_dir=os.path.join(workdir, 'storage'), latency=latency, bandwidth=bandwidth)
+    with rucio.patch():
+        plan = timed('make_upload_plan', upload_cls.make_plan_from_directory, src, 'root', rse='RSE', scope='bench',
+                     lifetime=3600, do_checksum=False)
+        timed('save', plan.save, plan_path)
+        plan = timed('load', Plan.load, plan_path)
+        timed('run_upload', run, plan, src)
+        plan = timed('make_download_plan', download_cls.make_plan_from_did, 'bench', 'root', clobber=False,
+                     show_tree=False)
+        timed('run_download', run, plan)
+    results['calls'] = dict(rucio.calls)
+    return results
+
+
+def run_case_in_subprocess(shape: str, n_files: int, args: argparse.Namespace) -> typing.Dict[str, typing.Any]:
+    """ Run a single benchmark case in a fresh interpreter, so that peak RSS is not shared between cases. """
+    workdir = tempfile.mkdtemp(prefix='plan-benchmark-', dir=args.workdir)
+    try:
+        command = [sys.executable, __file__, '--case', '{}:{}'.format(shape, n_files), '--method', args.method,
+                   '--latency', str(args.latency), '--executor', args.executor, '--huge-file-bytes',
+                   str(args.huge_file_bytes), '--workdir', workdir]
+        if args.bandwidth:
+            command += ['--bandwidth', str(args.bandwidth)]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results: typing.Dict[str, typing.Any], baseline: typing.Dict[str, typing.Any],
+            tolerance: float, min_seconds: float = 0.05) -> typing.List[str]:
+    """ Compare results against a baseline.
+
+    :param tolerance: fractional increase in time or peak RSS over the baseline above which a stage has regressed
+    :param min_seconds: ignore stages that took less than this in both (timings this short are mostly noise)
+    :return: a list of descriptions of regressions
+    """
+    regressions = []
+    for case, stages in sorted(results.items()):
+        if case not in baseline:
+            continue
+        for stage in STAGES:
+            if stage not in stages or stage not in baseline[case]:
+                continue
+            for quantity in ('seconds', 'peak_rss_bytes'):
+                old, new = baseline[case][stage][quantity], stages[stage][quantity]
+                if quantity == 'seconds' and max(old, new) < min_seconds:
+                    continue
+                if old and new > old * (1 + tolerance):
+                    regressions.append("{} {}: {} increased from {:.4g} to {:.4g} ({:+.0%})".format(
+                        case, stage, quantity, old, new, new / old - 1))
+    return regressions
+
+
+def print_table(results: typing.Dict[str, typing.Any]) -> None:
+    print("{:<32}{:<20}{:>12}{:>16}".format('case', 'stage', 'seconds', 'peak RSS (MiB)'))
+    for case, stages in sorted(results.items()):
+        for stage in STAGES:
+            print("{:<32}{:<20}{:>12.3f}{:>16.1f}".format(
+                case, stage, stages[stage]['seconds'], stages[stage]['peak_rss_bytes'] / 1024**2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark plan generation and execution on synthetic trees")
+    parser.add_argument('--baseline', type=str, help="results file to compare against")
+    parser.add_argument('--bandwidth', type=float, help="bandwidth of the stand-in's transfers (bytes/s)")
+    parser.add_argument('--case', type=str, help=argparse.SUPPRESS)       # run a single shape:size case
+    parser.add_argument('--executor', type=str, default='serial', choices=['serial', 'async', 'hybrid'],
+                        help="how to run the plans (hybrid also calculates the directory checksum)")
+    parser.add_argument('--huge-file-bytes', type=int, default=8 * 1024**2, help="size of files in huge trees")
+    parser.add_argument('--latency', type=float, default=0., help="latency of the stand-in's calls (s)")
+    parser.add_argument('--method', type=str, default='metadata', choices=['metadata', 'native'],
+                        help="hierarchy method")
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help="stages faster than this in both runs are not compared")
+    parser.add_argument('--output', type=str, help="file to write the results to")
+    parser.add_argument('--shapes', type=str, default=','.join(SHAPES), help="comma separated tree shapes")
+    parser.add_argument('--sizes', type=str, default='10000,100000,1000000', help="comma separated numbers of files")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="fractional increase over the baseline to report as a regression")
+    parser.add_argument('--workdir', type=str, help="directory to make trees in")
+    args = parser.parse_args()
+
+    if args.case:
+        logging.basicConfig(level=logging.CRITICAL)
+        shape, n_files = args.case.split(':')
+        print(json.dumps(run_case(shape, int(n_files), args.method, args.workdir, latency=args.latency,
+                                  bandwidth=args.bandwidth, huge_file_bytes=args.huge_file_bytes,
+                                  executor=args.executor)))
+        sys.exit()
+
+    results = {}
+    for n_files in [int(size) for size in args.sizes.split(',')]:
+        for shape in args.shapes.split(','):
+            print("Running {} tree with {} files...".format(shape, n_files), file=sys.stderr)
+            case = '{}:{}:{}:{}'.format(args.method, args.executor, shape, n_files)
+            results[case] = run_case_in_subprocess(shape, n_files, args)
+    print_table(results)
+
+    if args.output:
+        with open(args.output, 'w') as fi:
+            json.dump(results, fi, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as fi:
+            regressions = compare(results, json.load(fi), args.tolerance, args.min_seconds)
+        for regression in regressions:
+            print("REGRESSION: {}".format(regression))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+""" Benchmarks for how quickly the command line client and the plan API start.
+
+Each case is run in a fresh interpreter a number of times, and the fastest wall time is kept (as startup times are
+mostly noise above it). A case also fails if it imports a module that is only meant to be imported when used (Rucio,
+treelib and dirhash). Results are written as JSON and can be compared against a stored baseline, e.g.
+
+    python test/benchmarks/startup_benchmark.py --output baseline.json
+    python test/benchmarks/startup_benchmark.py --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+BIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'bin', 'rucio-extended')
+
+# modules no case should import
+DEFERRED_MODULES = ('dirhash', 'rucio', 'treelib')
+
+# case -> code run by the interpreter ({plan_path} is replaced by the path of a small saved plan)
+CASES = {
+    'python': "pass",
+    'import_plan_api': "import rucio_extended_client.api.plan",
+    'import_cli': "import rucio_extended_client.cli.directory, rucio_extended_client.cli.plan",
+    'load_plan': "from rucio_extended_client.api.plan import Plan; Plan.load({plan_path!r})",
+    'help': "import runpy, sys; sys.argv = ['rucio-extended', '--help']; runpy.run_path({bin!r}, run_name='__main__')",
+    'plan_stats': "import runpy, sys; sys.argv = ['rucio-extended', 'plan', 'stats', '-p', {plan_path!r}]; "
+                  "runpy.run_path({bin!r}, run_name='__main__')"
+}
+
+# run before each case to report which of the deferred modules it imported when it exits
+REPORT_IMPORTS = "import atexit, json, sys; atexit.register(lambda: print(json.dumps(" \
+                 "sorted(m for m in {modules!r} if m in sys.modules)), file=sys.stderr))\n"
+
+
+def make_plan(plan_path: str) -> None:
+    """ Save a small plan bound to deferred clients, as an upload would be. """
+    from rucio_extended_client.api.clients import get_deferred_client
+    from rucio_extended_client.api.plan import Plan
+
+    plan = Plan()
+    did_client = get_deferred_client('DIDClient')
+    plan.append_step("create_directories", fqn=os.makedirs, arguments={'name': 'd1', 'exist_ok': True})
+    for idx in range(100):
+        plan.append_step("create_collections", fqn=did_client.add_dataset,
+                         arguments={'scope': 'scope', 'name': 'd{}'.format(idx)})
+    plan.save(plan_path)
+
+
+def run_case(code: str, repeats: int) -> typing.Dict[str, typing.Any]:
+    """ Run a case in a fresh interpreter, repeats times.
+
+    :return: a dictionary of the fastest wall time, and the deferred modules imported
+    """
+    seconds = []
+    imported = []
+    for _ in range(repeats):
+        st = time.perf_counter()
+        process = subprocess.run([sys.executable, '-c', REPORT_IMPORTS.format(modules=DEFERRED_MODULES) + code],
+                                 check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+        seconds.append(time.perf_counter() - st)
+        imported = json.loads(process.stderr.strip().splitlines()[-1])
+    return {'seconds': min(seconds), 'imported': imported}
+
+
+def compare(results: typing.Dict[str, typing.Any], baseline: typing.Dict[str, typing.Any],
+            tolerance: float, min_seconds: float = 0.02) -> typing.List[str]:
+    """ Compare results against a baseline.
+
+    :param tolerance: fractional increase in time over the baseline above which a case has regressed
+    :param min_seconds: ignore increases smaller than this (timings this close are mostly noise)
+    :return: a list of descriptions of regressions
+    """
+    regressions = []
+    for case, result in sorted(results.items()):
+        if case not in baseline:
+            continue
+        old, new = baseline[case]['seconds'], result['seconds']
+        if new > old * (1 + tolerance) and new - old >= min_seconds:
+            regressions.append("{}: seconds increased from {:.4g} to {:.4g} ({:+.0%})".format(
+                case, old, new, new / old - 1))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark how quickly the client starts")
+    parser.add_argument('--baseline', type=str, help="results file to compare against")
+    parser.add_argument('--cases', type=str, default=','.join(CASES), help="comma separated cases")
+    parser.add_argument('--min-seconds', type=float, default=0.02,
+                        help="increases in time smaller than this are not reported")
+    parser.add_argument('--output', type=str, help="file to write the results to")
+    parser.add_argument('--repeats', type=int, default=5, help="number of times to run each case")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="fractional increase over the baseline to report as a regression")
+    args = parser.parse_args()
+
+    regressions = []
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='startup-benchmark-') as workdir:
+        plan_path = os.path.join(workdir, 'plan.json')
+        make_plan(plan_path)
+        for case in args.cases.split(','):
+            print("Running {}...".format(case), file=sys.stderr)
+            results[case] = run_case(CASES[case].format(plan_path=plan_path, bin=BIN), args.repeats)
+            if results[case]['imported']:
+                regressions.append("{}: imported {}".format(case, ', '.join(results[case]['imported'])))
+
+    print("{:<24}{:>12}  {}".format('case', 'seconds', 'deferred modules imported'))
+    for case, result in results.items():
+        print("{:<24}{:>12.3f}  {}".format(case, result['seconds'], ', '.join(result['imported']) or '-'))
+
+    if args.output:
+        with open(args.output, 'w') as fi:
+            json.dump(results, fi, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as fi:
+            regressions += compare(results, json.load(fi), args.tolerance, args.min_seconds)
+    for regression in regressions:
+        print("REGRESSION: {}".format(regression))
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,4 @@
+#!/bin/bash
+
+cd /opt/ska-rucio-extended-client
+python3 test/benchmarks/plan_benchmarks.py "$@"
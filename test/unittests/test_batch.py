@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from rucio_extended_client.api.batch import merge_plans
+from rucio_extended_client.api.optimize import coalesce_steps
+from rucio_extended_client.api.plan import DownloadPlanMetadata, DownloadPlanNative, Plan, UploadPlanMetadata, \
+    UploadPlanNative
+from rucio_extended_client.api.runners import AsyncPlanRunner
+from rucio_extended_client.testing.fake import FakeDIDClient, FakeRucio
+
+
+def make_directory(root, content):
+    for path in ['d1/d1_d1/f1', 'd1/f2', 'd2/f3', 'f4']:
+        os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+        with open(os.path.join(root, path), 'w') as fi:
+            fi.write(content + path)
+
+
+class TestBatch:
+    @pytest.mark.parametrize('upload_cls, download_cls', [
+        (UploadPlanMetadata, DownloadPlanMetadata),
+        (UploadPlanNative, DownloadPlanNative)
+    ])
+    def test_batch_round_trip(self, tmp_path, monkeypatch, upload_cls, download_cls):
+        """ Check that merged uploads and downloads of several directories coalesce their catalog calls. """
+        names = ['obs-{}'.format(idx) for idx in range(3)]
+        for name in names:
+            make_directory(str(tmp_path / 'src' / name), name)
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        with rucio.patch():
+            plan = merge_plans([upload_cls.make_plan_from_directory(
+                str(tmp_path / 'src' / name), name, rse='RSE', scope='scope', lifetime=3600) for name in names])
+            plan.save(str(tmp_path / 'plan.json'))
+            AsyncPlanRunner(Plan.load(str(tmp_path / 'plan.json'))).run()
+            plan = merge_plans([download_cls.make_plan_from_did('scope', name, clobber=False, show_tree=False)
+                                for name in names])
+            plan.run()
+        for name in names:
+            with open(str(tmp_path / name / 'd1' / 'd1_d1' / 'f1')) as fi:
+                assert fi.read() == name + 'd1/d1_d1/f1'
+        assert 'add_container' not in rucio.calls and 'add_dataset' not in rucio.calls
+        assert rucio.calls['add_replication_rule'] == 1
+        assert rucio.calls['set_dids_metadata_bulk'] == 1
+        assert len(rucio.rules) == 1 and len(next(iter(rucio.rules.values()))['dids']) == 3
+
+    def test_coalesce_steps_chunks(self):
+        """ Check that coalesced calls are chunked and that steps that can't be coalesced are left in order. """
+        did_client = FakeDIDClient(FakeRucio())
+        plan = Plan()
+        for idx in range(5):
+            plan.append_step("create_collections", fqn=did_client.add_container,
+                             arguments={'scope': 'scope', 'name': 'c{}'.format(idx)})
+        plan.append_step("create_collections", fqn=did_client.add_container,
+                         arguments={'scope': 'scope', 'name': 'c5', 'lifetime': 1})
+        steps = coalesce_steps(plan.steps, max_items_per_call=2)
+        assert [step.fqn.__name__ for step in steps] == ['add_dids', 'add_dids', 'add_dids', 'add_container']
+        assert [step.n_items for step in steps[:3]] == [2, 2, 1]
+        assert steps[0].arguments['dids'][0] == {'scope': 'scope', 'name': 'c0', 'type': 'CONTAINER'}
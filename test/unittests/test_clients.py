@@ -0,0 +1,110 @@
+import concurrent.futures
+import json
+
+from rucio_extended_client.api.clients import ClientPool, DeferredClient, get_client_pool, get_deferred_client, \
+    reset_deferred_clients, set_client_pool
+from rucio_extended_client.api.plan import Plan
+
+
+class Client:
+    """ Stands in for an authenticated Rucio client. """
+    def __init__(self):
+        self.calls = 0
+
+    def add_container(self, scope, name):
+        self.calls += 1
+        return self
+
+
+class Transfer:
+    """ Stands in for an UploadClient wrapping an authenticated Rucio client. """
+    def __init__(self, client):
+        self.client = client
+
+    def upload(self, items):
+        return self
+
+
+def make_pool(created):
+    def make_client(pool):
+        created.append('Client')
+        return Client()
+    return ClientPool(factories={
+        'Client': make_client,
+        'UploadClient': lambda pool: Transfer(pool.get('Client')),
+        'DownloadClient': lambda pool: Transfer(pool.get('Client'))
+    }, classes={
+        'Client': lambda: Client,
+        'UploadClient': lambda: Transfer,
+        'DownloadClient': lambda: Transfer
+    })
+
+
+class TestClientPool:
+    def setup_method(self):
+        reset_deferred_clients()        # so that no stand-in has bound its methods while another test's pool was set
+
+    def test_client_shared_between_roles(self):
+        """ Check that the catalog clients of a thread, and its transfer clients, all share one Rucio client. """
+        created = []
+        pool = make_pool(created)
+        assert pool.get('DIDClient') is pool.get('RuleClient') is pool.get('ReplicaClient') is pool.get('Client')
+        assert pool.get('UploadClient').client is pool.get('Client')
+        assert pool.get('DownloadClient').client is pool.get('Client')
+        assert pool.get('UploadClient') is pool.get('UploadClient')
+        assert created == ['Client']
+
+    def test_clients_per_thread(self):
+        """ Check that each thread gets its own clients, and that methods are rebound to them. """
+        created = []
+        pool = make_pool(created)
+        add_container = pool.get('DIDClient').add_container
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            other = executor.submit(pool.get, 'DIDClient').result()
+            rebound = executor.submit(pool.rebind, add_container).result()
+        assert other is not pool.get('DIDClient')
+        assert rebound.__self__ is other
+        assert pool.rebind(add_container).__self__ is pool.get('DIDClient')
+        assert pool.rebind(json.dumps) is json.dumps
+        assert created == ['Client', 'Client']
+
+    def test_plan_load_uses_pool(self, tmp_path):
+        """ Check that loading a plan makes no Rucio clients, and that running it takes them from the pool. """
+        created = []
+        original_pool = get_client_pool()
+        set_client_pool(make_pool(created))
+        try:
+            pool = get_client_pool()
+            plan = Plan()
+            plan.append_step("create_root_container", fqn=pool.get('DIDClient').add_container,
+                             arguments={'scope': 'scope', 'name': 'root'})
+            plan.append_step("create_files_dataset", fqn=pool.get('RuleClient').add_container,
+                             arguments={'scope': 'scope', 'name': 'files'})
+            plan.save(str(tmp_path / 'plan.json'))
+            created.clear()
+            pool.clear()
+            plan = Plan.load(str(tmp_path / 'plan.json'))
+            assert all(isinstance(step.fqn.__self__, DeferredClient) for step in plan.steps)
+            assert created == []
+            plan.run()
+            assert pool.get('Client').calls == 2
+            assert created == ['Client']
+        finally:
+            set_client_pool(original_pool)
+
+    def test_deferred_client(self):
+        """ Check that a deferred client only makes a client when one of its methods is called, in the calling thread.
+        """
+        created = []
+        original_pool = get_client_pool()
+        set_client_pool(make_pool(created))
+        try:
+            add_container = get_deferred_client('DIDClient').add_container
+            assert created == []
+            assert add_container(scope='scope', name='root') is get_client_pool().get('Client')
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                other = executor.submit(add_container, scope='scope', name='root').result()
+            assert other is not get_client_pool().get('Client')
+            assert created == ['Client', 'Client']
+        finally:
+            set_client_pool(original_pool)
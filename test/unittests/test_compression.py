@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from rucio_extended_client.api.plan import DownloadPlanMetadata, DownloadPlanNative, UploadPlanMetadata, \
+    UploadPlanNative
+from rucio_extended_client.api.runners import AsyncPlanRunner
+from rucio_extended_client.common.compression import CompressionPolicy, compress_file, decompress_file
+from rucio_extended_client.common.exceptions import CompressionError
+from rucio_extended_client.testing.fake import FakeRucio
+
+
+class TestCompression:
+    @pytest.mark.parametrize('upload_cls, download_cls', [
+        (UploadPlanMetadata, DownloadPlanMetadata),
+        (UploadPlanNative, DownloadPlanNative)
+    ])
+    def test_compressed_round_trip(self, tmp_path, monkeypatch, upload_cls, download_cls):
+        """ Check that compressible files are compressed on upload and decompressed on download, and that small or
+        incompressible files are uploaded as they are.
+        """
+        contents = {
+            'd1/log.txt': b'INFO everything is fine\n' * 10000,
+            'd1/random.bin': os.urandom(100000),
+            'd2/small.txt': b'small',
+            'table.csv': b'1,2,3,4\n' * 20000
+        }
+        for path, content in contents.items():
+            (tmp_path / 'src' / path).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / 'src' / path).write_bytes(content)
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        compression = CompressionPolicy(min_bytes=1024, staging_directory=str(tmp_path / 'staging'))
+        with rucio.patch():
+            plan = upload_cls.make_plan_from_directory(
+                str(tmp_path / 'src'), 'obs', rse='RSE', scope='scope', lifetime=3600, compression=compression)
+            assert len([step for step in plan.steps if step.section_name == 'compress_files']) == 2
+            AsyncPlanRunner(plan).run()
+            assert not os.path.exists(str(tmp_path / 'staging' / 'scope' / 'obs'))
+            compressed_files = rucio.metadata[('scope', 'obs')]['hierarchy']['compressed_files']
+            assert sorted(compressed_files.values(), key=lambda fi: fi['bytes']) == [
+                {'algorithm': 'gzip', 'bytes': len(contents['table.csv'])},
+                {'algorithm': 'gzip', 'bytes': len(contents['d1/log.txt'])}]
+            stored_bytes = sum(did['bytes'] for did in rucio.dids.values() if did['type'] == 'FILE')
+            assert stored_bytes < sum(len(content) for content in contents.values()) / 2
+
+            AsyncPlanRunner(download_cls.make_plan_from_did('scope', 'obs', clobber=False, show_tree=False)).run()
+            for path, content in contents.items():
+                assert (tmp_path / 'obs' / path).read_bytes() == content
+
+            # compressed files are compared by their original size
+            plan = download_cls.make_plan_from_did('scope', 'obs', clobber=False, show_tree=False, skip_existing=True)
+            assert not [step for step in plan.steps if step.section_name == 'download_files']
+
+    def test_decompress_checks_size(self, tmp_path):
+        """ Check that a decompressed file of the wrong size is rejected and the compressed file kept. """
+        (tmp_path / 'f').write_bytes(b'x' * 100)
+        compress_file(str(tmp_path / 'f'), str(tmp_path / 'f.gz'), 'gzip')
+        with pytest.raises(CompressionError):
+            decompress_file(str(tmp_path / 'f.gz'), str(tmp_path / 'g'), 'gzip', n_bytes=99)
+        assert not os.path.exists(str(tmp_path / 'g')) and os.path.exists(str(tmp_path / 'f.gz'))
+        decompress_file(str(tmp_path / 'f.gz'), str(tmp_path / 'g'), 'gzip', n_bytes=100)
+        assert (tmp_path / 'g').read_bytes() == b'x' * 100 and not os.path.exists(str(tmp_path / 'f.gz'))
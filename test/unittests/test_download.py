@@ -1,10 +1,54 @@
+import os
+
+import pytest
 from pytest_unordered import unordered
 
-from rucio_extended_client.api.plan import DownloadPlanNative
+from rucio_extended_client.api.plan import DownloadPlanMetadata, DownloadPlanNative, UploadPlanNative
+from rucio_extended_client.api.scheduling import schedule_largest_first
+from rucio_extended_client.common.checksum import adler32
+from rucio_extended_client.common.paths import PathSelector
+from rucio_extended_client.testing.fake import FakeRucio
+
+
+class TestDownloadScheduling:
+    def test_schedule_largest_first(self):
+        """ Check that large files are spread across workers first and small files are packed together. """
+        sizes = {'huge': 500, 'large_1': 200, 'large_2': 150, 'tiny_1': 1, 'tiny_2': 2, 'tiny_3': 3, 'unknown': None}
+        batches = schedule_largest_first(sizes, num_threads=2, batch_bytes=100, max_batch_items=3)
+        assert batches == [['huge', 'large_1'], ['large_2', 'tiny_3'], ['tiny_2', 'tiny_1', 'unknown']]
 
 
 class TestDownloadFolderMetadata:
-    pass
+    file_paths_to_names = {
+        'test/f1': 'uuid-f1',
+        'test/d1/d1_f1': 'uuid-d1_f1',
+        'test/d1/d1_f2.csv': 'uuid-d1_f2',
+        'test/d1/d1_d1/d1_d1_f1.csv': 'uuid-d1_d1_f1',
+        'test/d2/d2_d1/d2_d1_f1': 'uuid-d2_d1_f1'
+    }
+
+    dirs = ['test', 'test/d1', 'test/d1/d1_d1', 'test/d2', 'test/d2/d2_d1', 'test/d4', 'test/d4/d4_d1']
+
+    def test_download_folder_select_subpath(self):
+        """ Check that selecting a subpath keeps only files beneath it (and their ancestors). """
+        file_paths_to_names, dirs = DownloadPlanMetadata._select_paths(
+            'test', self.file_paths_to_names, self.dirs, PathSelector(subpath='d1'))
+        assert list(file_paths_to_names) == unordered(['test/d1/d1_f1', 'test/d1/d1_f2.csv', 'test/d1/d1_d1/d1_d1_f1.csv'])
+        assert dirs == unordered(['test', 'test/d1', 'test/d1/d1_d1'])
+
+    def test_download_folder_select_globs(self):
+        """ Check that include and exclude globs are applied to files and directories. """
+        file_paths_to_names, dirs = DownloadPlanMetadata._select_paths(
+            'test', self.file_paths_to_names, self.dirs, PathSelector(include=['*.csv'], exclude=['d1/d1_d1/*']))
+        assert list(file_paths_to_names) == ['test/d1/d1_f2.csv']
+        assert dirs == unordered(['test', 'test/d1'])
+
+        file_paths_to_names, dirs = DownloadPlanMetadata._select_paths(
+            'test', self.file_paths_to_names, self.dirs, PathSelector(exclude=['d1']))
+        assert list(file_paths_to_names) == unordered(['test/f1', 'test/d2/d2_d1/d2_d1_f1'])
+        assert dirs == unordered(['test', 'test/d2', 'test/d2/d2_d1', 'test/d4', 'test/d4/d4_d1'])
+        assert not PathSelector(exclude=['d1']).is_file_selected('d1/d1_d1/d1_d1_f1.csv')
+        assert PathSelector(exclude=['d1']).is_file_selected('d10/f1')
 
 
 class TestDownloadFolderNative:
@@ -76,3 +120,87 @@ class TestDownloadFolderNative:
             elif section =='rename_files':
                 assert len([step for step in self.plan.steps if step.section_name == section]) == 7
 
+
+    def test_download_folder_add_steps_selected(self):
+        """ Check addition of steps to plan when only a subpath is selected. """
+        plan = DownloadPlanNative(root_suffix='__root', path_delimiter='.')
+        tree = plan._make_tree_from_graph(self.graph, self.roots)
+        plan._add_steps_from_tree(tree, self.collections, mock=True, selector=PathSelector(subpath='d1'))
+
+        renames = [step.arguments['dst'] for step in plan.steps if step.section_name == 'rename_files']
+        assert renames == unordered([
+            'test_upload_1/d1/d1_f1', 'test_upload_1/d1/d1_f2', 'test_upload_1/d1/d1_d1/d1_d1_f1'])
+
+    def test_download_folder_add_steps_scheduled(self):
+        """ Check that downloads are batched largest first when file sizes are known. """
+        plan = DownloadPlanNative(root_suffix='__root', path_delimiter='.')
+        tree = plan._make_tree_from_graph(self.graph, self.roots)
+        file_sizes = {did: 1 for did in self.graph}
+        file_sizes['hierarchy_tests:test_upload_1.d3.d3_f1'] = 1024**3
+        plan._add_steps_from_tree(tree, self.collections, mock=True, file_sizes=file_sizes, num_threads=2)
+
+        downloads = [step for step in plan.steps if step.section_name == 'download_files']
+        assert len(downloads) == 2
+        assert downloads[0].arguments['items'][0]['did'] == 'hierarchy_tests:test_upload_1.d3.d3_f1'
+        assert len(downloads[0].arguments['items']) == 2
+        assert downloads[0].size_bytes == 1024**3 + 1
+        assert len(downloads[1].arguments['items']) == 5
+        assert len([step for step in plan.steps if step.section_name == 'rename_files']) == 7
+
+    def test_download_folder_add_steps_skip_existing(self, tmp_path, monkeypatch):
+        """ Check that only missing or mismatched files are downloaded when skipping existing files. """
+        monkeypatch.chdir(tmp_path)
+        os.makedirs('test_upload_1/d1')
+        with open('test_upload_1/f1', 'w') as fi:            # matches
+            fi.write('f1')
+        with open('test_upload_1/d1/d1_f1', 'w') as fi:      # mismatched content
+            fi.write('xx')
+
+        file_sizes = {did: 2 for did in self.graph}
+        file_checksums = {did: adler32('test_upload_1/f1') for did in self.graph}
+
+        plan = DownloadPlanNative(root_suffix='__root', path_delimiter='.')
+        tree = plan._make_tree_from_graph(self.graph, self.roots)
+        plan._add_steps_from_tree(tree, self.collections, mock=True, file_sizes=file_sizes,
+                                  file_checksums=file_checksums, skip_existing=True)
+
+        renames = [step.arguments['dst'] for step in plan.steps if step.section_name == 'rename_files']
+        assert len(renames) == 6
+        assert 'test_upload_1/f1' not in renames
+        assert 'test_upload_1/d1/d1_f1' in renames
+
+
+class TestDownloadFolderNativeManifest:
+    @pytest.mark.parametrize('record_manifest', [True, False])
+    def test_download_folder_from_manifest(self, tmp_path, monkeypatch, record_manifest):
+        """ Check that a download is planned from the manifest recorded on upload without crawling the hierarchy, and
+        that the hierarchy is crawled if there is no manifest.
+        """
+        paths = ['d1/d1_d1/f1', 'd1/f2', 'd2/f3', 'f4', 'd3/d3_d1/f5']
+        for path in paths:
+            (tmp_path / 'src' / 'obs' / path).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / 'src' / 'obs' / path).write_text(path)
+        (tmp_path / 'src' / 'obs' / 'd4').mkdir()
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        with rucio.patch():
+            UploadPlanNative.make_plan_from_directory(
+                str(tmp_path / 'src' / 'obs'), 'obs', rse='RSE', scope='scope', lifetime=3600,
+                record_manifest=record_manifest).run()
+            assert ('manifest' in rucio.metadata[('scope', 'obs')]['hierarchy']) == record_manifest
+            rucio.calls.clear()
+            plan = DownloadPlanNative.make_plan_from_did('scope', 'obs', clobber=False, show_tree=True)
+            if record_manifest:
+                assert rucio.calls['list_files'] == 1
+                assert not rucio.calls['list_content'] and not rucio.calls['list_parent_dids']
+            else:
+                assert rucio.calls['list_content'] > 0
+            plan.run()
+
+            # a subpath is selected from the manifest too
+            plan = DownloadPlanNative.make_plan_from_did(
+                'scope', 'obs', clobber=False, show_tree=False, subpath='d1', skip_existing=True)
+            assert not [step for step in plan.steps if step.section_name == 'download_files']
+        for path in paths:
+            assert (tmp_path / 'obs' / path).read_text() == path
+        assert (tmp_path / 'obs' / 'd4').is_dir()
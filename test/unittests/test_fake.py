@@ -0,0 +1,152 @@
+import os
+
+import pytest
+
+from rucio_extended_client.api import plan as plan_module, registration
+from rucio_extended_client.api.plan import DownloadPlanMetadata, DownloadPlanNative, Plan, UploadPlanMetadata, \
+    UploadPlanNative
+from rucio_extended_client.common.checksum import adler32, file_checksums
+from rucio_extended_client.common.exceptions import ArgumentError, InjectedFailureError
+from rucio_extended_client.testing.fake import FakeDIDClient, FakeReplicaClient, FakeRucio
+
+
+def make_directory(root):
+    for path, content in [('d1/d1_d1/d1_d1_f1', b'a' * 10), ('d1/d1_f1', b'b' * 20), ('d2/d2_f1', b'c' * 30),
+                          ('f1', b'd' * 40)]:
+        os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+        with open(os.path.join(root, path), 'wb') as fi:
+            fi.write(content)
+    os.makedirs(os.path.join(root, 'd3'))
+
+
+def list_directory(root):
+    entries = {}
+    for dirpath, dirs, files in os.walk(root):
+        for name in dirs + files:
+            path = os.path.join(dirpath, name)
+            if os.path.isdir(path):
+                entries[os.path.relpath(path, root)] = None
+            else:
+                with open(path, 'rb') as fi:
+                    entries[os.path.relpath(path, root)] = fi.read()
+    return entries
+
+
+class TestFakeRucio:
+    @pytest.mark.parametrize('upload_cls, download_cls, download_kwargs', [
+        (UploadPlanMetadata, DownloadPlanMetadata, {'clobber': False, 'show_tree': False}),
+        (UploadPlanNative, DownloadPlanNative, {'clobber': False, 'show_tree': False})
+    ])
+    def test_fake_round_trip(self, tmp_path, monkeypatch, upload_cls, download_cls, download_kwargs):
+        """ Check that a directory survives an upload and download through the fake, including a save and load. """
+        make_directory(str(tmp_path / 'src'))
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        with rucio.patch():
+            plan = upload_cls.make_plan_from_directory(
+                str(tmp_path / 'src'), 'root', rse='RSE', scope='scope', lifetime=3600)
+            plan.save(str(tmp_path / 'plan.json'))
+            Plan.load(str(tmp_path / 'plan.json')).run()
+
+            plan = download_cls.make_plan_from_did('scope', 'root', **download_kwargs)
+            plan.run()
+        assert list_directory(str(tmp_path / 'root')) == list_directory(str(tmp_path / 'src'))
+        assert rucio.calls['upload_item'] == 4
+        assert len(rucio.rules) == 1
+
+    @pytest.mark.parametrize('upload_cls, download_cls', [
+        (UploadPlanMetadata, DownloadPlanMetadata),
+        (UploadPlanNative, DownloadPlanNative)
+    ])
+    def test_fake_overwrite_partial_download(self, tmp_path, monkeypatch, upload_cls, download_cls):
+        """ Check that overwriting a download of a subpath only removes the subpath, and that overwriting a download
+        selecting files by glob is refused.
+        """
+        make_directory(str(tmp_path / 'src'))
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        with rucio.patch():
+            upload_cls.make_plan_from_directory(
+                str(tmp_path / 'src'), 'root', rse='RSE', scope='scope', lifetime=3600).run()
+            download_cls.make_plan_from_did('scope', 'root', clobber=False, show_tree=False).run()
+            (tmp_path / 'root' / 'd1' / 'stale').write_text('stale')
+            (tmp_path / 'root' / 'd2' / 'local').write_text('local')
+            download_cls.make_plan_from_did('scope', 'root', show_tree=False, subpath='d1').run()
+            assert not (tmp_path / 'root' / 'd1' / 'stale').exists()
+            assert (tmp_path / 'root' / 'd1' / 'd1_f1').exists() and (tmp_path / 'root' / 'd2' / 'local').exists()
+            with pytest.raises(ArgumentError):
+                download_cls.make_plan_from_did('scope', 'root', show_tree=False, exclude=['d2'])
+
+    def test_fake_failure_injection(self):
+        """ Check that calls fail at the configured rate. """
+        rucio = FakeRucio(failure_rate={'add_container': 1})
+        did_client = FakeDIDClient(rucio)
+        did_client.add_dataset(scope='scope', name='dataset')
+        with pytest.raises(InjectedFailureError):
+            did_client.add_container(scope='scope', name='container')
+        assert rucio.calls == {'add_dataset': 1, 'add_container': 1}
+
+    @pytest.mark.parametrize('upload_cls, download_cls', [
+        (UploadPlanMetadata, DownloadPlanMetadata),
+        (UploadPlanNative, DownloadPlanNative)
+    ])
+    def test_fake_deferred_registration(self, tmp_path, monkeypatch, upload_cls, download_cls):
+        """ Check that files uploaded before being registered in bulk can be downloaded, and that registration can be
+        resumed after failing between the transfers and registration, or part way through it.
+        """
+        make_directory(str(tmp_path / 'src'))
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'), failure_rate={'add_replicas': 1})
+        with rucio.patch():
+            plan = upload_cls.make_plan_from_directory(
+                str(tmp_path / 'src'), 'root', rse='RSE', scope='scope', lifetime=3600, deferred_registration=True)
+            assert all(step.arguments['items'].defaults['no_register'] for step in plan.steps
+                       if step.section_name == 'upload_files')
+            with pytest.raises(SystemExit):
+                plan.run()
+            assert rucio.calls['upload_item'] == 4 and not rucio.replicas
+
+            # a replica registered before the failure
+            rucio.failure_rate = 0
+            plan = Plan.load('plan-dump.json')
+            item = next(step.arguments['items'][0] for step in plan.steps if step.section_name == 'register_files')
+            FakeReplicaClient(rucio).add_replicas(rse='RSE', files=[{
+                'scope': item['did_scope'], 'name': item['did_name'], 'bytes': os.path.getsize(item['path'])}])
+            plan.run()
+
+            plan = download_cls.make_plan_from_did('scope', 'root', clobber=False, show_tree=False)
+            plan.run()
+        assert list_directory(str(tmp_path / 'root')) == list_directory(str(tmp_path / 'src'))
+        assert rucio.calls['upload_item'] == 4
+
+    def test_fake_deferred_registration_summaries(self, tmp_path, monkeypatch):
+        """ Check that files are registered with the checksums their uploads wrote to the upload summaries, and only
+        read again if a summary is missing.
+        """
+        make_directory(str(tmp_path / 'src'))
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(plan_module, 'DEFAULT_STAGING_DIRECTORY', str(tmp_path / 'staging'))
+        calculated = []
+        monkeypatch.setattr(registration, 'file_checksums',
+                            lambda path: calculated.append(path) or file_checksums(path))
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        with rucio.patch():
+            plan = UploadPlanNative.make_plan_from_directory(
+                str(tmp_path / 'src'), 'root', rse='RSE', scope='scope', lifetime=3600, deferred_registration=True)
+            plan.run()
+            assert calculated == [] and len(rucio.replicas) == 4
+            assert rucio.dids[('scope', 'root.d1.d1_f1')]['adler32'] == adler32(str(tmp_path / 'src' / 'd1' / 'd1_f1'))
+            assert not os.path.exists(str(tmp_path / 'staging' / 'scope' / 'root'))
+
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage2'), failure_rate={'add_replicas': 1})
+        with rucio.patch():
+            plan = UploadPlanNative.make_plan_from_directory(
+                str(tmp_path / 'src'), 'root', rse='RSE', scope='scope', lifetime=3600, deferred_registration=True)
+            with pytest.raises(SystemExit):
+                plan.run()
+            summary_file_path = next(step.arguments['summary_file_path'] for step in plan.steps
+                                     if step.section_name == 'upload_files')
+            os.remove(summary_file_path + '.0')
+            rucio.failure_rate = 0
+            Plan.load('plan-dump.json').run()
+        assert 0 < len(calculated) < 4 and len(rucio.replicas) == 4
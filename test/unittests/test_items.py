@@ -0,0 +1,84 @@
+import json
+from unittest import mock
+
+from rucio_extended_client.api.items import UploadItems, call_with_arguments, decode_arguments, encode_arguments
+from rucio_extended_client.api.plan import UploadPlanNative
+from rucio_extended_client.api.step import Step
+from rucio_extended_client.api.stragglers import get_transfer_timeout
+from rucio_extended_client.testing.fake import FakeRucio
+
+
+class TestUploadItems:
+    def setup_method(self):
+        self.defaults = {'did_scope': 'scope', 'dataset_scope': 'scope', 'dataset_name': 'obs.d1',
+                         'register_after_upload': True}
+        self.items = [
+            dict(self.defaults, path='/src/obs/d1/f1', did_name='obs.d1.f1'),                          # native
+            dict(self.defaults, path='/src/obs/d1/f2', did_name='0b7f4b3c-7e30-4c2c-8d4b-5f7e0e2ad3f2'),  # metadata
+            dict(self.defaults, path='/src/obs/d1/f3', did_name='obs.d1.f3', dataset_name='obs.d1__root'),
+            dict(self.defaults, path='/src/obs/d1/2', did_name='0b7f4b3c-7e30-4c2c-8d4b-5f7e0e2ad3f2')
+        ]
+
+    def test_items_expand_to_dictionaries(self):
+        """ Check that items are expanded to the dictionaries they were made from, and survive serialisation. """
+        items = UploadItems(self.defaults)
+        items.extend(self.items)
+        assert len(items) == 4
+        assert list(items) == self.items
+        assert items[-1] == self.items[-1] and items[1:3] == self.items[1:3]
+        assert items._overrides == {2: {'dataset_name': 'obs.d1__root'}}
+
+        decoded = decode_arguments(json.loads(json.dumps(encode_arguments({'items': items}))))['items']
+        assert isinstance(decoded, UploadItems) and decoded == items and list(decoded) == self.items
+
+    def test_items_select_and_set_path(self):
+        """ Check that selected items have the new defaults and keep changed paths. """
+        items = UploadItems(self.defaults)
+        items.extend(self.items)
+        items.set_path(0, '/staging/obs.d1.f1')
+        selected = items.select([2, 0], rse='RSE')
+        assert list(selected) == [dict(self.items[2], rse='RSE'),
+                                  dict(self.items[0], rse='RSE', path='/staging/obs.d1.f1')]
+
+    def test_items_sizes(self):
+        """ Check that items with a size get a transfer timeout from it, kept in a column rather than as overrides. """
+        items = UploadItems(self.defaults)
+        items.extend(self.items)
+        items.set_size(1, 100 * 1024**2)
+        assert items[1] == dict(self.items[1], transfer_timeout=get_transfer_timeout(100 * 1024**2))
+        assert items[0] == self.items[0] and items.get_size(0) is None
+        assert items._overrides == {2: {'dataset_name': 'obs.d1__root'}}
+        assert items.select([1], rse='RSE')[0] == dict(items[1], rse='RSE')
+
+        decoded = UploadItems.from_dict(json.loads(json.dumps(items.to_dict())))
+        assert decoded == items and decoded.get_size(1) == 100 * 1024**2
+
+    def test_items_expanded_in_chunks(self):
+        """ Check that a step's items are expanded a chunk at a time when it is run. """
+        items = UploadItems(self.defaults)
+        for idx in range(2500):
+            items.append({'path': '/src/obs/d1/f{}'.format(idx), 'did_name': 'obs.d1.f{}'.format(idx)})
+        upload = mock.Mock(return_value=0)
+        call_with_arguments(upload, {'items': items})
+        assert [len(call.kwargs['items']) for call in upload.call_args_list] == [1000, 1000, 500]
+        assert upload.call_args_list[-1].kwargs['items'][-1] == items[-1]
+
+    def test_plan_items_are_compact(self, tmp_path):
+        """ Check that planned upload steps hold compact items, which survive saving and loading the plan. """
+        for path in ['d1/f1', 'd1/f2', 'd2/f3']:
+            (tmp_path / 'obs' / path).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / 'obs' / path).write_text(path)
+        with FakeRucio(storage_dir=str(tmp_path / 'storage')).patch():
+            plan = UploadPlanNative.make_plan_from_directory(
+                str(tmp_path / 'obs'), 'obs', rse='RSE', scope='scope', lifetime=3600, do_checksum=False)
+            uploads = [step for step in plan.steps if step.section_name == 'upload_files']
+            assert all(isinstance(step.arguments['items'], UploadItems) for step in uploads)
+            assert sorted(item['did_name'] for step in uploads for item in step.arguments['items']) == \
+                ['obs.d1.f1', 'obs.d1.f2', 'obs.d2.f3']
+            assert all(item['transfer_timeout'] == get_transfer_timeout(5) for step in uploads
+                       for item in step.arguments['items'])
+            assert not any(step.arguments['items']._overrides for step in uploads)
+
+            step = Step.from_dict(json.loads(json.dumps(uploads[0].to_dict())), {})
+            assert step.arguments['items'] == uploads[0].arguments['items']
+            assert step.n_items == uploads[0].n_items
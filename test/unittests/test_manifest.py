@@ -0,0 +1,39 @@
+from pytest_unordered import unordered
+
+from rucio_extended_client.api.manifest import Manifest
+
+
+class TestManifest:
+    files = {
+        'f1': ('scope:f1', 1),
+        'd1/d1_f1': ('scope:d1_f1', 10),
+        'd1/d1_d1/d1_d1_f1': ('scope:d1_d1_f1', 100),
+        'd1-b/d1-b_f1': ('scope:d1-b_f1', 1000),
+        'd2/d2_d1/d2_d1_f1': ('scope:d2_d1_f1', 10000)
+    }
+    dirs = ['d1', 'd1/d1_d1', 'd1-b', 'd2', 'd2/d2_d1', 'd4/d4_d1']
+
+    manifest = Manifest(files, dirs)
+
+    def test_manifest_ls(self):
+        """ Check that only immediate children are listed, including those sorting between a directory and its
+        contents. """
+        assert [entry['path'] for entry in self.manifest.ls()] == ['d1', 'd1-b', 'd2', 'd4', 'f1']
+        assert self.manifest.ls('d1') == unordered([
+            {'path': 'd1/d1_d1', 'type': 'dir', 'bytes': 100},
+            {'path': 'd1/d1_f1', 'type': 'file', 'did': 'scope:d1_f1', 'bytes': 10}
+        ])
+        assert self.manifest.ls('d4/d4_d1') == []
+
+    def test_manifest_du(self):
+        """ Check the file counts and sizes beneath a path. """
+        assert self.manifest.du() == {'path': '', 'n_files': 5, 'n_dirs': 7, 'bytes': 11111}
+        assert self.manifest.du('d1/') == {'path': 'd1', 'n_files': 2, 'n_dirs': 1, 'bytes': 110}
+        assert self.manifest.du('d1/d1_f1') == {'path': 'd1/d1_f1', 'n_files': 1, 'n_dirs': 0, 'bytes': 10}
+
+    def test_manifest_save_load(self, tmp_path):
+        """ Check that a cached manifest gives the same answers. """
+        self.manifest.save(tmp_path / 'manifest.json')
+        manifest = Manifest.load(tmp_path / 'manifest.json')
+        assert manifest.du('d1') == self.manifest.du('d1')
+        assert manifest.ls('d2') == self.manifest.ls('d2')
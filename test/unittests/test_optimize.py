@@ -0,0 +1,66 @@
+import os
+
+from rucio_extended_client.api.plan import Plan
+from rucio_extended_client.testing.fake import FakeDIDClient, FakeRucio
+
+
+def noop(value=None):
+    pass
+
+
+class TestOptimize:
+    def test_optimize_plan(self):
+        """ Check that duplicate steps and implied directories are removed, and catalog steps coalesced. """
+        did_client = FakeDIDClient(FakeRucio())
+        plan = Plan()
+        for path in ['root/d1', 'root/d1/d1_d1', 'root', 'root/d1/d1_d1', 'root/d2']:
+            plan.append_step("create_directories", fqn=os.makedirs, arguments={'name': path, 'exist_ok': True})
+        for name in ['c1', 'c2']:
+            plan.append_step("create_collections", fqn=did_client.add_container,
+                             arguments={'scope': 'scope', 'name': name})
+            plan.append_step("create_attachments", fqn=did_client.add_containers_to_containers, arguments={
+                'attachments': [{'scope': 'scope', 'name': 'root', 'dids': [{'scope': 'scope', 'name': name}]}]
+            })
+        plan.append_step("create_collections", fqn=did_client.add_dataset, arguments={'scope': 'scope', 'name': 'd1'})
+
+        report = plan.optimize()
+        assert report == {'n_steps': 10, 'n_duplicates': 1, 'n_implied_directories': 2, 'n_coalesced': 3,
+                          'n_removed': 6}
+        assert [(step.section_name, step.fqn.__name__) for step in plan.steps] == [
+            ('create_directories', 'makedirs'),
+            ('create_directories', 'makedirs'),
+            ('create_collections', 'add_dids'),
+            ('create_attachments', 'add_containers_to_containers')
+        ]
+        assert [step.arguments['name'] for step in plan.steps[:2]] == ['root/d1/d1_d1', 'root/d2']
+        assert [did['type'] for did in plan.steps[2].arguments['dids']] == ['CONTAINER', 'CONTAINER', 'DATASET']
+        assert plan.steps[3].n_items == 2
+
+    def test_optimize_plan_keeps_order(self):
+        """ Check that steps already run or skipped, and steps in unknown sections, are left in order. """
+        plan = Plan()
+        for section_name, value in [('b', 1), ('a', 2), ('a', 2), ('b', 3), ('a', 2)]:
+            plan.append_step(section_name, fqn=noop, arguments={'value': value})
+        plan.current_step_number = 2
+        report = plan.optimize()
+        assert report['n_removed'] == 1
+        assert [(step.section_name, step.arguments['value']) for step in plan.steps] == [
+            ('b', 1), ('a', 2), ('a', 2), ('b', 3)]
+
+    def test_optimize_plan_metadata(self):
+        """ Check that metadata steps are coalesced into the arguments Rucio's set_dids_metadata_bulk expects. """
+        rucio = FakeRucio()
+        did_client = FakeDIDClient(rucio)
+        plan = Plan()
+        for name in ['c1', 'c2']:
+            did_client.add_container(scope='scope', name=name)
+            plan.append_step("add_metadata", fqn=did_client.set_metadata_bulk, arguments={
+                'scope': 'scope', 'name': name, 'meta': {'hierarchy': {'n_files': 1}}})
+        plan.optimize()
+        assert [step.fqn.__name__ for step in plan.steps] == ['set_dids_metadata_bulk']
+        assert plan.steps[0].arguments == {'dids': [
+            {'scope': 'scope', 'name': 'c1', 'meta': {'hierarchy': {'n_files': 1}}},
+            {'scope': 'scope', 'name': 'c2', 'meta': {'hierarchy': {'n_files': 1}}}
+        ]}
+        plan.run(optimize=False)
+        assert rucio.metadata[('scope', 'c2')] == {'hierarchy': {'n_files': 1}}
@@ -0,0 +1,150 @@
+import json
+import os
+
+import pytest
+
+from rucio_extended_client.api.partition import ShardJournal, ShardRunner, partition_plan, save_partitioned_plan
+from rucio_extended_client.api.plan import DownloadPlanNative, Plan, UploadPlanNative
+from rucio_extended_client.api.verification import verify_dir_checksum
+from rucio_extended_client.common.compression import DEFAULT_STAGING_DIRECTORY
+from rucio_extended_client.common.exceptions import ChecksumVerificationError, DataFormatError, ShardDependencyError
+from rucio_extended_client.testing.fake import FakeRucio
+
+
+def noop():
+    pass
+
+
+def make_directory(root):
+    for path, size in [('d1/d1_d1/f1', 100), ('d1/f2', 10), ('d2/f3', 50), ('d3/f4', 60), ('f5', 1)]:
+        os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+        with open(os.path.join(root, path), 'w') as fi:
+            fi.write('x' * size)
+
+
+def make_download_plan(sizes):
+    plan = Plan()
+    plan.append_step("create_directories", fqn=noop)
+    for idx, size_bytes in enumerate(sizes):
+        plan.append_step("download_files", fqn=noop, arguments={'items': [
+            {'did': 's:a{}'.format(idx), 'base_dir': 'd', 'no_subdir': True}]}, size_bytes=size_bytes)
+        plan.append_step("rename_files", fqn=noop, arguments={'src': os.path.join('d', 'a{}'.format(idx)),
+                                                              'dst': os.path.join('d', 'b{}'.format(idx))})
+    plan.append_step("add_metadata", fqn=noop)
+    return plan
+
+
+class TestPartition:
+    def test_partition_plan(self):
+        """ Check that transfers are balanced by bytes and renames stay with their download. """
+        plan = make_download_plan([10, 50, 40, 30])
+        shards = partition_plan(plan, 2)
+        assert list(shards) == ['coordinator', 'transfer-0', 'transfer-1', 'final']
+        assert shards['coordinator'].number_of_steps == 1
+        assert shards['final'].number_of_steps == 1
+        assert [step.size_bytes for step in shards['transfer-0'].steps if step.section_name == 'download_files'] == \
+            [10, 50]
+        assert [step.size_bytes for step in shards['transfer-1'].steps if step.section_name == 'download_files'] == \
+            [40, 30]
+        for name in ['transfer-0', 'transfer-1']:
+            steps = shards[name].steps
+            for download, rename in zip(steps[::2], steps[1::2]):
+                assert rename.arguments['src'] == os.path.join('d', download.arguments['items'][0]['did'][2:])
+
+    def test_partition_optimized_plan(self):
+        """ Check that renames stay with their download when the optimizer has put every rename after every download,
+        and renames of files no download step downloads are left to the final shard.
+        """
+        plan = make_download_plan([10, 50, 40, 30])
+        plan.append_step("rename_files", fqn=noop, arguments={'src': 'elsewhere', 'dst': 'elsewhere2'})
+        plan.optimize()
+        assert [step.section_name for step in plan.steps[1:]] == ['download_files'] * 4 + ['rename_files'] * 5 + \
+            ['add_metadata']
+        shards = partition_plan(plan, 2)
+        for name in ['transfer-0', 'transfer-1']:
+            steps = shards[name].steps
+            assert [step.section_name for step in steps] == ['download_files', 'rename_files'] * 2
+            for download, rename in zip(steps[::2], steps[1::2]):
+                assert rename.arguments['src'] == os.path.join('d', download.arguments['items'][0]['did'][2:])
+        assert [step.arguments['src'] for step in shards['final'].steps if step.section_name == 'rename_files'] == \
+            ['elsewhere']
+
+    def test_partition_plan_default_staging_directory(self, tmp_path):
+        """ Check that plans staging compressed files where other hosts can't read them are not partitioned. """
+        plan = Plan()
+        plan.append_step("compress_files", fqn=noop, arguments={
+            'src': 'f1', 'dst': os.path.join(DEFAULT_STAGING_DIRECTORY, 'scope', 'root', 'f1')})
+        with pytest.raises(DataFormatError):
+            partition_plan(plan, 2)
+        plan.steps[0].arguments['dst'] = str(tmp_path / 'staging' / 'f1')
+        assert partition_plan(plan, 2)['coordinator'].number_of_steps == 1
+
+    def test_partition_plan_unknown_section(self):
+        """ Check that plans with sections of unknown dependencies are not partitioned. """
+        plan = Plan()
+        plan.append_step("do_something", fqn=noop)
+        with pytest.raises(DataFormatError):
+            partition_plan(plan, 2)
+
+    def test_run_shards(self, tmp_path, monkeypatch):
+        """ Check that a partitioned upload, run shard by shard, can be downloaded again. """
+        make_directory(str(tmp_path / 'src'))
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        with rucio.patch():
+            plan = UploadPlanNative.make_plan_from_directory(
+                str(tmp_path / 'src'), 'root', rse='RSE', scope='scope', lifetime=3600)
+            manifest_path = save_partitioned_plan(plan, 3, str(tmp_path / 'upload'))
+            with open(manifest_path) as fi:
+                shard_names = [shard['name'] for shard in json.load(fi)['shards']]
+
+            with pytest.raises(ShardDependencyError):
+                ShardRunner(manifest_path, 'final').run(wait=False)
+            for name in shard_names:
+                ShardRunner(manifest_path, name).run(wait=False)
+            ShardRunner(manifest_path, 'final').run(wait=False)      # already done, so a no-op
+
+            state = ShardJournal(str(tmp_path / 'upload.journal')).read()
+            assert all(state[name]['is_done'] for name in shard_names)
+            assert rucio.calls['upload_item'] == 5
+            assert rucio.calls['set_metadata_bulk'] == 1
+
+    @pytest.mark.parametrize('corrupt', [False, True])
+    def test_run_download_shards_verify(self, tmp_path, monkeypatch, corrupt):
+        """ Check that the final shard of a partitioned download verifies the directory checksum once every transfer
+        shard is done.
+        """
+        make_directory(str(tmp_path / 'src'))
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        with rucio.patch():
+            UploadPlanNative.make_plan_from_directory(
+                str(tmp_path / 'src'), 'root', rse='RSE', scope='scope', lifetime=3600).run()
+            plan = DownloadPlanNative.make_plan_from_did('scope', 'root', clobber=False, show_tree=False)
+            plan.append_step("verify_dir_checksum", fqn=verify_dir_checksum, arguments={
+                'scope': 'scope', 'name': 'root', 'metadata_plugin': 'json', 'hierarchy_key': 'hierarchy'})
+            shards = partition_plan(plan, 2)
+            assert [step.section_name for step in shards['final'].steps] == ['verify_dir_checksum']
+
+            manifest_path = save_partitioned_plan(plan, 2, str(tmp_path / 'download'))
+            for name in ['coordinator', 'transfer-0', 'transfer-1']:
+                ShardRunner(manifest_path, name).run(wait=False)
+            if corrupt:
+                with open(str(tmp_path / 'root' / 'f5'), 'w') as fi:
+                    fi.write('y')
+                with pytest.raises(ChecksumVerificationError):
+                    ShardRunner(manifest_path, 'final').run(wait=False)
+            else:
+                ShardRunner(manifest_path, 'final').run(wait=False)
+            assert ShardJournal(str(tmp_path / 'download.journal')).read()['final']['is_done'] is not corrupt
+
+    def test_run_shard_resume(self, tmp_path):
+        """ Check that steps recorded as done in the journal are skipped. """
+        plan = Plan()
+        plan.append_step("create_directories", fqn=os.makedirs, arguments={'name': str(tmp_path / 'a')})
+        plan.append_step("create_directories", fqn=os.makedirs, arguments={'name': str(tmp_path / 'b')})
+        manifest_path = save_partitioned_plan(plan, 1, str(tmp_path / 'plan'))
+        ShardJournal(str(tmp_path / 'plan.journal')).record('coordinator', 'step_done', 0)
+        ShardRunner(manifest_path, 'coordinator').run()
+        assert not os.path.exists(str(tmp_path / 'a'))
+        assert os.path.isdir(str(tmp_path / 'b'))
@@ -0,0 +1,92 @@
+import json
+
+from rucio_extended_client.api.metrics import PlanMetrics
+from rucio_extended_client.api.plan import Plan
+from rucio_extended_client.testing.fake import FakeDIDClient, FakeRucio, FakeUploadClient
+
+
+def add(a, b):
+    return a + b
+
+
+def fail():
+    raise ValueError("step failed")
+
+
+class TestPlanMetrics:
+    def test_plan_metrics_record(self, tmp_path):
+        """ Check that steps are recorded per section and reported. """
+        plan = Plan()
+        plan.append_step("add_numbers", fqn=add, arguments={'a': 1, 'b': 2}, size_bytes=10)
+        plan.append_step("add_numbers", fqn=add, arguments={'a': 3, 'b': 4}, size_bytes=20)
+        plan.metrics = PlanMetrics(json_path=str(tmp_path / 'report.json'),
+                                   prometheus_path=str(tmp_path / 'report.prom'))
+        assert plan.run_next_step() == 3
+        assert plan.run_next_step() == 7
+        plan.metrics.report()
+
+        with open(tmp_path / 'report.json') as fi:
+            report = json.load(fi)
+        section = report['sections']['add_numbers']
+        assert section['n_steps'] == 2
+        assert section['n_failed'] == 0
+        assert section['bytes'] == 30
+        assert section['calls'] == {'add': 2}
+        assert section['latency_histogram']['0.01'] == 2
+
+        with open(tmp_path / 'report.prom') as fi:
+            prometheus = fi.read()
+        assert 'rucio_extended_plan_steps_total{section="add_numbers",status="success"} 2' in prometheus
+        assert 'rucio_extended_plan_step_duration_seconds_bucket{section="add_numbers",le="+Inf"} 2' in prometheus
+
+    def test_plan_metrics_record_failure(self):
+        """ Check that failed steps are recorded as failures. """
+        plan = Plan()
+        plan.append_step("fail", fqn=fail, size_bytes=10)
+        plan.metrics = PlanMetrics()
+        try:
+            plan.run_next_step()
+        except ValueError:
+            pass
+        assert plan.metrics.sections['fail'].n_failed == 1
+        assert plan.metrics.sections['fail'].bytes == 0
+
+
+class TestPlanSummary:
+    def test_plan_summarise(self, capsys):
+        """ Check that steps are summarised per section, with catalog calls and transfers counted separately. """
+        did_client = FakeDIDClient(FakeRucio())
+        upload_client = FakeUploadClient(did_client.rucio)
+        plan = Plan()
+        plan.append_step("create_root_container", fqn=did_client.add_container, arguments={
+            'scope': 'scope', 'name': 'root'})
+        plan.append_step("upload_files", fqn=upload_client.upload, arguments={'items': [{}, {}, {}]}, size_bytes=30)
+        plan.append_step("upload_files", fqn=upload_client.upload, arguments={'items': [{}]}, size_bytes=10,
+                         is_done=True)
+        plan.append_step("add_numbers", fqn=add, arguments={'a': 1, 'b': 2})
+
+        summary = plan.summarise()
+        assert list(summary['sections']) == ['create_root_container', 'upload_files', 'add_numbers']
+        assert summary['sections']['create_root_container']['n_catalog_calls'] == 1
+        assert summary['sections']['upload_files'] == {
+            'n_steps': 2, 'n_done': 1, 'n_items': 4, 'bytes': 40, 'bytes_done': 10, 'n_catalog_calls': 0,
+            'n_transfers': 4}
+        assert summary['total']['n_steps'] == 4
+        assert summary['total']['n_catalog_calls'] == 1
+
+        plan.describe(bandwidth=10)
+        output = capsys.readouterr().out
+        assert "3 steps pending (30 bytes)" in output
+        assert "'items'" not in output
+
+    def test_plan_describe_full_page(self, capsys):
+        """ Check that the full listing can be paginated. """
+        plan = Plan()
+        for idx in range(5):
+            plan.append_step("add_numbers", fqn=add, arguments={'a': idx, 'b': 0})
+        plan.describe(full=True, page=2, page_size=2)
+        output = capsys.readouterr().out
+        assert "Page 2 of 3" in output
+        assert "2: (add_numbers) RUN function" in output
+        assert "3: (add_numbers) RUN function" in output
+        assert "4: (add_numbers)" not in output
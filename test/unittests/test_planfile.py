@@ -0,0 +1,96 @@
+import json
+import os
+import subprocess
+import sys
+
+from rucio_extended_client.api.clients import get_deferred_client
+from rucio_extended_client.api.plan import Plan
+from rucio_extended_client.api.planfile import PlanFileReader, compact_plan_file
+
+CALLS = []
+
+
+def append(value):
+    CALLS.append(value)
+
+
+def make_plan():
+    plan = Plan(root_suffix='__root', path_delimiter='.')
+    plan.append_step("create_directories", fqn=append, arguments={'value': 'd1'}, is_done=True)
+    for idx in range(1, 5):
+        plan.append_step("upload_files", fqn=append, arguments={'value': 'f{}'.format(idx)},
+                         size_bytes=idx * 1024**3, is_done=idx == 2)
+    return plan
+
+
+class TestPlanFile:
+    def test_plan_file_round_trip(self, tmp_path):
+        """ Check that a saved plan is still a JSON document, and is summarised and filtered without loading it. """
+        plan = make_plan()
+        plan.save(str(tmp_path / 'plan.json'))
+        with open(str(tmp_path / 'plan.json')) as fi:
+            assert len(json.load(fi)['steps']) == 5
+        loaded_plan = Plan.load(str(tmp_path / 'plan.json'))
+        assert [step.to_dict() for step in loaded_plan.steps] == [step.to_dict() for step in plan.steps]
+
+        reader = PlanFileReader(str(tmp_path / 'plan.json'))
+        assert reader.is_streamable
+        assert reader.summary == plan.summarise()
+        assert [step_number for step_number, _, _ in reader.iter_steps(is_done=False)] == [1, 3, 4]
+        assert [step_number for step_number, _, _ in reader.iter_steps(section_name='upload_files', pattern='f[34]')] \
+            == [3, 4]
+
+    def test_plan_file_compact(self, tmp_path):
+        """ Check that compacting a plan drops the steps that are done or skipped. """
+        make_plan().save(str(tmp_path / 'plan.json'))
+        assert compact_plan_file(str(tmp_path / 'plan.json'), str(tmp_path / 'compact.json')) == 2
+        plan = Plan.load(str(tmp_path / 'compact.json'))
+        assert [step.arguments['value'] for step in plan.steps] == ['f1', 'f3', 'f4']
+        assert PlanFileReader(str(tmp_path / 'compact.json')).summary == plan.summarise()
+
+        # steps before the current step were skipped, so are dropped too
+        plan = make_plan()
+        plan.current_step_number = 3
+        plan.save(str(tmp_path / 'plan.json'))
+        assert compact_plan_file(str(tmp_path / 'plan.json'), str(tmp_path / 'compact.json')) == 3
+        plan = Plan.load(str(tmp_path / 'compact.json'))
+        assert [step.arguments['value'] for step in plan.steps] == ['f3', 'f4'] and plan.current_step_number == 0
+
+    def test_plan_file_legacy(self, tmp_path):
+        """ Check that plans saved as a single indented document are still read. """
+        plan = make_plan()
+        with open(str(tmp_path / 'plan.json'), 'w') as fi:
+            json.dump({
+                'current_step_number': 0,
+                'path_delimiter': '.',
+                'hierarchy_key': None,
+                'root_suffix': '__root',
+                'steps': [step.to_dict() for step in plan.steps]
+            }, fi, indent=2)
+        reader = PlanFileReader(str(tmp_path / 'plan.json'))
+        assert not reader.is_streamable
+        assert reader.summary == plan.summarise()
+        assert compact_plan_file(str(tmp_path / 'plan.json')) == 2
+        assert PlanFileReader(str(tmp_path / 'plan.json')).is_streamable
+
+    def test_plan_inspection_does_not_import_rucio(self, tmp_path):
+        """ Check that the command line client, the plans, and loading or inspecting a saved plan don't import Rucio
+        (or the other modules only imported when used).
+        """
+        plan = Plan()
+        plan.append_step("create_directories", fqn=os.makedirs, arguments={'name': 'd1', 'exist_ok': True})
+        plan.append_step("create_collections", fqn=get_deferred_client('DIDClient').add_dataset,
+                         arguments={'scope': 'scope', 'name': 'd1'})
+        plan.save(str(tmp_path / 'plan.json'))
+        script = "; ".join([
+            "import sys",
+            "from rucio_extended_client.cli.plan import Plan as PlanCommands",
+            "from rucio_extended_client.cli.directory import Directory",
+            "from rucio_extended_client.api.plan import Plan",
+            "from rucio_extended_client.api.planfile import PlanFileReader",
+            "PlanFileReader(sys.argv[1]).summary",
+            "Plan.load(sys.argv[1])",
+            "print([name for name in ('dirhash', 'rucio', 'treelib') if name in sys.modules])"
+        ])
+        output = subprocess.check_output([sys.executable, '-c', script, str(tmp_path / 'plan.json')])
+        assert output.decode().strip() == '[]'
@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+
+from dirhash import dirhash
+import pytest
+
+from rucio_extended_client.api.plan import DownloadPlanNative, Plan, UploadPlanMetadata, UploadPlanNative
+from rucio_extended_client.api.runners import AsyncPlanRunner, HybridPlanRunner
+from rucio_extended_client.api.sections import group_steps_into_phases
+from rucio_extended_client.common.checksum import get_dir_checksum_algorithm
+from rucio_extended_client.testing.fake import FakeRucio
+
+
+class Recorder:
+    """ Records the maximum number of concurrent calls. """
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(seconds)
+        with self.lock:
+            self.in_flight -= 1
+
+
+def noop():
+    pass
+
+
+def append(calls, value):
+    calls.append(value)
+
+
+class TestSections:
+    def test_group_steps_into_phases_known_sections(self):
+        """ Check that steps in known sections are grouped by section order, not plan order. """
+        plan = Plan()
+        for section_name in ['create_collections', 'create_attachments', 'upload_files', 'create_collections',
+                             'create_attachments', 'add_metadata']:
+            plan.append_step(section_name, fqn=noop)
+        assert group_steps_into_phases(plan.steps) == [[0, 3], [1, 4], [2], [5]]
+
+    def test_group_steps_into_phases_unknown_sections(self):
+        """ Check that steps are grouped by consecutive runs of a section if any section is unknown. """
+        plan = Plan()
+        for section_name in ['a', 'a', 'b', 'a']:
+            plan.append_step(section_name, fqn=noop)
+        assert group_steps_into_phases(plan.steps) == [[0, 1], [2], [3]]
+
+
+class TestAsyncPlanRunner:
+    def test_async_runner_concurrency(self):
+        """ Check that steps of a phase run concurrently up to the limit for their operation class. """
+        recorder = Recorder()
+        plan = Plan()
+        for _ in range(12):
+            plan.append_step("sleep", fqn=recorder.sleep, arguments={'seconds': 0.05})
+        plan.append_step("done", fqn=noop, is_done=True)
+        AsyncPlanRunner(plan, concurrency={'local': 4}).run()
+        assert recorder.max_in_flight == 4
+        assert all(step.is_done for step in plan.steps)
+        assert plan.current_step_number == plan.number_of_steps
+
+    def test_async_runner_round_trip(self, tmp_path, monkeypatch):
+        """ Check that a native upload run asynchronously can be downloaded again. """
+        for path in ['d1/d1_d1/f1', 'd1/f2', 'd2/f3', 'f4']:
+            os.makedirs(os.path.dirname(str(tmp_path / 'src' / path)), exist_ok=True)
+            with open(str(tmp_path / 'src' / path), 'w') as fi:
+                fi.write(path)
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'), latency=0.01)
+        with rucio.patch():
+            plan = UploadPlanNative.make_plan_from_directory(
+                str(tmp_path / 'src'), 'root', rse='RSE', scope='scope', lifetime=3600)
+            AsyncPlanRunner(plan).run()
+            plan = DownloadPlanNative.make_plan_from_did('scope', 'root', clobber=False, show_tree=False)
+            AsyncPlanRunner(plan).run()
+        with open(str(tmp_path / 'root' / 'd1' / 'd1_d1' / 'f1')) as fi:
+            assert fi.read() == 'd1/d1_d1/f1'
+        assert os.path.isfile(str(tmp_path / 'root' / 'f4'))
+
+    def test_async_runner_verifies_last(self):
+        """ Check that verification steps are run after every other step, once abandoned copies are cleaned up. """
+        calls = []
+        plan = Plan()
+        plan.append_step("verify_dir_checksum", fqn=append, arguments={'calls': calls, 'value': 'verify'})
+        plan.append_step("add_metadata", fqn=append, arguments={'calls': calls, 'value': 'metadata'})
+        AsyncPlanRunner(plan).run()
+        assert calls == ['metadata', 'verify']
+        assert all(step.is_done for step in plan.steps)
+
+    def test_plan_run_resumes_after_async_runner(self):
+        """ Check that Plan.run skips steps that are already done, wherever they are. """
+        calls = []
+        plan = Plan()
+        for idx in range(4):
+            plan.append_step("step", fqn=append, arguments={'calls': calls, 'value': idx}, is_done=idx in (1, 3))
+        plan.run()
+        assert calls == [0, 2]
+
+
+class TestHybridPlanRunner:
+    @pytest.mark.parametrize('algorithm', ['md5', 'sha256'])
+    def test_hybrid_runner_dir_checksum(self, tmp_path, monkeypatch, algorithm):
+        """ Check that the directory checksum calculated while uploading matches dirhash with the algorithm recorded.
+        """
+        for path in ['d1/d1_d1/f1', 'd1/f2', 'd2/f3', 'f4']:
+            os.makedirs(os.path.dirname(str(tmp_path / 'src' / path)), exist_ok=True)
+            with open(str(tmp_path / 'src' / path), 'w') as fi:
+                fi.write(path)
+        os.makedirs(str(tmp_path / 'src' / 'd3'))
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        with rucio.patch():
+            plan = UploadPlanMetadata.make_plan_from_directory(
+                str(tmp_path / 'src'), 'root', rse='RSE', scope='scope', lifetime=3600, do_checksum=False,
+                dir_checksum_algorithm=algorithm)
+            HybridPlanRunner(plan, n_processes=2, root_directory=str(tmp_path / 'src'), max_queued_hashes=2).run()
+        metadata_hierarchy = rucio.metadata[('scope', 'root')]['hierarchy']
+        assert get_dir_checksum_algorithm(metadata_hierarchy) == algorithm
+        assert metadata_hierarchy['dir_checksum'] == dirhash(str(tmp_path / 'src'), algorithm=algorithm, empty_dirs=True)
+
+    def test_hybrid_runner_resumes_dir_checksum(self, tmp_path, monkeypatch):
+        """ Check that a dumped hybrid plan keeps the uploaded directory, so that resuming it calculates the checksum.
+        """
+        for path in ['d1/f1', 'f2']:
+            os.makedirs(os.path.dirname(str(tmp_path / 'src' / path)), exist_ok=True)
+            with open(str(tmp_path / 'src' / path), 'w') as fi:
+                fi.write(path)
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        with rucio.patch():
+            plan = UploadPlanMetadata.make_plan_from_directory(
+                str(tmp_path / 'src'), 'root', rse='RSE', scope='scope', lifetime=3600, do_checksum=False)
+            plan.root_directory = str(tmp_path / 'src')
+            plan.save(str(tmp_path / 'plan.json'))
+            plan = UploadPlanMetadata.load(str(tmp_path / 'plan.json'))
+            assert plan.root_directory == str(tmp_path / 'src')
+            HybridPlanRunner(plan, n_processes=2).run()
+        metadata_hierarchy = rucio.metadata[('scope', 'root')]['hierarchy']
+        assert metadata_hierarchy['dir_checksum'] == dirhash(str(tmp_path / 'src'), algorithm='md5', empty_dirs=True)
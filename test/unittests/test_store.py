@@ -0,0 +1,56 @@
+import pytest
+
+from rucio_extended_client.api.plan import Plan
+from rucio_extended_client.api.store import PlanStore
+
+CALLS = []
+
+
+def append(value):
+    CALLS.append(value)
+
+
+def fail_once(value):
+    if value not in CALLS:
+        CALLS.append(value)
+        raise RuntimeError("failed")
+
+
+def make_plan():
+    plan = Plan(root_suffix='__root', path_delimiter='.')
+    plan.append_step("create_directories", fqn=append, arguments={'value': 0})
+    for idx in range(1, 5):
+        plan.append_step("upload_files", fqn=append, arguments={'value': idx}, size_bytes=idx * 1024**3,
+                         is_done=idx == 2)
+    return plan
+
+
+class TestPlanStore:
+    def test_store_round_trip_and_query(self, tmp_path):
+        """ Check that a plan saved as a store can be queried and loaded again. """
+        plan = make_plan()
+        plan.save(str(tmp_path / 'plan.sqlite'))
+        with PlanStore(str(tmp_path / 'plan.sqlite')) as store:
+            assert store.get_attributes() == {'root_suffix': '__root', 'path_delimiter': '.', 'hierarchy_key': None}
+            assert [step['step_number'] for step in store.query(
+                section_name='upload_files', is_done=False, min_bytes=2 * 1024**3)] == [3, 4]
+            assert store.count(is_done=True) == 1
+            assert store.summarise() == plan.summarise()
+        loaded_plan = Plan.load(str(tmp_path / 'plan.sqlite'))
+        assert [step.to_dict() for step in loaded_plan.steps] == [step.to_dict() for step in plan.steps]
+        assert loaded_plan.root_suffix == '__root'
+
+    def test_store_run_resumes(self, tmp_path):
+        """ Check that running a store a page at a time marks steps as done, so that a failed run can be resumed. """
+        plan = make_plan()
+        plan.append_step("add_metadata", fqn=fail_once, arguments={'value': 'metadata'})
+        plan.current_step_number = 1            # the first step has been skipped
+        CALLS.clear()
+        with PlanStore.from_plan(plan, str(tmp_path / 'plan.db')) as store:
+            with pytest.raises(SystemExit):
+                store.run(page_size=2)
+            assert CALLS == [1, 3, 4, 'metadata']
+            assert store.count(is_done=False) == 1
+            store.run(page_size=2)
+            assert CALLS == [1, 3, 4, 'metadata']
+            assert store.count(is_done=False) == 0
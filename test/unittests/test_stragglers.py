@@ -0,0 +1,74 @@
+import os
+import time
+
+from rucio_extended_client.api.clients import get_deferred_client
+from rucio_extended_client.api.plan import Plan
+from rucio_extended_client.api.runners import AsyncPlanRunner
+from rucio_extended_client.api.stragglers import DEFAULT_TRANSFER_TIMEOUT, SPECULATIVE_DIRECTORY, StragglerPolicy, \
+    get_transfer_timeout, make_speculative_items
+from rucio_extended_client.testing.fake import FakeRucio, FakeUploadClient
+
+
+class TestStragglers:
+    def test_get_transfer_timeout(self):
+        """ Check that transfer timeouts grow with the size of the file. """
+        assert get_transfer_timeout() == DEFAULT_TRANSFER_TIMEOUT
+        assert get_transfer_timeout(0) == 60
+        assert get_transfer_timeout(100 * 1024**2) == 160
+        assert get_transfer_timeout(100 * 1024**2, min_bytes_per_second=10 * 1024**2, min_seconds=0) == 10
+
+    def test_straggler_policy(self):
+        """ Check that a step is only a straggler once enough steps have finished, and it is slow enough. """
+        policy = StragglerPolicy(slowdown=4, min_seconds=1, min_samples=3)
+        for seconds in (1, 2, 10):
+            assert not policy.is_straggler(1024, 100)
+            policy.record(1024, seconds)
+        assert policy.median_rate == 512
+        assert not policy.is_straggler(1024, 7)
+        assert policy.is_straggler(1024, 9)
+        assert not policy.is_straggler(1, 0.5)          # quicker than min_seconds
+        assert not policy.is_straggler(None, 100)       # unknown size
+
+    def test_make_speculative_items(self):
+        """ Check that speculative copies are downloaded aside, from a replica other than the first listed. """
+        items = [{'did': 's:f1', 'base_dir': 'd'}, {'did': 's:f2', 'base_dir': 'd'}]
+        assert make_speculative_items(items, {'s:f1': ['A', 'B'], 's:f2': ['A']}) == [
+            {'did': 's:f1', 'base_dir': os.path.join('d', SPECULATIVE_DIRECTORY), 'rse': 'B'},
+            {'did': 's:f2', 'base_dir': os.path.join('d', SPECULATIVE_DIRECTORY)}
+        ]
+
+    def test_speculative_download(self, tmp_path):
+        """ Check that a download from a slow replica is overtaken by a speculative copy from another replica, that the
+        run doesn't wait for the copy that lost, and that nothing is left behind by it once it has finished.
+        """
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        for idx in range(6):
+            with open(str(tmp_path / 'f{}'.format(idx)), 'w') as fi:
+                fi.write('f{}'.format(idx) * 100)
+            for rse in (['SLOW', 'FAST'] if idx == 5 else ['FAST']):
+                FakeUploadClient(rucio).upload([{'path': str(tmp_path / 'f{}'.format(idx)), 'rse': rse,
+                                                 'did_scope': 'scope'}])
+        rucio.rse_latency = {'SLOW': 2.}
+
+        download_client = get_deferred_client('DownloadClient')
+        plan = Plan()
+        for idx in range(6):
+            plan.append_step("download_files", fqn=download_client.download_dids, arguments={'items': [{
+                'did': 'scope:f{}'.format(idx), 'base_dir': str(tmp_path / 'dst'), 'no_subdir': True
+            }]}, size_bytes=200)
+            plan.append_step("rename_files", fqn=os.rename, arguments={
+                'src': str(tmp_path / 'dst' / 'f{}'.format(idx)),
+                'dst': str(tmp_path / 'dst' / 'g{}'.format(idx))
+            })
+        policy = StragglerPolicy(slowdown=2, min_seconds=0.1, min_samples=5, check_interval=0.05)
+        with rucio.patch():
+            runner = AsyncPlanRunner(plan, concurrency={'transfer': 1}, stragglers=policy)
+            st = time.perf_counter()
+            runner.run()
+            assert time.perf_counter() - st < 1.5
+
+            assert policy.n_stragglers == 1 and policy.n_speculative_wins == 1
+            assert runner.wait_for_abandoned(timeout=5)
+        assert sorted(os.listdir(str(tmp_path / 'dst'))) == ['g{}'.format(idx) for idx in range(6)]
+        with open(str(tmp_path / 'dst' / 'g5')) as fi:
+            assert fi.read() == 'f5' * 100
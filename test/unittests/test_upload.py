@@ -1,6 +1,8 @@
 import tempfile
 
 from rucio_extended_client.api.plan import UploadPlanMetadata, UploadPlanNative
+from rucio_extended_client.api.scheduling import WeightedStriper
+from rucio_extended_client.testing.fake import FakeRucio
 
 
 class TestUploadFolderMetadata:
@@ -114,3 +116,44 @@ class TestUploadFolderNative:
                 assert len([step for step in self.plan.steps if step.section_name == section]) == 1
 
 
+
+
+class TestUploadStriped:
+    def test_weighted_striper(self):
+        """ Check that items are striped across targets in proportion to their weights, balanced by bytes. """
+        striper = WeightedStriper({'A': 1, 'B': 3})
+        striped = striper.stripe({idx: 100 for idx in range(8)})
+        assert sorted(len(items) for items in striped.values()) == [2, 6]
+        assert striper.bytes == {'A': 200, 'B': 600}
+
+    def test_upload_striped(self, tmp_path, monkeypatch):
+        """ Check that uploads are striped across weighted RSEs, and that the rule covers them all or consolidates
+        the upload onto another RSE.
+        """
+        for idx in range(12):
+            path = tmp_path / 'src' / 'd{}'.format(idx % 2) / 'f{}'.format(idx)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b'x' * 1024 * (idx + 1))
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        with rucio.patch():
+            plan = UploadPlanMetadata.make_plan_from_directory(
+                str(tmp_path / 'src'), 'striped', rse={'RSE_A': 1, 'RSE_B': 2}, scope='scope', lifetime=3600)
+            upload_steps = [step for step in plan.steps if step.section_name == 'upload_files']
+            assert len(upload_steps) == 4                       # one per RSE per directory
+            assert all(len(set(item['rse'] for item in step.arguments['items'])) == 1 for step in upload_steps)
+            plan.run()
+            bytes_per_rse = {'RSE_A': 0, 'RSE_B': 0}
+            for did, replicas in rucio.replicas.items():
+                for rse in replicas:
+                    bytes_per_rse[rse] += rucio.dids[did]['bytes']
+            assert abs(bytes_per_rse['RSE_B'] / bytes_per_rse['RSE_A'] - 2) < 0.2
+            assert [(rule['rse_expression'], rule['grouping']) for rule in rucio.rules.values()] == \
+                [('RSE_A|RSE_B', 'NONE')]
+
+            plan = UploadPlanNative.make_plan_from_directory(
+                str(tmp_path / 'src'), 'consolidated', rse={'RSE_A': 1, 'RSE_B': 1}, scope='scope', lifetime=3600,
+                consolidate_rse='RSE_C')
+            plan.run()
+            assert [rule['rse_expression'] for rule in rucio.rules.values()] == ['RSE_A|RSE_B', 'RSE_C']
+            assert 'grouping' not in list(rucio.rules.values())[-1]        # consolidated as Rucio does by default
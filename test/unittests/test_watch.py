@@ -0,0 +1,158 @@
+import os
+
+import pytest
+
+from rucio_extended_client.api.ingest import IncrementalIngest
+from rucio_extended_client.api.plan import DownloadPlanMetadata, DownloadPlanNative, UploadPlanMetadata, \
+    UploadPlanNative
+from rucio_extended_client.common.exceptions import InjectedFailureError
+from rucio_extended_client.common.watch import InotifyWatcher, PollingWatcher, StabilityTracker
+from rucio_extended_client.testing.fake import FakeRucio
+
+
+def write(root, path, content=None):
+    os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+    with open(os.path.join(root, path), 'w') as fi:
+        fi.write(content or path)
+
+
+class TestWatch:
+    @pytest.mark.parametrize('method, upload_cls, download_cls', [
+        ('metadata', UploadPlanMetadata, DownloadPlanMetadata),
+        ('native', UploadPlanNative, DownloadPlanNative)
+    ])
+    def test_watch_ingests_into_hierarchy(self, tmp_path, monkeypatch, method, upload_cls, download_cls):
+        """ Check that files written after an upload are ingested into the existing hierarchy. """
+        root = str(tmp_path / 'src' / 'obs')
+        for path in ['d1/d1_d1/f1', 'd1/f2', 'd2/f3', 'f4']:
+            write(root, path)
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        with rucio.patch():
+            upload_cls.make_plan_from_directory(root, 'obs', rse='RSE', scope='scope', lifetime=3600).run()
+            n_uploads = rucio.calls['upload']
+            for path in ['f5', 'd1/d1_d1/f6', 'd1/f7', 'd3/d3_d1/f8', 'd1/f2.tmp']:
+                write(root, path)
+            ingest = IncrementalIngest(root, 'scope', 'obs', rse='RSE', method=method, exclude=['*.tmp'])
+            ingest.watch(settle_seconds=0, batch_seconds=0, use_inotify=False, max_batches=1)
+            assert rucio.calls['upload'] == n_uploads + 1
+            assert ingest.is_pending(os.path.join(root, 'f5')) is False
+
+            # a second batch only has the newly written file
+            write(root, 'd2/f9')
+            assert ingest.ingest([os.path.join(root, 'd2/f9'), os.path.join(root, 'f5')]) == 1
+
+            metadata = rucio.metadata[('scope', 'obs')]['hierarchy']
+            assert metadata['dir_checksum'] is None
+            if method == 'metadata':
+                assert metadata['n_files'] == 9
+                assert 'obs/d3' in metadata['dirs'] and 'obs/d3/d3_d1' in metadata['dirs']
+
+            download_cls.make_plan_from_did('scope', 'obs', clobber=False, show_tree=False).run()
+        for path in ['d1/d1_d1/f1', 'f5', 'd1/d1_d1/f6', 'd1/f7', 'd3/d3_d1/f8', 'd2/f9']:
+            with open(str(tmp_path / 'obs' / path)) as fi:
+                assert fi.read() == path
+        assert not os.path.exists(str(tmp_path / 'obs' / 'd1' / 'f2.tmp'))
+
+    def test_watch_keeps_failed_batch(self, tmp_path, monkeypatch):
+        """ Check that a micro-batch failing to ingest raises rather than exiting, and that watching logs the error and
+        keeps its files for the next micro-batch.
+        """
+        root = str(tmp_path / 'src' / 'obs')
+        write(root, 'd1/f1')
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        with rucio.patch():
+            UploadPlanNative.make_plan_from_directory(root, 'obs', rse='RSE', scope='scope', lifetime=3600).run()
+            write(root, 'd1/f2')
+            rucio.failure_rate = {'upload': 1}
+            ingest = IncrementalIngest(root, 'scope', 'obs', rse='RSE', method='native')
+            ingest.load()
+            with pytest.raises(InjectedFailureError):
+                ingest.ingest([os.path.join(root, 'd1', 'f2')])
+            assert not os.path.exists(str(tmp_path / 'plan-dump.json'))
+
+            batches = []
+            ingest_batch = ingest.ingest
+
+            def ingest_failing_once(paths, dry_run=False):
+                batches.append(paths)
+                if len(batches) == 2:
+                    rucio.failure_rate = 0
+                return ingest_batch(paths, dry_run=dry_run)
+
+            monkeypatch.setattr(ingest, 'ingest', ingest_failing_once)
+            ingest.watch(settle_seconds=0, batch_seconds=0, use_inotify=False, max_batches=2, retry_seconds=0)
+            assert batches == [[os.path.join(root, 'd1', 'f2')]] * 2
+            assert ingest.is_pending(os.path.join(root, 'd1', 'f2')) is False
+            assert ('scope', 'obs.d1.f2') in rucio.dids
+
+    @pytest.mark.parametrize('method, upload_cls, download_cls, failing_call', [
+        ('metadata', UploadPlanMetadata, DownloadPlanMetadata, 'set_dids_metadata_bulk'),
+        ('native', UploadPlanNative, DownloadPlanNative, 'set_dids_metadata_bulk'),
+        ('native', UploadPlanNative, DownloadPlanNative, 'add_datasets_to_containers')
+    ])
+    def test_retry_partly_failed_batch(self, tmp_path, monkeypatch, method, upload_cls, download_cls, failing_call):
+        """ Check that retrying a micro-batch that failed partway through repeats none of the steps that finished, and
+        uploads its files under the same DID names.
+        """
+        root = str(tmp_path / 'src' / 'obs')
+        write(root, 'd1/f1')
+        monkeypatch.chdir(tmp_path)
+        rucio = FakeRucio(storage_dir=str(tmp_path / 'storage'))
+        with rucio.patch():
+            upload_cls.make_plan_from_directory(root, 'obs', rse='RSE', scope='scope', lifetime=3600).run()
+            write(root, 'd1/f2')
+            write(root, 'd2/f3')
+            paths = [os.path.join(root, 'd1', 'f2'), os.path.join(root, 'd2', 'f3')]
+            ingest = IncrementalIngest(root, 'scope', 'obs', rse='RSE', method=method)
+            ingest.load()
+            rucio.failure_rate = {failing_call: 1}
+            with pytest.raises(InjectedFailureError):
+                ingest.ingest(paths)
+            rucio.failure_rate = 0
+            n_uploads = rucio.calls['upload_item']
+            dids = set(rucio.dids)
+
+            assert ingest.ingest(paths) == 2
+            is_uploaded = failing_call == 'set_dids_metadata_bulk'
+            assert rucio.calls['upload_item'] == n_uploads + (0 if is_uploaded else 2)
+            assert len(rucio.dids) == len(dids) + (0 if is_uploaded else 2)
+            assert not any(ingest.is_pending(path) for path in paths)
+            assert not ingest.planned_names and not ingest.uploaded and not ingest.unattached
+
+            os.rename(root, str(tmp_path / 'src' / 'local'))
+            download_cls.make_plan_from_did('scope', 'obs', clobber=False, show_tree=False).run()
+        for path in ['d1/f1', 'd1/f2', 'd2/f3']:
+            with open(str(tmp_path / 'obs' / path)) as fi:
+                assert fi.read() == path
+
+    def test_stability_tracker(self, tmp_path):
+        """ Check that files are only ready once unchanged for the settling time. """
+        write(str(tmp_path), 'f1')
+        tracker = StabilityTracker(settle_seconds=10)
+        tracker.add(str(tmp_path / 'f1'), now=0)
+        assert tracker.pop_ready(now=5) == []
+        assert tracker.time_until_ready(now=5) == 5
+        with open(str(tmp_path / 'f1'), 'a') as fi:
+            fi.write('more')
+        assert tracker.pop_ready(now=8) == []           # changed, so the settling time restarts
+        assert tracker.pop_ready(now=17) == []
+        assert tracker.pop_ready(now=18) == [str(tmp_path / 'f1')]
+        assert tracker.time_until_ready() is None
+
+    def test_watchers(self, tmp_path):
+        """ Check that both watchers report existing files, then new and changed files. """
+        write(str(tmp_path), 'd1/f1')
+        watchers = [PollingWatcher(str(tmp_path), interval=0)]
+        try:
+            watchers.append(InotifyWatcher(str(tmp_path)))
+        except OSError:
+            pass
+        for watcher in watchers:
+            assert watcher.poll(0) == [str(tmp_path / 'd1' / 'f1')]
+        write(str(tmp_path), 'd2/d2_d1/f2')
+        for watcher in watchers:
+            assert watcher.poll(1) == [str(tmp_path / 'd2' / 'd2_d1' / 'f2')]
+            assert watcher.poll(0) == []
+            watcher.close()